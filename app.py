@@ -2,16 +2,17 @@
 
 import streamlit as st
 import pandas as pd
-from docxtpl import DocxTemplate
 import os
-import re
 import time
-import zipfile
 from io import BytesIO
 
-# --- Importaciones de Google Cloud (CORREGIDAS) ---
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part, HarmCategory, HarmBlockThreshold
+from fichas import CacheFichas, contextos_fichas, ensamblar_zip_fichas, renderizar_ficha_docxtpl, variables_plantilla
+from motor import (
+    DIRECTORIO_DATOS, FORMATOS_EXPORTACION, MODEL_OPTIONS, MODO_REPARACION, MODOS_EJECUCION, MODOS_GENERACION, REGIONES_ADICIONALES,
+    FORMATOS_TELEMETRIA, CacheRespuestas, DestinoZipFichas, ErrorEsquemaExcel, calcular_items_por_minuto,
+    columnas_excel, serializar_datos, serializar_telemetria, validar_esquema_excel,
+)
+from trabajos import ESTADOS_ACTIVOS, ESTADOS_REANUDABLES, GestorTrabajos
 
 # --- CONFIGURACIÓN DE LA PÁGINA DE STREAMLIT ---
 st.set_page_config(
@@ -20,303 +21,53 @@ st.set_page_config(
     layout="wide"
 )
 
-# --- MODELOS DISPONIBLES ---
-MODEL_OPTIONS = {
-    "Gemini 2.5 Pro": "gemini-2.5-pro",
-    "Gemini 2.5 Flash": "gemini-2.5-flash",
-    "Gemini 2.5 Flash Lite": "gemini-2.5-flash-lite",
-}
+# --- ADAPTADORES DEL MOTOR A STREAMLIT ---
 
-# --- FUNCIONES DE LÓGICA ---
-
-def limpiar_html(texto_html):
-    """Limpia etiquetas HTML de un texto."""
-    if not isinstance(texto_html, str):
-        return texto_html
-    cleanr = re.compile('<.*?>')
-    texto_limpio = re.sub(cleanr, '', texto_html)
-    return texto_limpio
-
-def setup_model(project_id, location, model_name):
-    """Configura y retorna el cliente para el modelo Gemini en Vertex AI."""
-    try:
-        vertexai.init(project=project_id, location=location)
-        
-        generation_config = {
-            "temperature": 0.6,
-            "top_p": 1.0,
-            "top_k": 32,
-            "max_output_tokens": 8192,
-        }
-        
-        # Forma correcta de definir las configuraciones de seguridad
-        safety_settings = {
-            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-        }
-
-        model = GenerativeModel(
-            model_name,
-            generation_config=generation_config,
-            safety_settings=safety_settings
-        )
-        return model
-    except Exception as e:
-        st.error(f"Error al inicializar Vertex AI: {e}")
-        st.info("Asegúrate de haberte autenticado con 'gcloud auth application-default login' en tu terminal y de que las APIs necesarias estén habilitadas en tu proyecto de Google Cloud.")
-        return None
-
-# --- EJEMPLOS DE ALTA CALIDAD (FEW-SHOT PROMPTING) ---
-
-EJEMPLOS_ANALISIS_PREMIUM = """
-A continuación, te muestro ejemplos de análisis de la más alta calidad. Tu respuesta debe seguir este mismo estilo, tono y nivel de detalle.
-
-### EJEMPLO 1: LECTURA LITERAL (TEXTO NARRATIVO) ###
-**INSUMOS:**
-- Competencia: Comprensión de textos
-- Componente: Lectura literal
-- Evidencia: Reconoce información específica en el texto.
-- Enunciado: Los personajes del cuento son:
-- Opciones: A: "Un hombre, un hombrecito y alguien que sostiene unas pinzas.", B: "Un narrador, un hombre y un hombrecito.", C: Un hombrecito y alguien que sostiene unas pinzas., D: Un hombre y el narrador.
-
-**RESULTADO ESPERADO:**
-Ruta Cognitiva Correcta:
-Para responder la pregunta, el estudiante debe leer el cuento prestando atención a las entidades que realizan acciones o a quienes les suceden eventos en el texto. En el tercer párrafo, se menciona a "un hombre" que armó el barquito y a un "hombrecito diminuto" dentro de la botella. En el último párrafo, se describe que un "ojo enorme lo atisbaba desde fuera" al primer hombre y que "unas enormes pinzas que avanzaban hacia él". Este "ojo enorme" y las "enormes pinzas" implican la existencia de un tercer personaje, un ser que se encuentra mirando al primer personaje. El estudiante debe identificar a todos estos personajes que interactúan o son afectados por la trama.
-
-Análisis de Opciones No Válidas:
-- **Opción B:** No es correcta porque, en este cuento, el "narrador" es la voz que cuenta la historia, no un personaje que participe en los eventos del cuento. El relato está escrito en tercera persona y el narrador se mantiene fuera de la acción.
-- **Opción C:** No es correcta porque omite al primer personaje introducido y central en la trama: "un hombre" que construye el barquito y observa al "hombrecito". Sin este personaje, la secuencia de eventos no se establece.
-- **Opción D:** No es correcta porque, al igual que la opción B, incluye al "narrador" como personaje, lo cual es incorrecto. Además, omite al "hombrecito" y al ser con "unas pinzas", reduciendo el número de personajes activos en la historia.
-
-### EJEMPLO 2: LECTURA INFERENCIAL (TEXTO NARRATIVO-INFORMATIVO) ###
-**INSUMOS:**
-- Competencia: Comprensión de textos
-- Componente: Lectura inferencial
-- Evidencia: Integra y compara diferentes partes del texto y analiza la estructura para hacer inferencias.
-- Enunciado: Lee el siguiente fragmento del texto: “Los manglares están muriendo, por lo que el desequilibrio es cada vez mayor. La carretera lo cambió todo. Para construirla arrasaron veinte mil hectáreas de manglar...”. ¿Qué función cumple la parte subrayada dentro del fragmento?
-- Opciones: A: Señalar la causa de un problema medioambiental., B: Establecer una comparación entre dos acciones de un proceso., C: Mostrar la consecuencia del daño medioambiental., D: Explicar el motivo por el que se decidió realizar una acción.
-
-**RESULTADO ESPERADO:**
-Ruta Cognitiva Correcta:
-El estudiante debe comprender el contenido del fragmento y la estructura global del texto, para luego identificar cuál es la función que cumple dentro de esta. En este caso específico, el estudiante debe comprender que el fragmento señala la principal causa que ha llevado al desequilibrio del ecosistema de los manglares en la zona, y que este fragmento del texto justamente cumple con la función de señalar esa causa.
-
-Análisis de Opciones No Válidas:
-- **Opción B:** Es incorrecta porque la pregunta busca la causa del problema, no la comparación de acciones.
-- **Opción C:** Es incorrecta porque el estudiante confunde la causa con la consecuencia del problema medioambiental. Identifica un efecto del problema, pero no su origen.
-- **Opción D:** Es incorrecta porque se centra en la motivación detrás de una acción, en lugar de la causa del problema en sí mismo. La pregunta busca el origen del problema medioambiental.
-
-### EJEMPLO 3: LECTURA CRÍTICA (TEXTO NARRATIVO-INFORMATIVO) ###
-**INSUMOS:**
-- Competencia: Comprensión de textos
-- Componente: Lectura crítica
-- Evidencia: Evalúa la credibilidad, confiabilidad y objetividad del texto, emitiendo juicios críticos sobre la información.
-- Enunciado: ¿Por qué el autor cita el testimonio de Jesús Suárez en el texto?
-- Opciones: A: Porque es el vocero que la comunidad palafítica ha designado., B: Porque es causante de la situación que ocurre en la población., C: Porque al ser experto en ecosistemas acuáticos su opinión es confiable., D: Porque al ser investigador puede verificar lo dicho por otro testigo de los hechos.
-
-**RESULTADO ESPERADO:**
-Ruta Cognitiva Correcta:
-El estudiante analiza las opciones presentadas considerando la relación entre la justificación dada y la confiabilidad de la fuente. Evalúa la opción C y reconoce que la experticia en ecosistemas acuáticos otorga mayor credibilidad a la opinión de un individuo sobre una situación relacionada con este tema. Justifica la selección de la opción C al contrastarla con las demás opciones, considerando la relevancia de la experticia para la situación planteada.
-
-Análisis de Opciones No Válidas:
-- **Opción A:** Es incorrecta porque ser vocero no implica necesariamente tener el conocimiento experto para opinar sobre situaciones específicas.
-- **Opción B:** Es incorrecta porque ser causante de un problema no implica tener el conocimiento o la imparcialidad para analizarlo y ofrecer una opinión confiable.
-- **Opción D:** Es incorrecta porque la verificación de un testimonio en este contexto requiere una experticia específica en el tema, que en este caso es ecosistemas acuáticos.
-"""
-
-EJEMPLOS_RECOMENDACIONES_PREMIUM = """
-A continuación, te muestro ejemplos de recomendaciones pedagógicas de la más alta calidad. Tu respuesta debe seguir este mismo estilo, estructura y enfoque creativo.
-
-### EJEMPLO 1 DE RECOMENDACIONES PERFECTAS (TEXTO DISCONTINUO) ###
-**INSUMOS:**
-- Qué Evalúa la pregunta: la pregunta evalúa la habilidad del estudiante para relacionar diferentes elementos del contenido e identificar nueva información en textos no literarios.
-- Evidencia: Relaciona diferentes partes del texto para hacer inferencias sobre significados o sobre el propósito general.
-
-**RESULTADO ESPERADO:**
-RECOMENDACIÓN PARA FORTALECER EL APRENDIZAJE EVALUADO EN la pregunta
-Para reforzar la habilidad de vincular diferentes elementos del contenido y descubrir nuevas ideas, se sugiere la realización de actividades que impliquen el análisis de textos no literarios de carácter discontinuo como infografías. Los estudiantes podrían empezar por leer estas fuentes y marcar los datos que consideren relevantes. Posteriormente, en un esfuerzo colectivo, podrían construir un mapa conceptual que refleje la relación entre los diferentes datos resaltados. Finalmente, podrían trabajar en la identificación de las ideas principales y secundarias que emergen de este mapa, lo que les permitirá tener una comprensión más profunda del texto.
-
-RECOMENDACIÓN PARA AVANZAR EN EL APRENDIZAJE EVALUADO EN la pregunta
-Para consolidar la capacidad de identificar las funciones de los diferentes elementos que componen un texto no literario de carácter discontinuo, se sugiere fomentar la práctica de reorganizar textos desordenados. Los estudiantes pueden recibir fragmentos de una infografía que deben arreglar en el orden correcto, identificando la introducción, el desarrollo y la conclusión. Durante esta actividad, se pueden formular preguntas como: ¿Cuál fragmento introduce el tema? ¿Qué información proporciona esta imagen o gráfico? ¿Cómo se relaciona con el texto?
-
-### EJEMPLO 2 DE RECOMENDACIONES PERFECTAS (TEXTO INFORMATIVO) ###
-**INSUMOS:**
-- Qué Evalúa la pregunta: Este ítem evalúa la capacidad del estudiante para hacer una inferencia integrando información implícita presente en una parte del texto.
-- Evidencia: Integra y compara diferentes partes del texto y analiza la estructura para hacer inferencias.
-
-**RESULTADO ESPERADO:**
-RECOMENDACIÓN PARA FORTALECER EL APRENDIZAJE EVALUADO EN la pregunta
-Para fortalecer la habilidad de hacer inferencias a partir de un segmento de un texto informativo, se sugiere implementar una dinámica de "lectura de pistas". Esta estrategia se enfoca en que los estudiantes identifiquen información implícita en fragmentos textuales cortos para inferir contextos o emociones que no se mencionan directamente. El docente puede presentar al grupo tres o cuatro fragmentos muy breves y evocadores (de noticias o crónicas) que insinúen una situación sin describirla por completo. Por ejemplo: "El teléfono sonó por décima vez. Al otro lado de la línea, solo se oía una respiración agitada. Afuera, la sirena de una ambulancia se acercaba". Los estudiantes, en parejas, leen el fragmento y discuten qué pueden deducir de la escena. Las preguntas orientadoras pueden ser: ¿Qué pistas te da el texto sobre el estado de ánimo de la persona?, ¿Qué crees que pasó justo antes de la escena descrita?
-
-RECOMENDACIÓN PARA AVANZAR EN EL APRENDIZAJE EVALUADO EN la pregunta
-Para avanzar en la habilidad de hacer inferencias complejas a partir de la comparación de diferentes partes de un texto, se sugiere proponer un análisis de perspectivas múltiples dentro de una misma crónica o texto informativo. El objetivo es que los estudiantes superen la inferencia local y aprendan a contrastar voces, datos o argumentos presentados en un mismo relato. El docente puede seleccionar una crónica periodística sobre un tema urbano actual que incluya las voces de distintos actores sociales (un vendedor, un residente, un funcionario). Los estudiantes deben leer el texto e identificar y comparar las diferentes posturas frente al mismo hecho. Las preguntas orientadoras pueden ser: ¿Qué similitudes y diferencias encuentras entre las perspectivas?, ¿Qué visión del problema se formaría un lector si el texto solo hubiera incluido una de estas voces?
-"""
-
-# --- FUNCIONES DE PROMPTS SECUENCIALES ---
-
-def construir_prompt_paso1_analisis_central(fila, instruccion_adicional=""):
-    """Paso 1: Genera la Ruta Cognitiva y el Análisis de Distractores, guiado por ejemplos."""
-    fila = fila.fillna('')
-    descripcion_item = (
-        f"Enunciado: {fila.get('Enunciado', '')}\n"
-        f"A. {fila.get('OpcionA', '')}\n"
-        f"B. {fila.get('OpcionB', '')}\n"
-        f"C. {fila.get('OpcionC', '')}\n"
-        f"D. {fila.get('OpcionD', '')}\n"
-        f"Respuesta correcta: {fila.get('AlternativaClave', '')}"
+@st.cache_resource
+def obtener_cache_respuestas(ruta, max_mb):
+    """Una sola caché por proceso, compartida entre reruns y sesiones."""
+    return CacheRespuestas(ruta, max_bytes=int(max_mb * 1024 * 1024))
+
+@st.cache_resource
+def obtener_cache_fichas(ruta, max_mb):
+    """Fichas ya renderizadas, compartidas entre reruns y sesiones."""
+    return CacheFichas(ruta, max_bytes=int(max_mb * 1024 * 1024))
+
+def leer_archivo(ruta):
+    """Bytes de un archivo local para una descarga diferida (solo se lee al pulsar el botón)."""
+    with open(ruta, "rb") as f:
+        return f.read()
+
+@st.cache_resource
+def obtener_gestor_trabajos():
+    """Un solo gestor por proceso: los trabajos siguen corriendo aunque la sesión se cierre."""
+    return GestorTrabajos(
+        max_simultaneos=int(os.environ.get("MAX_TRABAJOS_SIMULTANEOS", "4")), fabrica_cache=obtener_cache_respuestas
     )
-    instruccion_formateada = f"\n**Instrucción Adicional del Usuario:** {instruccion_adicional}\n" if instruccion_adicional else ""
-    return f"""
-🎯 ROL DEL SISTEMA
-Eres un experto psicómetra y pedagogo. Tu misión es deconstruir un ítem de evaluación siguiendo el estilo y la calidad de los ejemplos proporcionados.
-
-{EJEMPLOS_ANALISIS_PREMIUM}
-
-🧠 INSUMOS DE ENTRADA (Para el nuevo ítem que debes analizar):
-- Texto/Fragmento: {fila.get('ItemContexto', 'No aplica')}
-- Descripción dla pregunta: {fila.get('ItemEnunciado', 'No aplica')}
-- Componente: {fila.get('ComponenteNombre', 'No aplica')}
-- Competencia: {fila.get('CompetenciaNombre', '')}
-- Aprendizaje Priorizado: {fila.get('AfirmacionNombre', '')}
-- Evidencia de Aprendizaje: {fila.get('EvidenciaNombre', '')}
-- Tipología Textual (Solo para Lectura Crítica): {fila.get('Tipologia Textual', 'No aplica')}
-- Grado Escolar: {fila.get('ItemGradoId', '')}
-- Análisis de Errores Comunes: {fila.get('Analisis_Errores', 'No aplica')}
-- Respuesta correcta: {fila.get('AlternativaClave', 'No aplica')}
-- Opción A: {fila.get('OpcionA', 'No aplica')}
-- Opción B: {fila.get('OpcionB', 'No aplica')}
-- Opción C: {fila.get('OpcionC', 'No aplica')}
-- Opción D: {fila.get('OpcionD', 'No aplica')}
-
-
-📝 INSTRUCCIONES
-Basándote en los ejemplos de alta calidad y los nuevos insumos, realiza el siguiente proceso en dos fases:
-{instruccion_formateada}
-
-FASE 1: RUTA COGNITIVA
-Describe, en un párrafo continuo y de forma impersonal, el procedimiento mental que un estudiante debe ejecutar para llegar a la respuesta correcta.
-1.  **Genera la Ruta Cognitiva:** Describe el paso a paso mental y lógico que un estudiante debe seguir para llegar a la respuesta correcta. Usa verbos que representen procesos cognitivos.
-2.  **Auto-Verificación:** Revisa que la ruta se alinee con la Competencia ('{fila.get('CompetenciaNombre', '')}') y la Evidencia ('{fila.get('EvidenciaNombre', '')}').
-3.  **Justificación Final:** El último paso debe justificar la elección de la respuesta correcta.
-
-FASE 2: ANÁLISIS DE OPCIONES NO VÁLIDAS
-- Para cada opción incorrecta, identifica la naturaleza del error y explica el razonamiento fallido.
-- Luego, explica el posible razonamiento que lleva al estudiante a cometer ese error.
-- Finalmente, clarifica por qué esa opción es incorrecta en el contexto de la tarea evaluativa.
-
-✍️ FORMATO DE SALIDA
-**REGLA CRÍTICA:** Responde únicamente con los dos títulos siguientes, en este orden y sin añadir texto adicional.
-
-Ruta Cognitiva Correcta:
-[Párrafo continuo y detallado.] Debe describir como es la secuencia de procesos cognitivos. Ejemplo: Para resolver correctamente este ítem, el estudiante primero debe [verbo cognitivo 1]... Luego, necesita [verbo cognitivo 2]... Este proceso le permite [verbo cognitivo 3]..., lo que finalmente lo lleva a concluir que la opción [letra de la respuesta correcta] es la correcta porque [justificación final].
-
-Análisis de Opciones No Válidas:
-- **Opción [Letra del distractor]:** El estudiante podría escoger esta opción si comete un error de [naturaleza de la confusión u error], lo que lo lleva a pensar que [razonamiento erróneo]. Sin embargo, esto es incorrecto porque [razón clara y concisa].
-"""
-    
-def construir_prompt_paso2_sintesis_que_evalua(analisis_central_generado, fila, instruccion_adicional=""):
-    """Paso 2: Sintetiza el "Qué Evalúa" a partir del análisis central."""
-    fila = fila.fillna('')
-    try:
-        header_distractores = "Análisis de Opciones No Válidas:"
-        idx_distractores = analisis_central_generado.find(header_distractores)
-        ruta_cognitiva_texto = analisis_central_generado[:idx_distractores].strip() if idx_distractores != -1 else analisis_central_generado
-    except:
-        ruta_cognitiva_texto = analisis_central_generado
-    instruccion_formateada = f"\n**Instrucción Adicional del Usuario:** {instruccion_adicional}\n" if instruccion_adicional else ""
-    return f"""
-🎯 ROL DEL SISTEMA
-Eres un experto en evaluación que sintetiza análisis complejos en una sola frase concisa.
-
-🧠 INSUMOS DE ENTRADA
-A continuación, te proporciono un análisis detallado de la ruta cognitiva necesaria para resolver un ítem.
-
-ANÁLISIS DE LA RUTA COGNITIVA:
----
-{ruta_cognitiva_texto}
----
-
-TAXONOMÍA DE REFERENCIA:
-- Competencia: {fila.get('CompetenciaNombre', '')}
-- Aprendizaje Priorizado: {fila.get('AfirmacionNombre', '')}
-- Evidencia de Aprendizaje: {fila.get('EvidenciaNombre', '')}
-
-📝 INSTRUCCIONES
-{instruccion_formateada}
-Basándote **exclusivamente** en el ANÁLISIS DE LA RUTA COGNITIVA, redacta una única frase (máximo 2 renglones) que resuma la habilidad principal que se está evaluando.
-- **Regla 1:** La frase debe comenzar obligatoriamente con "Este ítem evalúa la capacidad del estudiante para...".
-- **Regla 2:** La frase debe describir los **procesos cognitivos**, no debe contener especificamene ninguno de los elementos del texto o dla pregunta, busca en cambio palabras/expresiones genéricas en reemplazo de elementos del item/texto cuando es necesario.
-- **Regla 3:** Utiliza la TAXONOMÍA DE REFERENCIA para asegurar que el lenguaje sea preciso y alineado.
-
-✍️ FORMATO DE SALIDA
-Responde únicamente con la frase solicitada, sin el título "Qué Evalúa".
-"""
-
-def construir_prompt_paso3_recomendaciones(que_evalua_sintetizado, analisis_central_generado, fila, instruccion_adicional=""):
-    """Paso 3: Genera las recomendaciones, guiado por ejemplos."""
-    fila = fila.fillna('')
-    instruccion_formateada = f"\n**Instrucción Adicional del Usuario:** {instruccion_adicional}\n" if instruccion_adicional else ""
-    return f"""
-🎯 ROL DEL SISTEMA
-Eres un diseñador instruccional experto y un docente de aula con mucha experiencia. Tu especialidad es crear actividades de lectura que son novedosas, lúdicas y, sobre todo, prácticas y realizables en un salón de clases con recursos limitados.
-
-{EJEMPLOS_RECOMENDACIONES_PREMIUM}
-
-🧠 INSUMOS DE ENTRADA (Para el nuevo ítem):
-# Se mantienen los insumos para dar contexto, pero las instrucciones forzarán a la IA a no usarlos literalmente.
-- Qué Evalúa la pregunta: {que_evalua_sintetizado}
-- Análisis Detallado dla pregunta: {analisis_central_generado}
-- Texto/Fragmento: {fila.get('ItemContexto', 'No aplica')}
-- Descripción dla pregunta: {fila.get('ItemEnunciado', 'No aplica')}
-- Componente: {fila.get('ComponenteNombre', 'No aplica')}
-- Competencia: {fila.get('CompetenciaNombre', '')}
-- Aprendizaje Priorizado: {fila.get('AfirmacionNombre', '')}
-- Evidencia de Aprendizaje: {fila.get('EvidenciaNombre', '')}
-- Tipología Textual (Solo para Lectura Crítica): {fila.get('Tipologia Textual', 'No aplica')}
-- Grado Escolar: {fila.get('ItemGradoId', '')}
-- Análisis de Errores Comunes: {fila.get('Analisis_Errores', 'No aplica')}
-- Respuesta correcta: {fila.get('AlternativaClave', 'No aplica')}
-
-📝 INSTRUCCIONES PARA GENERAR LAS RECOMENDACIONES
-{instruccion_formateada}
-Basándote en los ejemplos y los insumos, genera dos recomendaciones (Fortalecer y Avanzar) que cumplan con estas reglas inviolables:
-1.  **ABSTRACCIÓN DE LA HABILIDAD:** # <-- CAMBIO CLAVE 1: Desanclar del ítem.
-    Las actividades deben enfocarse en la habilidad cognitiva descrita en 'Qué Evalúa la pregunta', no en el contenido específico del 'Texto/Fragmento' o la 'Descripción dla pregunta'. Usa los insumos solo para entender la habilidad, pero diseña una actividad que se pueda aplicar a OTROS textos o contextos.
-    CRÍTICO: Evita usar las mismas situaciones expuestas en el ítem. Deben ser diferentes pero debene estar dentro del mismo campo cognitivo de lo que evalúa el ítem.
-    
-2.  **VIABILIDAD EN EL AULA:** # <-- CAMBIO CLAVE 2: Realismo y practicidad.
-    Las actividades deben ser 100% realizables dentro de un salón de clases estándar. Esto significa:
-    - **Cero Materiales:** No requieren preparación de materiales especiales (fichas, tarjetas, proyectores). Se basan en la discusión, el análisis oral o la interacción con un texto genérico.
-    - **Cero Tareas Externas:** No implican actividades fuera del aula, ni uso de tecnología.
-    - **La novedad está en la dinámica, no en los recursos.**
-
-3.  **CERO PRODUCCIÓN ESCRITA:** Deben ser actividades exclusivas de lectura, selección, debate corto, clasificación oral o argumentación.
-
-4.  **CREATIVIDAD BASADA EN EL ESCENARIO:** # <-- ESTA ES LA REGLA CLAVE MODIFICADA
-    La novedad y el factor lúdico deben residir en la **situación o el contexto** que se plantea, no necesariamente en el formato de la interacción.
-    - **EVITA** escenarios clichés o abstractos típicos de libros de texto. Por ejemplo, en lugar de "lanzar un dado 20 veces", que es un escenario aburrido...
-    - **FAVORECE** escenarios concretos, imaginativos y con una narrativa. Por ejemplo, para la misma habilidad de probabilidad, podrías proponer: "se organiza un pequeño 'casino' en clase con barajas de colores donde los estudiantes deben calcular sus posibilidades de ganar en diferentes juegos inventados". O "los estudiantes son exploradores que deben decidir qué camino tomar en una jungla basándose en las probabilidades de encontrar recursos o peligros".
-    - El objetivo es crear un "mini-mundo" o un reto temático donde se aplique la habilidad.
-
-5.  **REDACCIÓN IMPERSONAL.**
-
-RECOMENDACIÓN PARA FORTALECER EL APRENDIZAJE EVALUADO EN la pregunta
-Para fortalecer la habilidad de [verbo clave extraído de la Evidencia de Aprendizaje], se sugiere [descripción de la estrategia de andamiaje para ese proceso exacto].
-Una actividad que se puede hacer es: [Descripción detallada de la actividad novedosa y creativa, que no implica escritura].
-Las preguntas orientadoras para esta actividad, entre otras, pueden ser:
-- [Pregunta 1: Que guíe el primer paso del proceso cognitivo]
-- [Pregunta 2: Que ayude a analizar un componente clave del proceso]
-- [Pregunta 3: Que conduzca a la conclusión del proceso base]
-
-RECOMENDACIÓN PARA AVANZAR EN EL APRENDIZAJE EVALUADO EN la pregunta
-Para avanzar desde [proceso cognitivo de Fortalecer] hacia la habilidad de [verbo clave del proceso cognitivo superior], se sugiere [descripción de la estrategia de complejización].
-Una actividad que se puede hacer es: [Descripción detallada de la actividad estimulante y poco convencional, que no implique escritura].
-Las preguntas orientadoras para esta actividad, entre otras, pueden ser:
-- [Pregunta 1: De análisis o evaluación que requiera un razonamiento más profundo]
-- [Pregunta 2: De aplicación, comparación o transferencia a un nuevo contexto]
-- [Pregunta 3: De metacognición o pensamiento crítico sobre el proceso completo]
-"""
+
+ETIQUETAS_ESTADO = {
+    "en_cola": "⏳ En cola",
+    "en_curso": "⚙️ En curso",
+    "completado": "✅ Completado",
+    "cancelado": "⏹️ Cancelado",
+    "interrumpido": "⚠️ Interrumpido",
+    "fallido": "❌ Fallido",
+}
+MAX_FALLOS_MOSTRADOS = 200
+
+def formatear_duracion(segundos):
+    minutos, segundos = divmod(int(segundos), 60)
+    horas, minutos = divmod(minutos, 60)
+    return f"{horas}h {minutos:02d}m" if horas else f"{minutos}m {segundos:02d}s"
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def exportar_datos(_df, version, formato):
+    """Serializa el DataFrame enriquecido una sola vez por versión y formato.
+
+    `version` identifica el contenido de `_df` (cambia cada vez que se guarda un nuevo
+    resultado); el DataFrame no se hashea para no pagar ese costo en cada rerun.
+    """
+    return serializar_datos(_df, formato)
 
 # --- INTERFAZ PRINCIPAL DE STREAMLIT ---
 
@@ -325,8 +76,15 @@ st.markdown("Una aplicación para enriquecer datos pedagógicos usando los model
 
 if 'df_enriquecido' not in st.session_state:
     st.session_state.df_enriquecido = None
-if 'zip_buffer' not in st.session_state:
-    st.session_state.zip_buffer = None
+    st.session_state.version_df = None
+if 'zip_fichas' not in st.session_state:
+    st.session_state.zip_fichas = None
+if 'comparativa_modos' not in st.session_state:
+    st.session_state.comparativa_modos = []
+if 'trabajo_actual' not in st.session_state:
+    st.session_state.trabajo_actual = None
+
+gestor_trabajos = obtener_gestor_trabajos()
 
 # --- PASO 0: Configuración de Google Cloud en la Barra Lateral ---
 st.sidebar.header("☁️ Configuración de Google Cloud")
@@ -341,11 +99,113 @@ location = st.sidebar.text_input(
     value=os.environ.get("GCP_LOCATION", "us-central1"),
     help="Ejemplo: us-central1, europe-west2, etc."
 )
+regiones_adicionales = [region.strip() for region in st.sidebar.text_input(
+    "Regiones adicionales (opcional)",
+    value=", ".join(REGIONES_ADICIONALES),
+    help="Separadas por comas, p. ej. us-east4, europe-west4. Las llamadas en línea se reparten entre la región principal y estas según la cuota libre de cada una, y una región que responde 429/503 de forma sostenida se deja en pausa un minuto."
+).split(",") if region.strip()]
 selected_model_key = st.sidebar.selectbox(
     "Elige el modelo de Gemini a utilizar",
     options=list(MODEL_OPTIONS.keys()),
     help="Gemini 2.5 Pro es más potente, mientras que Flash es más rápido y económico."
 )
+max_concurrencia = st.sidebar.slider(
+    "Ítems procesados en paralelo",
+    min_value=1,
+    max_value=32,
+    value=int(os.environ.get("MAX_CONCURRENCIA", "8")),
+    help="Cuántos ítems se envían a la IA al mismo tiempo. Los 3 pasos de cada ítem siguen siendo secuenciales."
+)
+modo_generacion = st.sidebar.selectbox(
+    "Estrategia de generación",
+    options=list(MODOS_GENERACION.keys()),
+    help="'Llamada única' pide las cinco columnas en un solo JSON estructurado y, si la respuesta no valida, recurre a la cadena de 3 pasos para ese ítem."
+)
+agrupar_pasajes = st.sidebar.checkbox(
+    "Agrupar ítems que comparten el mismo texto",
+    value=False,
+    help="Los ítems con el mismo ItemContexto se analizan juntos: el pasaje se envía una sola vez en los pasos 1 y 3 y la respuesta se reparte por ítem. Usa la cadena de 3 pasos en línea."
+)
+max_por_grupo = 5
+if agrupar_pasajes:
+    max_por_grupo = st.sidebar.slider(
+        "Máximo de ítems por grupo",
+        min_value=2,
+        max_value=10,
+        value=5,
+        help="Grupos más grandes ahorran más tokens de entrada, pero la respuesta agrupada debe caber en el límite de salida del modelo."
+    )
+modo_ejecucion = st.sidebar.radio(
+    "Modo de ejecución",
+    options=list(MODOS_EJECUCION),
+    help="'Por lotes' usa Vertex AI Batch Prediction: más lento en arrancar pero más económico, ideal para bancos grandes que pueden correr durante la noche. Siempre usa la cadena de 3 pasos."
+)
+destino_lotes = ""
+if modo_ejecucion == "Por lotes":
+    destino_lotes = st.sidebar.text_input(
+        "Destino de los trabajos por lotes",
+        value=os.environ.get("BATCH_DESTINO", ""),
+        help="gs://bucket/prefijo para Vertex Batch Prediction, o una carpeta local para el backend de pruebas sin conexión."
+    )
+
+bucket_checkpoints = st.sidebar.text_input(
+    "Bucket de GCS para puntos de control (opcional)",
+    value=os.environ.get("GCS_BUCKET_CHECKPOINTS", ""),
+    help="Si lo indicas, el progreso se copia también a gs://<bucket>/checkpoints/ y sobrevive al reciclaje de la instancia."
+)
+
+bucket_fichas = st.sidebar.text_input(
+    "Bucket de GCS para el .zip de fichas (opcional)",
+    value=os.environ.get("GCS_BUCKET_FICHAS", ""),
+    help="Si lo indicas, el .zip se sube a gs://<bucket>/fichas/ mientras se genera y se descarga con un enlace firmado, sin ocupar memoria de la instancia."
+)
+
+with st.sidebar.expander("🧭 Modelo por paso"):
+    modelos_por_paso = {}
+    for paso, etiqueta in ((1, "Paso 1 · Análisis central"), (2, "Paso 2 · Qué evalúa"), (3, "Paso 3 · Recomendaciones")):
+        clave_modelo = st.selectbox(
+            etiqueta,
+            options=list(MODEL_OPTIONS.keys()),
+            index=list(MODEL_OPTIONS.keys()).index(selected_model_key),
+            key=f"modelo_paso{paso}",
+        )
+        modelos_por_paso[paso] = MODEL_OPTIONS[clave_modelo]
+    cascada_economica = st.checkbox(
+        "Cascada económica",
+        value=False,
+        help="Cada paso se intenta primero con el modelo más económico y solo se escala al siguiente (hasta el elegido para ese paso) si la respuesta no pasa la validación de formato. Solo en modo en línea; el modo por lotes usa el modelo principal."
+    )
+
+with st.sidebar.expander("📡 Respuestas en streaming"):
+    usar_streaming = st.checkbox(
+        "Recibir las respuestas por fragmentos y cortar las que se desvían del formato",
+        value=False,
+        help="Cada respuesta se revisa mientras llega: si no empieza con el título esperado, no trae su separador a tiempo o supera el largo previsto del paso, se corta y se vuelve a pedir sin esperar (ni pagar) la respuesta completa. El texto parcial se ve en el avance del trabajo. Solo en modo en línea."
+    )
+
+with st.sidebar.expander("⚡ Context caching de Vertex"):
+    usar_context_caching = st.checkbox(
+        "Cachear en Vertex los ejemplos fijos de los pasos 1 y 3",
+        value=True,
+        help="El rol, los ejemplos y las instrucciones de los pasos 1 y 3 se suben una vez como contenido cacheado y cada ítem envía solo su parte variable. Reduce la latencia y los tokens de entrada facturados. Se elimina al terminar la ejecución."
+    )
+    ttl_context_caching = st.number_input(
+        "Duración del caché (minutos)", min_value=5, max_value=24 * 60, value=60, step=5,
+        help="Se renueva automáticamente si la ejecución dura más."
+    )
+
+with st.sidebar.expander("🗄️ Caché de respuestas"):
+    usar_cache = st.checkbox(
+        "Reutilizar respuestas ya generadas",
+        value=True,
+        help="Si un prompt es idéntico a uno ya procesado (mismo modelo y configuración), se reutiliza la respuesta guardada sin volver a llamar a la IA. Desactívalo para forzar la regeneración."
+    )
+    cache_max_mb = st.number_input("Tamaño máximo (MB)", min_value=10, max_value=10_000, value=500, step=50)
+    cache_respuestas = obtener_cache_respuestas(os.path.join(DIRECTORIO_DATOS, "respuestas.sqlite"), cache_max_mb)
+    st.caption(f"Ocupado: {cache_respuestas.tamano_mb:.1f} MB")
+    if st.button("Vaciar caché"):
+        cache_respuestas.vaciar()
+        st.success("Caché vaciada.")
 
 with st.sidebar.expander("ℹ️ ¿Cómo funciona la autenticación?"):
     st.write("""
@@ -370,6 +230,16 @@ with col1:
     archivo_excel = st.file_uploader("Sube tu Excel con los datos base", type=["xlsx"])
 with col2:
     archivo_plantilla = st.file_uploader("Sube tu Plantilla de Word", type=["docx"])
+solo_columnas_usadas = st.checkbox(
+    "Leer del Excel solo las columnas que usan los prompts y la plantilla",
+    value=True,
+    help="Carga más rápido y con menos memoria los Excel grandes. Sin plantilla se leen todas las columnas."
+)
+columna_nombre_archivo = st.text_input(
+    "Escribe el nombre de la columna para nombrar los archivos (ej. ItemId)",
+    value="ItemId",
+    help="Se usa en el Paso 4 para nombrar cada ficha; se lee del Excel aunque la plantilla no la use."
+)
 
 # --- PASO 2: Enriquecimiento con IA ---    
 st.header("Paso 2: Enriquece tus Datos con IA")
@@ -392,163 +262,308 @@ with st.expander("💡 Opcional: Añadir Instrucciones Adicionales a la IA"):
         help="Guía para el diseño de las actividades de Fortalecer y Avanzar."
     )
 
+reparar = st.checkbox(
+    "🔧 Reparar un Excel ya enriquecido (regenerar solo las celdas vacías o con error)",
+    value=False,
+    help="Sube el Excel que exportó una ejecución anterior: solo se vuelven a pedir los pasos que fallaron, "
+         "usando como entrada lo que ya generaron los pasos previos. Las filas completas no se reenvían."
+)
+reanudar = st.checkbox(
+    "♻️ Reanudar la ejecución anterior de este Excel (omitir ítems ya completados)",
+    value=True,
+    help="Cada ítem terminado se guarda en un punto de control. Solo se reanuda con el mismo Excel, los mismos modelos y las mismas instrucciones; desmárcalo para empezar desde cero."
+)
+
 if st.button("🤖 Iniciar Análisis y Generación", disabled=(not project_id or not location or not archivo_excel)):
     if not project_id or not location:
         st.error("Por favor, completa la configuración de Google Cloud en la barra lateral izquierda.")
     elif not archivo_excel:
         st.warning("Por favor, sube un archivo Excel para continuar.")
+    elif modo_ejecucion == "Por lotes" and not destino_lotes:
+        st.error("Indica en la barra lateral el destino de los trabajos por lotes (gs://bucket/prefijo).")
+    elif modo_ejecucion == "Por lotes" and reparar:
+        st.error("La reparación de celdas solo está disponible en el modo de ejecución 'En línea'.")
     else:
-        model_name = MODEL_OPTIONS[selected_model_key]
-        model = setup_model(project_id, location, model_name)
-        
-        if model:
-            st.success(f"Conectado a Vertex AI en el proyecto '{project_id}' usando el modelo '{model_name}'.")
-            with st.spinner("Procesando archivo Excel y preparando datos..."):
-                df = pd.read_excel(archivo_excel)
-                for col in df.columns:
-                    if df[col].dtype == 'object':
-                        df[col] = df[col].apply(limpiar_html)
-
-                columnas_nuevas = ["Que_Evalua", "Justificacion_Correcta", "Analisis_Distractores", "Recomendacion_Fortalecer", "Recomendacion_Avanzar"]
-                for col in columnas_nuevas:
-                    if col not in df.columns:
-                        df[col] = ""
-                st.success("Datos limpios y listos.")
-
-            progress_bar_main = st.progress(0, text="Iniciando Proceso...")
-            total_filas = len(df)
-
-            for i, fila in df.iterrows():
-                item_id = fila.get('ItemId', i + 1)
-                st.markdown(f"--- \n ### Procesando Ítem: **{item_id}**")
-                progress_bar_main.progress(i / total_filas, text=f"Procesando ítem {i+1}/{total_filas}")
-
-                with st.container(border=True):
-                    try:
-                        # --- LLAMADA 1: ANÁLISIS CENTRAL ---
-                        st.write(f"**Paso 1/3:** Realizando análisis central...")
-                        # Pasa el contenido de la caja de texto a la función
-                        prompt_paso1 = construir_prompt_paso1_analisis_central(fila, instruccion_paso1) 
-                        response_paso1 = model.generate_content(prompt_paso1)
-                        analisis_central = response_paso1.text.strip()
-                        time.sleep(1) 
-
-                        header_correcta = "Ruta Cognitiva Correcta:"
-                        header_distractores = "Análisis de Opciones No Válidas:"
-                        idx_distractores = analisis_central.find(header_distractores)
-                        
-                        if idx_distractores == -1:
-                            raise ValueError("La respuesta de la IA (Paso 1) no contiene el separador 'Análisis de Opciones No Válidas'.")
-
-                        ruta_cognitiva = analisis_central[len(header_correcta):idx_distractores].strip()
-                        analisis_distractores = analisis_central[idx_distractores:].strip()
-
-                        # --- LLAMADA 2: SÍNTESIS DEL "QUÉ EVALÚA" ---
-                        st.write(f"**Paso 2/3:** Sintetizando 'Qué Evalúa'...")
-                        # Pasa el contenido de la caja de texto a la función
-                        prompt_paso2 = construir_prompt_paso2_sintesis_que_evalua(analisis_central, fila, instruccion_paso2)
-                        response_paso2 = model.generate_content(prompt_paso2)
-                        que_evalua = response_paso2.text.strip()
-                        time.sleep(1)
-                        
-                        # --- LLAMADA 3: GENERACIÓN DE RECOMENDACIONES ---
-                        st.write(f"**Paso 3/3:** Generando recomendaciones...")
-                        # Pasa el contenido de la caja de texto a la función
-                        prompt_paso3 = construir_prompt_paso3_recomendaciones(que_evalua, analisis_central, fila, instruccion_paso3)
-                        response_paso3 = model.generate_content(prompt_paso3)
-                        recomendaciones = response_paso3.text.strip()
-                        
-                        titulo_avanzar = "RECOMENDACIÓN PARA AVANZAR"
-                        idx_avanzar = recomendaciones.upper().find(titulo_avanzar)
-                        
-                        if idx_avanzar == -1:
-                             raise ValueError("La respuesta de la IA (Paso 3) no contiene el separador 'RECOMENDACIÓN PARA AVANZAR'.")
-
-                        fortalecer = recomendaciones[:idx_avanzar].strip()
-                        avanzar = recomendaciones[idx_avanzar:].strip()
-
-                        # --- GUARDAR TODO EN EL DATAFRAME ---
-                        df.loc[i, "Que_Evalua"] = que_evalua
-                        df.loc[i, "Justificacion_Correcta"] = ruta_cognitiva
-                        df.loc[i, "Analisis_Distractores"] = analisis_distractores
-                        df.loc[i, "Recomendacion_Fortalecer"] = fortalecer
-                        df.loc[i, "Recomendacion_Avanzar"] = avanzar
-                        st.success(f"Ítem {item_id} procesado con éxito.")
-
-                    except Exception as e:
-                        st.error(f"Ocurrió un error procesando la pregunta {item_id}: {e}")
-                        df.loc[i, "Que_Evalua"] = "ERROR EN PROCESAMIENTO"
-                        # Puedes agregar más detalles del error si lo necesitas
-                        df.loc[i, "Justificacion_Correcta"] = f"Error: {e}" 
-            
-            progress_bar_main.progress(1.0, text="¡Proceso completado!")
-            st.session_state.df_enriquecido = df
-            st.balloons()
+        try:
+            validar_esquema_excel(columnas_excel(BytesIO(archivo_excel.getvalue())))
+        except ErrorEsquemaExcel as e:
+            st.error(str(e))
         else:
-            st.error("No se pudo inicializar el modelo de IA. Verifica tu configuración de GCP.")
+            columnas = None
+            if solo_columnas_usadas and archivo_plantilla is not None:
+                columnas = sorted(variables_plantilla(archivo_plantilla.getvalue()) | {"ItemId", columna_nombre_archivo})
+            parametros = {
+                "project_id": project_id,
+                "location": location,
+                "regiones_adicionales": regiones_adicionales,
+                "model_name": MODEL_OPTIONS[selected_model_key],
+                "modelos_por_paso": modelos_por_paso,
+                "cascada": cascada_economica,
+                "modo_ejecucion": modo_ejecucion,
+                "destino_lotes": destino_lotes,
+                "max_concurrencia": max_concurrencia,
+                "modo_generacion": MODO_REPARACION if reparar else modo_generacion,
+                "agrupar_pasajes": agrupar_pasajes and not reparar,
+                "max_por_grupo": max_por_grupo,
+                "usar_cache": usar_cache,
+                "cache_max_mb": cache_max_mb,
+                "usar_context_caching": usar_context_caching,
+                "streaming": usar_streaming,
+                "ttl_context_caching": ttl_context_caching,
+                "bucket_checkpoints": bucket_checkpoints,
+                "instrucciones": [instruccion_paso1, instruccion_paso2, instruccion_paso3],
+                "reanudar": reanudar,
+                "columnas": columnas,
+            }
+            st.session_state.trabajo_actual = gestor_trabajos.enviar(archivo_excel.getvalue(), archivo_excel.name, parametros)
+
+def mostrar_trabajo(trabajo_id):
+    """Avance y resultado de un trabajo en segundo plano; se refresca solo mientras está activo."""
+    trabajo = gestor_trabajos.obtener(trabajo_id)
+    if trabajo is None:
+        return
+    p = trabajo["parametros"]
+    resumen = trabajo["resumen"]
+    monitor = gestor_trabajos.monitor(trabajo_id) or {}
+    procesados = trabajo["completados"] + trabajo["errores"]
+    pendientes = max(trabajo["total"] - trabajo["recuperados"], 1)
+    duracion = ((trabajo["fin"] or time.time()) - trabajo["inicio"]) if trabajo["inicio"] else 0
+    ritmo = calcular_items_por_minuto(procesados, duracion)
+    restantes = max(pendientes - procesados, 0)
+    activo = trabajo["estado"] in ESTADOS_ACTIVOS
+
+    # Todo lo que se dibuja aquí tiene tamaño fijo: contadores, percentiles, los últimos eventos
+    # y una página de fallos, sin importar cuántos ítems tenga el trabajo.
+    st.subheader(f"Trabajo {trabajo_id} · {trabajo['nombre_excel']} · {ETIQUETAS_ESTADO[trabajo['estado']]}")
+    st.progress(min(procesados / pendientes, 1.0), text=f"Procesados {procesados}/{pendientes} ítems")
+    col_ok, col_error, col_curso, col_ritmo, col_eta, col_costo = st.columns(6)
+    col_ok.metric("Completados", trabajo["completados"])
+    col_error.metric("Con error", trabajo["errores"])
+    col_curso.metric("En curso", monitor.get("en_curso", 0) if activo else 0)
+    col_ritmo.metric("Ítems/min", f"{ritmo:.1f}", help=f"{procesados} ítems en {duracion:.0f} s con {p['max_concurrencia']} en paralelo.")
+    col_eta.metric("Tiempo restante", formatear_duracion(restantes / ritmo * 60) if activo and ritmo and restantes else "—")
+    costo_usd = monitor["costo_usd"] if "costo_usd" in monitor else resumen.get("costo_usd")
+    col_costo.metric("Costo estimado", f"US$ {costo_usd:,.4f}" if costo_usd is not None else "—",
+                     help="Según los precios de lista de cada modelo (PRECIOS_MODELO); no incluye ítems recuperados.")
+    if trabajo["recuperados"]:
+        st.caption(f"{trabajo['recuperados']} ítems recuperados del punto de control.")
+    for aviso in trabajo["avisos"]:
+        st.info(aviso)
+    if trabajo["mensaje"]:
+        (st.error if trabajo["estado"] == "fallido" else st.info)(trabajo["mensaje"])
+
+    latencia_pasos = monitor.get("latencia_pasos") or resumen.get("latencia_pasos")
+    col_latencia, col_eventos = st.columns(2)
+    with col_latencia:
+        st.caption("Latencia por paso (últimos ítems)")
+        if latencia_pasos:
+            st.dataframe(pd.DataFrame([
+                {"paso": f"Paso {paso}", "p50 (s)": valores["p50_s"], "p95 (s)": valores["p95_s"], "muestras": valores["muestras"]}
+                for paso, valores in latencia_pasos.items()
+            ]).round(2), hide_index=True)
+        else:
+            st.write("—")
+    with col_eventos:
+        st.caption("Eventos recientes")
+        if monitor.get("eventos"):
+            st.dataframe(pd.DataFrame(monitor["eventos"]), hide_index=True, height=250)
+        else:
+            st.write("—")
+    if activo and monitor.get("parciales"):
+        st.caption("Respuestas llegando (final del texto recibido)")
+        st.dataframe(pd.DataFrame(monitor["parciales"]), hide_index=True, height=200)
+
+    if trabajo["errores"]:
+        with st.expander(f"❌ Ítems con error ({trabajo['errores']})"):
+            filtro = st.text_input("Filtrar por ItemId o mensaje", key=f"filtro_fallos_{trabajo_id}")
+            total_fallos, fallos = gestor_trabajos.fallos(trabajo_id, filtro, limite=MAX_FALLOS_MOSTRADOS)
+            st.dataframe(pd.DataFrame([
+                {"ItemId": f["item_id"], "error": f["error"], "hora": time.strftime("%H:%M:%S", time.localtime(f["ts"]))}
+                for f in fallos
+            ]), hide_index=True)
+            if total_fallos > len(fallos):
+                st.caption(f"Mostrando los {len(fallos)} más recientes de {total_fallos}.")
+
+    if activo:
+        if st.button("⏹️ Cancelar trabajo", key=f"cancelar_{trabajo_id}"):
+            gestor_trabajos.cancelar(trabajo_id)
+        return
+    if trabajo["estado"] in ESTADOS_REANUDABLES and st.button("▶️ Reanudar trabajo", key=f"reanudar_{trabajo_id}"):
+        gestor_trabajos.reanudar(trabajo_id)
+        st.rerun()
+
+    if "cache_aciertos" in resumen:
+        col_aciertos, col_fallos = st.columns(2)
+        col_aciertos.metric("Respuestas desde caché", resumen["cache_aciertos"])
+        col_fallos.metric("Llamadas nuevas a la IA", resumen["cache_fallos"])
+    if p["agrupar_pasajes"] and "tokens_ahorrados" in resumen:
+        st.metric("Tokens de entrada ahorrados por agrupar pasajes (estimado)", f"{resumen['tokens_ahorrados']:,.0f}")
+    if resumen.get("enrutamiento") and (p["cascada"] or set(p["modelos_por_paso"].values()) != {p["model_name"]}):
+        st.caption("Llamadas, escalamientos y latencia por paso y modelo")
+        st.dataframe(pd.DataFrame(resumen["enrutamiento"]).round(2), hide_index=True)
+    regiones = monitor.get("regiones") if activo else resumen.get("regiones")
+    if regiones:
+        st.caption("Reparto entre regiones de Vertex AI")
+        st.dataframe(pd.DataFrame(regiones).round(2), hide_index=True)
+    if resumen.get("llamadas"):
+        with st.expander("💲 Tokens, latencia y costo por paso y modelo"):
+            st.dataframe(pd.DataFrame(resumen["llamadas"]).round(4), hide_index=True)
+            histogramas = resumen.get("histograma_latencia", {})
+            for col_paso, (paso, histograma) in zip(st.columns(max(len(histogramas), 1)), histogramas.items()):
+                col_paso.caption(f"Latencia de las llamadas del paso {paso} (s)")
+                col_paso.bar_chart(pd.DataFrame({"llamadas": histograma["llamadas"]}, index=histograma["desde_s"]))
+            formato_telemetria = st.radio(
+                "Formato del registro de llamadas", options=list(FORMATOS_TELEMETRIA), horizontal=True,
+                key=f"formato_telemetria_{trabajo_id}",
+            )
+            extension_telemetria, mime_telemetria = FORMATOS_TELEMETRIA[formato_telemetria]
+            st.download_button(
+                "📥 Descargar registro de llamadas",
+                data=lambda: serializar_telemetria(gestor_trabajos.telemetria(trabajo_id), extension_telemetria),
+                file_name=f"llamadas_{trabajo_id}.{extension_telemetria}",
+                mime=mime_telemetria,
+                key=f"descargar_telemetria_{trabajo_id}",
+            )
+
+    # Al terminar (o cancelarse), los resultados pasan a los pasos 3 y 4
+    version = f"{trabajo_id}:{trabajo['fin']}"
+    if trabajo["estado"] in ("completado", "cancelado") and st.session_state.version_df != version:
+        st.session_state.df_enriquecido = gestor_trabajos.dataframe(trabajo_id)
+        st.session_state.version_df = version
+        for fila in resumen.get("uso", []):
+            st.session_state.comparativa_modos.append({"modelo": resumen["clave_modelos"], **fila})
+        if trabajo["estado"] == "completado":
+            st.balloons()
+        st.rerun()
+
+with st.expander("🗂️ Trabajos en esta instancia"):
+    trabajos = gestor_trabajos.listar()
+    if trabajos:
+        st.dataframe(pd.DataFrame([
+            {
+                "id": t["id"],
+                "excel": t["nombre_excel"],
+                "estado": ETIQUETAS_ESTADO[t["estado"]],
+                "avance": f"{t['recuperados'] + t['completados'] + t['errores']}/{t['total']}",
+                "creado": time.strftime("%Y-%m-%d %H:%M", time.localtime(t["creado"])),
+            }
+            for t in trabajos
+        ]), hide_index=True)
+        ids = [t["id"] for t in trabajos]
+        seleccion = st.selectbox(
+            "Seguir el trabajo", options=ids,
+            index=ids.index(st.session_state.trabajo_actual) if st.session_state.trabajo_actual in ids else 0,
+        )
+        if seleccion != st.session_state.trabajo_actual and st.button("Ver este trabajo"):
+            st.session_state.trabajo_actual = seleccion
+            st.rerun()
+    else:
+        st.caption("Todavía no se ha enviado ningún trabajo.")
+
+if st.session_state.trabajo_actual:
+    trabajo_actual = gestor_trabajos.obtener(st.session_state.trabajo_actual)
+    if trabajo_actual and trabajo_actual["estado"] in ESTADOS_ACTIVOS:
+        st.fragment(run_every=2)(mostrar_trabajo)(st.session_state.trabajo_actual)
+    else:
+        mostrar_trabajo(st.session_state.trabajo_actual)
+
+if st.session_state.comparativa_modos:
+    with st.expander("⏱️ Latencia y tokens por ítem según estrategia de generación", expanded=True):
+        st.caption("Cada ejecución agrega una fila por modelo y modo efectivo. Corre el mismo Excel con ambas estrategias para compararlas.")
+        st.dataframe(pd.DataFrame(st.session_state.comparativa_modos).round(2), hide_index=True)
 
 # --- PASO 3: Vista Previa y Descarga de Excel ---
 if st.session_state.df_enriquecido is not None:
     st.header("Paso 3: Verifica y Descarga los Datos Enriquecidos")
     st.dataframe(st.session_state.df_enriquecido.head())
     
-    output_excel = BytesIO()
-    with pd.ExcelWriter(output_excel, engine='openpyxl') as writer:
-        st.session_state.df_enriquecido.to_excel(writer, index=False, sheet_name='Datos Enriquecidos')
-    output_excel.seek(0)
-    
+    formato_exportacion = st.radio("Formato de descarga", options=list(FORMATOS_EXPORTACION.keys()), horizontal=True)
+    extension, mime = FORMATOS_EXPORTACION[formato_exportacion]
+    df_exportar, version_exportar = st.session_state.df_enriquecido, st.session_state.version_df
+
+    # El archivo se genera al hacer clic (y se reutiliza mientras no cambien los datos), no en cada rerun
     st.download_button(
-        label="📥 Descargar Excel Enriquecido",
-        data=output_excel,
-        file_name="excel_enriquecido_con_ia.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        label="📥 Descargar Excel Enriquecido" if extension == "xlsx" else f"📥 Descargar datos enriquecidos (.{extension})",
+        data=lambda: exportar_datos(df_exportar, version_exportar, formato_exportacion),
+        file_name=f"excel_enriquecido_con_ia.{extension}",
+        mime=mime
     )
 
 # --- PASO 4: Ensamblaje y Descarga de Fichas ---
 if st.session_state.df_enriquecido is not None and archivo_plantilla is not None:
     st.header("Paso 4: Ensambla y Descarga las Fichas Técnicas")
     
-    columna_nombre_archivo = st.text_input(
-        "Escribe el nombre de la columna para nombrar los archivos (ej. ItemId)",
-        value="ItemId"
+    procesos_fichas = st.slider(
+        "Procesos para ensamblar fichas",
+        min_value=1,
+        max_value=max(os.cpu_count() or 1, 1),
+        value=min(int(os.environ.get("MAX_PROCESOS_FICHAS", os.cpu_count() or 1)), max(os.cpu_count() or 1, 1)),
+        help="La plantilla se prepara una sola vez por proceso y las fichas se reparten entre los núcleos disponibles."
     )
-    
+    reutilizar_fichas = st.checkbox(
+        "Renderizar solo las fichas que cambiaron",
+        value=True,
+        help="Cada ficha se identifica por la plantilla y los valores de su fila. Al volver a ensamblar tras editar o reparar unas pocas filas, las demás se copian de la caché sin renderizarlas."
+    )
+
     if st.button("📄 Ensamblar Fichas Técnicas", type="primary"):
         df_final = st.session_state.df_enriquecido
         if columna_nombre_archivo not in df_final.columns:
-            st.error(f"La columna '{columna_nombre_archivo}' no existe en el Excel. Elige una de: {', '.join(df_final.columns)}")
+            st.error(
+                f"La columna '{columna_nombre_archivo}' no existe en el Excel. Elige en el Paso 1 una de: {', '.join(df_final.columns)}"
+            )
         else:
             with st.spinner("Ensamblando todas las fichas en un archivo .zip..."):
-                plantilla_bytes = BytesIO(archivo_plantilla.getvalue())
-                zip_buffer = BytesIO()
-                
-                with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-                    total_docs = len(df_final)
-                    progress_bar_zip = st.progress(0, text="Iniciando ensamblaje...")
-                    for i, fila in df_final.iterrows():
-                        plantilla_bytes.seek(0) # ¡Importante! Reinicia el buffer de la plantilla
-                        doc = DocxTemplate(plantilla_bytes)
-                        contexto = fila.to_dict()
-                        contexto_limpio = {k: (v if pd.notna(v) else "") for k, v in contexto.items()}
-                        doc.render(contexto_limpio)
-                        
-                        doc_buffer = BytesIO()
-                        doc.save(doc_buffer)
-                        doc_buffer.seek(0)
-                        
-                        nombre_base = str(fila.get(columna_nombre_archivo, f"ficha_{i+1}")).replace('/', '_').replace('\\', '_')
-                        nombre_archivo_salida = f"{nombre_base}.docx"
-                        
-                        zip_file.writestr(nombre_archivo_salida, doc_buffer.getvalue())
-                        progress_bar_zip.progress((i + 1) / total_docs, text=f"Añadiendo ficha {i+1}/{total_docs} al .zip")
-                
-                st.session_state.zip_buffer = zip_buffer
+                plantilla_bytes = archivo_plantilla.getvalue()
+                _, contextos = contextos_fichas(df_final, columna_nombre_archivo)
+
+                # Referencia: el camino anterior (docxtpl completo por ficha) sobre unas pocas filas
+                muestra = contextos[:5]
+                inicio_referencia = time.perf_counter()
+                for contexto in muestra:
+                    renderizar_ficha_docxtpl(plantilla_bytes, contexto)
+                fichas_por_segundo_serial = len(muestra) / max(time.perf_counter() - inicio_referencia, 1e-9)
+
+                cache_fichas = None
+                if reutilizar_fichas:
+                    cache_fichas = obtener_cache_fichas(os.path.join(DIRECTORIO_DATOS, "fichas.sqlite"), int(os.environ.get("CACHE_FICHAS_MAX_MB", "1024")))
+                    cache_fichas.reiniciar_contadores()
+                inicio_fichas = time.perf_counter()
+                progress_bar_zip = st.progress(0, text="Iniciando ensamblaje...")
+                with DestinoZipFichas(bucket_fichas or None) as destino:
+                    ensamblar_zip_fichas(
+                        df_final, plantilla_bytes, destino.archivo, columna_nombre_archivo, procesos_fichas,
+                        al_avanzar=lambda n, total: progress_bar_zip.progress(n / total, text=f"Añadiendo ficha {n}/{total} al .zip"),
+                        cache=cache_fichas,
+                    )
+                fichas_por_segundo = len(contextos) / max(time.perf_counter() - inicio_fichas, 1e-9)
+
+                zip_anterior = st.session_state.zip_fichas
+                if zip_anterior and zip_anterior["tipo"] == "local" and os.path.exists(zip_anterior["ruta"]):
+                    os.remove(zip_anterior["ruta"])
+                st.session_state.zip_fichas = destino.referencia
                 st.success("¡Ensamblaje completado!")
-
-if st.session_state.zip_buffer:
-    st.download_button(
-        label="📥 Descargar TODAS las fichas (.zip)",
-        data=st.session_state.zip_buffer.getvalue(),
-        file_name="fichas_tecnicas_generadas.zip",
-        mime="application/zip"
-    )
+                st.metric(
+                    "Fichas por segundo", f"{fichas_por_segundo:.1f}",
+                    delta=f"{fichas_por_segundo / fichas_por_segundo_serial:.1f}× frente a docxtpl por ficha ({fichas_por_segundo_serial:.1f}/s)",
+                    help=f"{len(contextos)} fichas con {procesos_fichas} proceso(s). La referencia se mide renderizando {len(muestra)} fichas con el camino anterior."
+                )
+                if cache_fichas is not None:
+                    st.caption(
+                        f"{cache_fichas.aciertos} ficha(s) reutilizadas de la caché y {len(contextos) - cache_fichas.aciertos} renderizadas "
+                        f"(caché: {cache_fichas.tamano_mb:.1f} MB en {cache_fichas.ruta})."
+                    )
+
+if st.session_state.zip_fichas:
+    zip_fichas = st.session_state.zip_fichas
+    if zip_fichas["tipo"] == "gcs":
+        if zip_fichas["url"]:
+            st.link_button("📥 Descargar TODAS las fichas (.zip)", zip_fichas["url"])
+        st.caption(f"El .zip quedó guardado en {zip_fichas['uri']}")
+    elif os.path.exists(zip_fichas["ruta"]):
+        st.download_button(
+            label="📥 Descargar TODAS las fichas (.zip)",
+            data=lambda: leer_archivo(zip_fichas["ruta"]),
+            file_name="fichas_tecnicas_generadas.zip",
+            mime="application/zip"
+        )
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+"""Mide el rendimiento del pipeline completo sin gastar cuota de Vertex AI.
+
+Sustituye `GenerativeModel.generate_content` por un modelo simulado con latencia configurable,
+errores 429/5xx inyectados, respuestas desbocadas opcionales y respuestas que pasan los validadores
+de cada paso (también en streaming). Sobre Excel
+sintéticos de varios tamaños ejecuta el enriquecimiento y el ensamblaje de fichas, y guarda
+ítems/min, fichas/s, memoria pico y tiempo por etapa para comparar con ejecuciones anteriores.
+Al final edita una parte de las filas y vuelve a ensamblar las fichas con la caché, como tras una revisión.
+
+    python benchmark.py --tamanos 100,1000,10000 --latencia lognormal --latencia-ms 800 \
+        --concurrencia 32 --tasa-429 0.02 --tasa-5xx 0.005
+
+Cada tamaño corre en un proceso aparte para que la memoria pico de uno no contamine al otro.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from io import BytesIO
+
+import pandas as pd
+from docx import Document
+from google.api_core import exceptions as google_exceptions
+
+from fichas import CacheFichas, ensamblar_zip_fichas, variables_plantilla
+from motor import (
+    COLUMNAS_NUEVAS, DIRECTORIO_DATOS, FORMATOS_EXPORTACION, GENERATION_CONFIG, MARCA_ITEM_GRUPO, MODEL_OPTIONS, MODOS_GENERACION,
+    LimitadorAdaptativo, Streaming, calcular_items_por_minuto, ejecutar_enriquecimiento, estimar_tokens, leer_excel,
+    serializar_datos,
+)
+
+try:
+    import resource
+except ImportError:  # Windows: sin medición de memoria pico
+    resource = None
+
+RUTA_RESULTADOS = os.path.join(DIRECTORIO_DATOS, "benchmarks", "resultados.jsonl")
+DISTRIBUCIONES_LATENCIA = ("fija", "uniforme", "lognormal")
+
+# --- MODELO SIMULADO ---
+
+RESPUESTA_PASO1 = (
+    "Ruta Cognitiva Correcta:\n"
+    "Para resolver el ítem, el estudiante debe identificar la idea central del fragmento, relacionar la información "
+    "explícita con la pregunta planteada, descartar las interpretaciones que no se sustentan en el texto y contrastar "
+    "cada opción con la evidencia disponible. Finalmente, selecciona la opción que recoge la relación correcta entre "
+    "las ideas, lo que justifica la elección de la respuesta correcta.\n\n"
+    "Análisis de Opciones No Válidas:\n"
+    "- **Opción A:** El estudiante podría escoger esta opción si comete un error de generalización, lo que lo lleva a "
+    "pensar que un detalle resume todo el texto. Sin embargo, esto es incorrecto porque el detalle es secundario.\n"
+    "- **Opción C:** El estudiante podría escoger esta opción si confunde causa y efecto. Sin embargo, esto es "
+    "incorrecto porque el texto presenta la relación en sentido contrario.\n"
+    "- **Opción D:** El estudiante podría escoger esta opción si se apoya en conocimientos previos ajenos al texto. "
+    "Sin embargo, esto es incorrecto porque la tarea exige basarse en el fragmento."
+)
+RESPUESTA_PASO2 = "Este ítem evalúa la capacidad del estudiante para relacionar la información explícita de un texto con su idea central."
+RESPUESTA_PASO3 = (
+    "RECOMENDACIÓN PARA FORTALECER EL APRENDIZAJE EVALUADO EN la pregunta\n"
+    "Para fortalecer la habilidad de identificar la idea central, se sugiere un andamiaje con preguntas graduales.\n"
+    "Una actividad que se puede hacer es: \"Detectives del titular\", en la que los grupos proponen oralmente el "
+    "titular que mejor resume una noticia leída en voz alta y defienden su elección frente a los demás.\n"
+    "Las preguntas orientadoras para esta actividad, entre otras, pueden ser:\n"
+    "- ¿Qué información se repite a lo largo del texto?\n"
+    "- ¿Qué detalle podría eliminarse sin cambiar el sentido?\n"
+    "- ¿Qué titular dejaría por fuera una idea importante?\n\n"
+    "RECOMENDACIÓN PARA AVANZAR EN EL APRENDIZAJE EVALUADO EN la pregunta\n"
+    "Para avanzar desde la identificación de la idea central hacia la evaluación de la postura del autor, se sugiere "
+    "comparar textos con enfoques distintos.\n"
+    "Una actividad que se puede hacer es: \"El tribunal de las versiones\", donde dos equipos leen relatos opuestos "
+    "de un mismo hecho y un jurado decide cuál está mejor sustentado.\n"
+    "Las preguntas orientadoras para esta actividad, entre otras, pueden ser:\n"
+    "- ¿Qué evidencia usa cada versión?\n"
+    "- ¿Qué omite cada autor y por qué?\n"
+    "- ¿Qué versión resulta más confiable?"
+)
+RESPUESTA_UNICA = json.dumps({
+    "Que_Evalua": RESPUESTA_PASO2,
+    "Justificacion_Correcta": RESPUESTA_PASO1.split("\n\nAnálisis de Opciones No Válidas:")[0],
+    "Analisis_Distractores": RESPUESTA_PASO1[RESPUESTA_PASO1.find("Análisis de Opciones No Válidas:"):],
+    "Recomendacion_Fortalecer": RESPUESTA_PASO3.split("\n\nRECOMENDACIÓN PARA AVANZAR")[0],
+    "Recomendacion_Avanzar": RESPUESTA_PASO3[RESPUESTA_PASO3.find("RECOMENDACIÓN PARA AVANZAR"):],
+}, ensure_ascii=False)
+
+PATRON_ITEMS_GRUPO = re.compile(r"\((\d+) ítems")
+# Una respuesta desbocada repite el texto hasta agotar max_output_tokens (unos 4 caracteres por token)
+CARACTERES_DESBOCADA = GENERATION_CONFIG["max_output_tokens"] * 4
+TAMANO_FRAGMENTO = 200
+
+def muestreador_latencia(distribucion, media_s, dispersion=0.5):
+    """Retorna una función sin argumentos que da la latencia simulada de una llamada, en segundos.
+
+    'fija' siempre da `media_s`; 'uniforme' varía ±`dispersion`·media; 'lognormal' tiene mediana
+    `media_s` y sigma `dispersion` (cola larga, como las latencias reales de un LLM).
+    """
+    if distribucion == "fija":
+        return lambda: media_s
+    if distribucion == "uniforme":
+        return lambda: random.uniform(media_s * (1 - dispersion), media_s * (1 + dispersion))
+    if distribucion == "lognormal":
+        return lambda: random.lognormvariate(0, dispersion) * media_s
+    raise ValueError(f"Distribución de latencia desconocida: {distribucion}")
+
+class ModeloSimulado:
+    """Reemplazo local de GenerativeModel: misma interfaz `generate_content`, sin llamadas a Vertex AI.
+
+    Reconoce el paso por el prompt y responde con textos fijos que pasan los validadores (también
+    los prompts agrupados y la llamada única en JSON). Con probabilidad `tasa_429` / `tasa_5xx`
+    lanza TooManyRequests / ServiceUnavailable, como haría la API, y con `tasa_desbocada` la
+    respuesta se repite hasta CARACTERES_DESBOCADA (y tarda en proporción a su largo). Con
+    `stream=True` entrega la respuesta en fragmentos repartidos a lo largo de la latencia.
+    """
+
+    def __init__(self, model_name="gemini-2.5-flash", latencia=None, tasa_429=0.0, tasa_5xx=0.0, semilla=None, tasa_desbocada=0.0):
+        self._model_name = f"publishers/google/models/{model_name}"
+        self.latencia = latencia or muestreador_latencia("fija", 0.0)
+        self.tasa_429 = tasa_429
+        self.tasa_5xx = tasa_5xx
+        self.tasa_desbocada = tasa_desbocada
+        self._random = random.Random(semilla)
+        self._lock = threading.Lock()
+        self.llamadas = 0
+        self.errores_inyectados = 0
+
+    def _respuesta(self, prompt, generation_config):
+        if generation_config is not None and "application/json" in str(generation_config.to_dict()):
+            return RESPUESTA_UNICA
+        if "RECOMENDACIÓN PARA AVANZAR" in prompt:
+            texto = RESPUESTA_PASO3
+        elif "FASE 1: RUTA COGNITIVA" in prompt:
+            texto = RESPUESTA_PASO1
+        else:
+            return RESPUESTA_PASO2
+        grupo = PATRON_ITEMS_GRUPO.search(prompt)
+        if grupo:
+            return "\n\n".join(f"{MARCA_ITEM_GRUPO.format(n=n)}\n{texto}" for n in range(1, int(grupo.group(1)) + 1))
+        return texto
+
+    def generate_content(self, prompt, generation_config=None, stream=False, **kwargs):
+        with self._lock:
+            self.llamadas += 1
+            sorteo = self._random.random()
+            desbocada = self._random.random() < self.tasa_desbocada
+        latencia = self.latencia()
+        if sorteo < self.tasa_429 + self.tasa_5xx:
+            time.sleep(latencia)
+            with self._lock:
+                self.errores_inyectados += 1
+            if sorteo < self.tasa_429:
+                raise google_exceptions.TooManyRequests("Cuota agotada (simulado)")
+            raise google_exceptions.ServiceUnavailable("Servicio no disponible (simulado)")
+        texto = self._respuesta(prompt, generation_config)
+        factor = max(CARACTERES_DESBOCADA // len(texto), 1) if desbocada else 1
+        texto = "\n".join([texto] * factor)
+        if stream:
+            return self._fragmentos(prompt, texto, latencia * factor / len(texto))
+        time.sleep(latencia * factor)
+        return self._con_uso(prompt, texto)
+
+    def _fragmentos(self, prompt, texto, segundos_por_caracter):
+        for inicio in range(0, len(texto), TAMANO_FRAGMENTO):
+            parte = texto[inicio:inicio + TAMANO_FRAGMENTO]
+            time.sleep(len(parte) * segundos_por_caracter)
+            yield types.SimpleNamespace(text=parte, usage_metadata=None)
+        # Como en Vertex, el uso de tokens llega con el último fragmento
+        yield self._con_uso(prompt, texto, texto_fragmento="")
+
+    def _con_uso(self, prompt, texto, texto_fragmento=None):
+        return types.SimpleNamespace(
+            text=texto if texto_fragmento is None else texto_fragmento,
+            usage_metadata=types.SimpleNamespace(
+                prompt_token_count=estimar_tokens(prompt),
+                candidates_token_count=estimar_tokens(texto),
+                cached_content_token_count=0,
+                total_token_count=estimar_tokens(prompt) + estimar_tokens(texto),
+            ),
+        )
+
+# --- DATOS Y PLANTILLA SINTÉTICOS ---
+
+def generar_excel_sintetico(n_items, ruta, items_por_pasaje=4, semilla=0):
+    """Escribe un banco de `n_items` ítems con las columnas que usan los prompts; cada pasaje lo comparten `items_por_pasaje` ítems."""
+    aleatorio = random.Random(semilla)
+    competencias = ["Comprensión literal", "Comprensión inferencial", "Lectura crítica"]
+    filas = []
+    for i in range(n_items):
+        pasaje = i // max(items_por_pasaje, 1)
+        filas.append({
+            "ItemId": f"SIN{i + 1:06d}",
+            "ItemContexto": f"<p>Pasaje {pasaje}: " + " ".join(["Texto &amp; contexto de lectura."] * 40) + "</p>",
+            "ItemEnunciado": f"<p>¿Cuál es la idea principal del pasaje {pasaje} (pregunta {i + 1})?</p>",
+            "ComponenteNombre": "Lectura",
+            "CompetenciaNombre": aleatorio.choice(competencias),
+            "AfirmacionNombre": "Identifica información local del texto.",
+            "EvidenciaNombre": "Reconoce la idea central de un texto.",
+            "Tipologia Textual": "Continuo",
+            "ItemGradoId": aleatorio.choice([3, 5, 7, 9, 11]),
+            "AlternativaClave": aleatorio.choice("ABCD"),
+            "OpcionA": "Primera opción", "OpcionB": "Segunda opción", "OpcionC": "Tercera opción", "OpcionD": "Cuarta opción",
+        })
+    pd.DataFrame(filas).to_excel(ruta, index=False)
+
+def plantilla_sintetica():
+    """Plantilla .docx mínima con un campo Jinja por columna que suele llevar una ficha."""
+    documento = Document()
+    documento.add_heading("Ficha técnica {{ ItemId }}", level=1)
+    documento.add_paragraph("Competencia: {{ CompetenciaNombre }} · Grado {{ ItemGradoId }}")
+    for columna in COLUMNAS_NUEVAS:
+        documento.add_heading(columna.replace("_", " "), level=2)
+        documento.add_paragraph(f"{{{{ {columna} }}}}")
+    salida = BytesIO()
+    documento.save(salida)
+    return salida.getvalue()
+
+# --- MEDICIÓN ---
+
+def memoria_pico_mb():
+    """Memoria residente pico de este proceso y de sus hijos ya terminados (procesos de fichas), en MB."""
+    if resource is None:
+        return None
+    # ru_maxrss viene en KB en Linux y en bytes en macOS
+    escala = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(
+        (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / escala, 1
+    )
+
+def medir_tamano(n_items, args):
+    """Corre el pipeline completo sobre un Excel sintético de `n_items` ítems y retorna sus métricas."""
+    etapas = {}
+    with tempfile.TemporaryDirectory() as directorio:
+        ruta_excel = os.path.join(directorio, "banco.xlsx")
+        inicio = time.perf_counter()
+        generar_excel_sintetico(n_items, ruta_excel, args.items_por_pasaje)
+        etapas["generar_excel_s"] = time.perf_counter() - inicio
+
+        plantilla_bytes = plantilla_sintetica()
+        if args.plantilla:
+            with open(args.plantilla, "rb") as f:
+                plantilla_bytes = f.read()
+        inicio = time.perf_counter()
+        df = leer_excel(ruta_excel, variables_plantilla(plantilla_bytes) | {"ItemId"})
+        etapas["lectura_s"] = time.perf_counter() - inicio
+
+        modelo = ModeloSimulado(
+            args.modelo, muestreador_latencia(args.latencia, args.latencia_ms / 1000, args.dispersion),
+            args.tasa_429, args.tasa_5xx, semilla=n_items, tasa_desbocada=args.tasa_desbocada,
+        )
+        limitador = LimitadorAdaptativo(args.rpm, args.tpm) if args.rpm else None
+        cortadas = []
+        streaming = Streaming(al_abortar=lambda indices, paso, motivo: cortadas.append(paso)) if args.streaming else None
+        errores = 0
+        inicio = time.perf_counter()
+        resultados = ejecutar_enriquecimiento(
+            modelo, args.modelo, df, df, max_concurrencia=args.concurrencia, limitador=limitador, modo=args.estrategia,
+            agrupar_pasajes=args.agrupar_pasajes, max_por_grupo=args.max_por_grupo, streaming=streaming,
+        )
+        tokens_salida = 0
+        for _, _, error, uso in resultados:
+            errores += error is not None
+            tokens_salida += (uso or {}).get("tokens_salida", 0)
+        etapas["enriquecimiento_s"] = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        with open(os.path.join(directorio, "enriquecido.xlsx"), "wb") as f:
+            serializar_datos(df, next(iter(FORMATOS_EXPORTACION)), f)
+        etapas["exportacion_s"] = time.perf_counter() - inicio
+
+        cache_fichas = CacheFichas(os.path.join(directorio, "fichas.sqlite"))
+        inicio = time.perf_counter()
+        with open(os.path.join(directorio, "fichas.zip"), "wb") as f:
+            total_fichas = ensamblar_zip_fichas(df, plantilla_bytes, f, max_procesos=args.procesos_fichas, cache=cache_fichas)
+        etapas["fichas_s"] = time.perf_counter() - inicio
+
+        editadas = random.Random(n_items).sample(list(df.index), max(1, round(len(df) * args.fraccion_editada)))
+        df.loc[editadas, COLUMNAS_NUEVAS[-1]] = df.loc[editadas, COLUMNAS_NUEVAS[-1]] + " (revisado)"
+        cache_fichas.reiniciar_contadores()
+        inicio = time.perf_counter()
+        with open(os.path.join(directorio, "fichas_revisadas.zip"), "wb") as f:
+            ensamblar_zip_fichas(df, plantilla_bytes, f, max_procesos=args.procesos_fichas, cache=cache_fichas)
+        etapas["fichas_incremental_s"] = time.perf_counter() - inicio
+        fichas_reutilizadas = cache_fichas.aciertos
+
+    return {
+        "items": n_items,
+        "errores": errores,
+        "llamadas": modelo.llamadas,
+        "errores_inyectados": modelo.errores_inyectados,
+        "respuestas_cortadas": len(cortadas),
+        "tokens_salida": round(tokens_salida),
+        "items_por_minuto": round(calcular_items_por_minuto(n_items, etapas["enriquecimiento_s"]), 1),
+        "fichas_por_segundo": round(total_fichas / etapas["fichas_s"], 1) if etapas["fichas_s"] else None,
+        "fichas_editadas": len(editadas),
+        "fichas_reutilizadas": fichas_reutilizadas,
+        "memoria_pico_mb": memoria_pico_mb(),
+        **{etapa: round(segundos, 3) for etapa, segundos in etapas.items()},
+    }
+
+# --- RESULTADOS ---
+
+def configuracion(args):
+    """Parámetros que definen una ejecución comparable (sin los tamaños)."""
+    return {
+        "modelo": args.modelo, "estrategia": args.estrategia, "agrupar_pasajes": args.agrupar_pasajes,
+        "max_por_grupo": args.max_por_grupo, "items_por_pasaje": args.items_por_pasaje, "concurrencia": args.concurrencia,
+        "latencia": args.latencia, "latencia_ms": args.latencia_ms, "dispersion": args.dispersion,
+        "tasa_429": args.tasa_429, "tasa_5xx": args.tasa_5xx, "tasa_desbocada": args.tasa_desbocada,
+        "streaming": args.streaming, "rpm": args.rpm, "tpm": args.tpm,
+        "procesos_fichas": args.procesos_fichas, "fraccion_editada": args.fraccion_editada, "plantilla": os.path.basename(args.plantilla) if args.plantilla else None,
+    }
+
+def version_codigo():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def cargar_resultados(ruta):
+    if not os.path.exists(ruta):
+        return []
+    with open(ruta, encoding="utf-8") as f:
+        return [json.loads(linea) for linea in f if linea.strip()]
+
+def guardar_resultado(ruta, resultado):
+    os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+    with open(ruta, "a", encoding="utf-8") as f:
+        f.write(json.dumps(resultado, ensure_ascii=False) + "\n")
+
+def comparar_con_anterior(resultado, anteriores):
+    """Tabla de la ejecución contra la última anterior con la misma configuración y tamaño."""
+    previas = [r for r in anteriores if r["configuracion"] == resultado["configuracion"] and r["items"] == resultado["items"]]
+    if not previas:
+        return None
+    previa = previas[-1]
+    filas = []
+    for metrica in ("items_por_minuto", "fichas_por_segundo", "memoria_pico_mb", "tokens_salida", "lectura_s",
+                    "enriquecimiento_s", "exportacion_s", "fichas_s", "fichas_incremental_s"):
+        antes, ahora = previa.get(metrica), resultado.get(metrica)
+        cambio = f"{(ahora - antes) / antes:+.1%}" if antes and ahora is not None else "—"
+        filas.append({"métrica": metrica, "anterior": antes, "actual": ahora, "cambio": cambio})
+    return previa, pd.DataFrame(filas)
+
+# --- LÍNEA DE COMANDOS ---
+
+def construir_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tamanos", default="100,1000,10000", help="Cantidades de ítems separadas por comas")
+    parser.add_argument("--modelo", default=MODEL_OPTIONS["Gemini 2.5 Flash"], choices=list(MODEL_OPTIONS.values()),
+                        help="Modelo que se simula (solo cambia el costo estimado)")
+    parser.add_argument("--estrategia", default="3 pasos", choices=list(MODOS_GENERACION.keys()))
+    parser.add_argument("--agrupar-pasajes", action="store_true")
+    parser.add_argument("--max-por-grupo", type=int, default=5)
+    parser.add_argument("--items-por-pasaje", type=int, default=4, help="Ítems que comparten cada pasaje en el Excel sintético")
+    parser.add_argument("--concurrencia", type=int, default=16)
+    parser.add_argument("--latencia", default="lognormal", choices=DISTRIBUCIONES_LATENCIA)
+    parser.add_argument("--latencia-ms", type=float, default=50.0, help="Latencia media (mediana en lognormal) por llamada")
+    parser.add_argument("--dispersion", type=float, default=0.5, help="Sigma de la lognormal o ±fracción de la uniforme")
+    parser.add_argument("--tasa-429", type=float, default=0.0, help="Fracción de llamadas que responden 429")
+    parser.add_argument("--tasa-5xx", type=float, default=0.0, help="Fracción de llamadas que responden 503")
+    parser.add_argument("--tasa-desbocada", type=float, default=0.0,
+                        help="Fracción de respuestas que se alargan hasta max_output_tokens (para medir el corte en streaming)")
+    parser.add_argument("--streaming", action="store_true", help="Leer las respuestas por fragmentos y cortar las que se desvían")
+    parser.add_argument("--rpm", type=int, default=0, help="Simular el limitador con estas peticiones/min (0: sin limitador)")
+    parser.add_argument("--tpm", type=int, default=10_000_000)
+    parser.add_argument("--procesos-fichas", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--fraccion-editada", type=float, default=0.01,
+                        help="Fracción de filas que se editan antes de volver a ensamblar las fichas con la caché")
+    parser.add_argument("--plantilla", help="Plantilla .docx real (por defecto, una sintética)")
+    parser.add_argument("--resultados", default=RUTA_RESULTADOS, help="Archivo JSONL donde se acumulan los resultados")
+    parser.add_argument("--etiqueta", default="", help="Nota libre para identificar la ejecución")
+    parser.add_argument("--solo-tamano", type=int, help=argparse.SUPPRESS)
+    return parser
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = construir_parser().parse_args(argv)
+    if args.solo_tamano:
+        # Proceso hijo: mide un tamaño y entrega el resultado como JSON en la última línea
+        print(json.dumps(medir_tamano(args.solo_tamano, args)))
+        return 0
+
+    anteriores = cargar_resultados(args.resultados)
+    comun = {"fecha": time.strftime("%Y-%m-%d %H:%M:%S"), "version": version_codigo(), "etiqueta": args.etiqueta,
+             "configuracion": configuracion(args)}
+    for n_items in (int(n) for n in args.tamanos.split(",") if n.strip()):
+        print(f"Midiendo {n_items} ítems...", file=sys.stderr, flush=True)
+        proceso = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *argv, "--solo-tamano", str(n_items)],
+            capture_output=True, text=True,
+        )
+        if proceso.returncode != 0:
+            print(proceso.stderr, file=sys.stderr)
+            return proceso.returncode
+        resultado = {**comun, **json.loads(proceso.stdout.strip().splitlines()[-1])}
+        guardar_resultado(args.resultados, resultado)
+        print(pd.Series({k: v for k, v in resultado.items() if k != "configuracion"}).to_string())
+        comparacion = comparar_con_anterior(resultado, anteriores)
+        if comparacion:
+            previa, tabla = comparacion
+            print(f"\nFrente a la ejecución del {previa['fecha']} ({previa.get('version') or 'sin versión'}):")
+            print(tabla.to_string(index=False))
+        print()
+    print(f"Resultados guardados en {args.resultados}", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""Procesa un banco de ítems sin interfaz: enriquece el Excel con Vertex AI y ensambla las fichas.
+
+Pensado para Cloud Run Jobs o tareas programadas. Ejemplo:
+
+    python cli.py banco.xlsx --plantilla plantilla.docx --modelo gemini-2.5-flash \
+        --concurrencia 16 --salida resultados/
+
+Usa el mismo motor que la app de Streamlit, incluidos el punto de control (una ejecución
+interrumpida se reanuda al relanzar el mismo comando) y la caché de respuestas.
+"""
+
+import argparse
+import os
+import sys
+import time
+from contextlib import nullcontext
+
+import pandas as pd
+
+from fichas import CacheFichas, ensamblar_zip_fichas, variables_plantilla
+from motor import (
+    DIRECTORIO_DATOS, FORMATOS_EXPORTACION, FORMATOS_TELEMETRIA, MODEL_OPTIONS, MODO_REPARACION, MODOS_EJECUCION,
+    MODOS_GENERACION, REGIONES_ADICIONALES, CacheRespuestas, ContextoFewShotCacheado, ErrorEsquemaExcel, DestinoZipFichas, LimitadorAdaptativo, Streaming,
+    abrir_punto_control, calcular_items_por_minuto, inicializar_vertex, clave_modelos, crear_enrutador, ejecutar_enriquecimiento,
+    filas_a_reparar, leer_excel, registros_llamadas, restaurar_punto_control, resumir_llamadas, serializar_datos, serializar_telemetria,
+    setup_model,
+)
+
+FORMATOS_POR_EXTENSION = {extension: formato for formato, (extension, _) in FORMATOS_EXPORTACION.items()}
+
+def informar(mensaje):
+    print(f"[{time.strftime('%H:%M:%S')}] {mensaje}", file=sys.stderr, flush=True)
+
+def construir_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("excel", help="Excel con el banco de ítems")
+    parser.add_argument("--plantilla", help="Plantilla .docx de la ficha; sin ella solo se enriquece el Excel")
+    parser.add_argument("--salida", default="salida", help="Carpeta donde se escriben los resultados (por defecto: salida)")
+    parser.add_argument("--proyecto", default=os.environ.get("GCP_PROJECT_ID"), help="ID del proyecto de GCP (o GCP_PROJECT_ID)")
+    parser.add_argument("--region", default=os.environ.get("GCP_LOCATION", "us-central1"), help="Región de Vertex AI (o GCP_LOCATION)")
+    parser.add_argument("--regiones", default=",".join(REGIONES_ADICIONALES),
+                        help="Regiones adicionales separadas por comas (o GCP_REGIONES): las llamadas en línea se reparten entre ellas y --region")
+    parser.add_argument("--modelo", default=MODEL_OPTIONS["Gemini 2.5 Pro"], choices=list(MODEL_OPTIONS.values()))
+    for paso in (1, 2, 3):
+        parser.add_argument(f"--modelo-paso{paso}", choices=list(MODEL_OPTIONS.values()), help=f"Modelo del paso {paso} (por defecto, --modelo)")
+    parser.add_argument("--cascada", action="store_true", help="Intentar cada paso primero con el modelo más económico")
+    parser.add_argument("--concurrencia", type=int, default=int(os.environ.get("MAX_CONCURRENCIA", "8")), help="Ítems procesados en paralelo")
+    parser.add_argument("--estrategia", default="3 pasos", choices=list(MODOS_GENERACION.keys()), help="Estrategia de generación")
+    parser.add_argument("--reparar", action="store_true",
+                        help="Recibir un Excel ya enriquecido y regenerar solo los pasos de las celdas vacías o con error")
+    parser.add_argument("--agrupar-pasajes", action="store_true", help="Analizar juntos los ítems que comparten el mismo texto")
+    parser.add_argument("--max-por-grupo", type=int, default=5)
+    parser.add_argument("--lotes", metavar="DESTINO", default=os.environ.get("BATCH_DESTINO"),
+                        help="Usar Vertex Batch Prediction con este destino (gs://bucket/prefijo o carpeta local)")
+    parser.add_argument("--instruccion-paso1", default="")
+    parser.add_argument("--instruccion-paso2", default="")
+    parser.add_argument("--instruccion-paso3", default="")
+    parser.add_argument("--desde-cero", action="store_true", help="Ignorar el punto de control de una ejecución anterior")
+    parser.add_argument("--bucket-checkpoints", default=os.environ.get("GCS_BUCKET_CHECKPOINTS"))
+    parser.add_argument("--sin-cache", action="store_true", help="No reutilizar respuestas guardadas")
+    parser.add_argument("--cache-max-mb", type=int, default=500)
+    parser.add_argument("--sin-context-caching", action="store_true", help="Enviar siempre los prompts completos")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Leer las respuestas por fragmentos y cortar y volver a pedir las que se desvían del formato")
+    parser.add_argument("--telemetria", default="jsonl", choices=[ext for ext, _ in FORMATOS_TELEMETRIA.values()],
+                        help="Formato del registro de llamadas (tokens, latencia, reintentos y costo por llamada)")
+    parser.add_argument("--todas-las-columnas", action="store_true",
+                        help="Leer todas las columnas del Excel (por defecto, con --plantilla solo las que usan los prompts y la plantilla)")
+    parser.add_argument("--formato", default="xlsx", choices=list(FORMATOS_POR_EXTENSION), help="Formato del archivo enriquecido")
+    parser.add_argument("--columna-nombre", default="ItemId", help="Columna con la que se nombran las fichas")
+    parser.add_argument("--procesos-fichas", type=int, default=int(os.environ.get("MAX_PROCESOS_FICHAS", os.cpu_count() or 1)))
+    parser.add_argument("--sin-cache-fichas", action="store_true",
+                        help="Renderizar todas las fichas aunque no hayan cambiado (la caché está en $DIRECTORIO_DATOS/fichas.sqlite, por defecto .datos/)")
+    parser.add_argument("--cache-fichas-max-mb", type=int, default=1024)
+    parser.add_argument("--bucket-fichas", default=os.environ.get("GCS_BUCKET_FICHAS"), help="Subir el .zip de fichas a este bucket")
+    return parser
+
+def main(argv=None):
+    args = construir_parser().parse_args(argv)
+    if not args.proyecto:
+        informar("Indica el proyecto de GCP con --proyecto o GCP_PROJECT_ID.")
+        return 2
+    modo_ejecucion = MODOS_EJECUCION[1] if args.lotes else MODOS_EJECUCION[0]
+    if args.reparar and args.lotes:
+        informar("--reparar solo está disponible en el modo En línea (sin --lotes).")
+        return 2
+    estrategia = MODO_REPARACION if args.reparar else args.estrategia
+
+    inicializar_vertex(args.proyecto, args.region)
+    model = setup_model(args.proyecto, args.region, args.modelo)
+    enrutador = None
+    regiones = [region.strip() for region in args.regiones.split(",") if region.strip()]
+    if modo_ejecucion == "En línea":
+        modelos_por_paso = {paso: getattr(args, f"modelo_paso{paso}") or args.modelo for paso in (1, 2, 3)}
+        enrutador = crear_enrutador(args.proyecto, args.region, modelos_por_paso, args.cascada, regiones_adicionales=regiones)
+
+    plantilla_bytes = None
+    if args.plantilla:
+        with open(args.plantilla, "rb") as f:
+            plantilla_bytes = f.read()
+    columnas = None
+    if plantilla_bytes and not args.todas_las_columnas:
+        columnas = variables_plantilla(plantilla_bytes) | {args.columna_nombre}
+    try:
+        df = leer_excel(args.excel, columnas)
+    except ErrorEsquemaExcel as e:
+        informar(str(e))
+        return 2
+    with open(args.excel, "rb") as f:
+        contenido_excel = f.read()
+    instrucciones = (args.instruccion_paso1, args.instruccion_paso2, args.instruccion_paso3)
+    punto_control = abrir_punto_control(contenido_excel, clave_modelos(args.modelo, enrutador), args.bucket_checkpoints, instrucciones)
+    ya_completados = restaurar_punto_control(df, punto_control, reanudar=not args.desde_cero)
+    df_pendiente = df.drop(index=ya_completados)
+    if args.reparar:
+        df_pendiente = df_pendiente.loc[filas_a_reparar(df_pendiente)]
+        informar(f"{len(df)} ítems en el Excel: {len(df_pendiente)} con celdas vacías o con error.")
+    else:
+        informar(f"{len(df)} ítems en el Excel: {len(ya_completados)} recuperados del punto de control, {len(df_pendiente)} pendientes.")
+
+    cache = None
+    if not args.sin_cache:
+        cache = CacheRespuestas(os.path.join(DIRECTORIO_DATOS, "respuestas.sqlite"), max_bytes=args.cache_max_mb * 1024 * 1024)
+    usar_contexto_cacheado = not args.sin_context_caching and modo_ejecucion == "En línea"
+    modelos_contexto = enrutador.nombres_por_paso() if enrutador else args.modelo
+
+    streaming = None
+    if args.streaming and modo_ejecucion == "En línea":
+        streaming = Streaming(al_abortar=lambda indices, paso, motivo: informar(
+            f"Ítem {', '.join(str(df.loc[i].get('ItemId', i + 1)) for i in indices)}: {motivo} Se vuelve a pedir."
+        ))
+
+    completados = errores = 0
+    usos = []
+    inicio = time.monotonic()
+    with (ContextoFewShotCacheado(modelos_contexto, args.proyecto, [args.region, *regiones]) if usar_contexto_cacheado else nullcontext()) as contexto_fewshot:
+        for (paso, nombre), motivo in (contexto_fewshot.errores.items() if contexto_fewshot else ()):
+            informar(f"No se pudo cachear el prefijo del paso {paso} ({nombre}); se enviará completo. Motivo: {motivo}")
+        resultados = ejecutar_enriquecimiento(
+            enrutador or model, args.modelo, df, df_pendiente, instrucciones, punto_control,
+            modo_ejecucion, args.lotes, args.concurrencia, LimitadorAdaptativo.para_modelo(args.modelo), cache, estrategia,
+            agrupar_pasajes=args.agrupar_pasajes, max_por_grupo=args.max_por_grupo, contexto_fewshot=contexto_fewshot,
+            al_iniciar_ola=lambda paso, n: informar(f"Ola {paso}/3: {n} solicitudes enviadas al trabajo por lotes."),
+            streaming=streaming,
+        )
+        for i, _, error, uso in resultados:
+            completados += 1
+            item_id = df.loc[i].get('ItemId', i + 1)
+            if uso:
+                usos.append((item_id, uso))
+            if error is not None:
+                errores += 1
+                informar(f"Error en el ítem {item_id}: {error}")
+            ritmo = calcular_items_por_minuto(completados, time.monotonic() - inicio)
+            informar(f"{completados}/{len(df_pendiente)} ítems · {ritmo:.1f} ítems/min")
+
+    if enrutador and enrutador.estadisticas_regiones():
+        informar("Reparto entre regiones:\n" + pd.DataFrame(enrutador.estadisticas_regiones()).round(2).to_string(index=False))
+
+    os.makedirs(args.salida, exist_ok=True)
+    ruta_datos = os.path.join(args.salida, f"excel_enriquecido_con_ia.{args.formato}")
+    with open(ruta_datos, "wb") as f:
+        serializar_datos(df, FORMATOS_POR_EXTENSION[args.formato], f)
+    informar(f"Datos enriquecidos en {ruta_datos}")
+
+    registros = registros_llamadas(usos)
+    if registros:
+        ruta_telemetria = os.path.join(args.salida, f"llamadas.{args.telemetria}")
+        with open(ruta_telemetria, "wb") as f:
+            f.write(serializar_telemetria(registros, args.telemetria))
+        resumen = resumir_llamadas(registros)
+        informar("Consumo por paso y modelo:\n" + resumen.round(4).to_string(index=False))
+        informar(f"Costo estimado: US$ {resumen['costo_usd'].sum():,.4f}. Registro de llamadas en {ruta_telemetria}")
+
+    if plantilla_bytes:
+        cache_fichas = None
+        if not args.sin_cache_fichas:
+            cache_fichas = CacheFichas(os.path.join(DIRECTORIO_DATOS, "fichas.sqlite"), max_bytes=args.cache_fichas_max_mb * 1024 * 1024)
+        with DestinoZipFichas(args.bucket_fichas, directorio=args.salida, nombre="fichas_tecnicas_generadas.zip") as destino:
+            total = ensamblar_zip_fichas(df, plantilla_bytes, destino.archivo, args.columna_nombre, args.procesos_fichas, cache=cache_fichas)
+        reutilizadas = f" ({cache_fichas.aciertos} reutilizadas sin renderizar)" if cache_fichas else ""
+        informar(f"{total} fichas{reutilizadas} en {destino.referencia.get('uri') or destino.referencia['ruta']}")
+
+    return 1 if errores else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
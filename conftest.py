@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Utilidades compartidas por las pruebas: un modelo falso que responde como Gemini y bancos de ítems mínimos."""
+
+import re
+import threading
+import types
+
+import pandas as pd
+import pytest
+
+RESPUESTA_PASO1 = "Ruta Cognitiva Correcta:\nSe identifica la idea principal.\n\nAnálisis de Opciones No Válidas:\n- **Opción B:** confusión."
+RESPUESTA_PASO2 = "Este ítem evalúa la capacidad del estudiante para identificar la idea principal."
+RESPUESTA_PASO3 = (
+    "RECOMENDACIÓN PARA FORTALECER EL APRENDIZAJE\nActividad de fortalecimiento.\n\n"
+    "RECOMENDACIÓN PARA AVANZAR EN EL APRENDIZAJE\nActividad para avanzar."
+)
+PATRON_ITEMS_GRUPO = re.compile(r"INSUMOS DE ENTRADA \((\d+) ítems")
+
+class RespuestaFalsa:
+    def __init__(self, texto, tokens_entrada=100, tokens_salida=50):
+        self.text = texto
+        self.usage_metadata = types.SimpleNamespace(
+            prompt_token_count=tokens_entrada, candidates_token_count=tokens_salida,
+            total_token_count=tokens_entrada + tokens_salida, cached_content_token_count=0,
+        )
+
+class ModeloFalso:
+    """Responde los tres pasos (también agrupados) con textos válidos y cuenta las llamadas.
+
+    `fallar(prompt)` puede lanzar una excepción para simular errores de Vertex en ciertas llamadas.
+    """
+
+    def __init__(self, nombre="gemini-2.5-flash", fallar=None):
+        self._model_name = f"publishers/google/models/{nombre}"
+        self.fallar = fallar
+        self.prompts = []
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt, **kwargs):
+        with self._lock:
+            self.prompts.append(prompt)
+        if self.fallar:
+            self.fallar(prompt)
+        if "FASE 1: RUTA COGNITIVA" in prompt:
+            texto = RESPUESTA_PASO1
+        elif "RECOMENDACIÓN PARA AVANZAR" in prompt:
+            texto = RESPUESTA_PASO3
+        else:
+            return RespuestaFalsa(RESPUESTA_PASO2)
+        grupo = PATRON_ITEMS_GRUPO.search(prompt)
+        if grupo:
+            texto = "\n\n".join(f"=== ÍTEM {n} ===\n{texto}" for n in range(1, int(grupo.group(1)) + 1))
+        return RespuestaFalsa(texto)
+
+def banco_items(n=3, contexto="Texto compartido", **columnas):
+    """Banco de `n` ítems con todas las columnas requeridas (las de `columnas` reemplazan las de base)."""
+    return pd.DataFrame([{
+        "ItemId": f"I{k + 1}", "ItemContexto": contexto, "ItemEnunciado": f"Enunciado {k + 1}", "CompetenciaNombre": "Lectura",
+        "AlternativaClave": "A", "OpcionA": "a", "OpcionB": "b", "OpcionC": "c", "OpcionD": "d", **columnas,
+    } for k in range(n)])
+
+@pytest.fixture
+def modelo_falso():
+    return ModeloFalso()
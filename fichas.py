@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""Ensamblaje de las fichas técnicas (.docx) a partir de la plantilla de Word.
+
+La plantilla se abre, se limpia (`patch_xml` de docxtpl) y sus partes Jinja se compilan una
+sola vez; cada ficha solo renderiza esas plantillas ya compiladas y reescribe en el .docx las
+partes que cambian (cuerpo, encabezados, pies, notas al pie y propiedades). Las fichas se
+pueden repartir entre varios procesos, cada uno con su propia copia de la plantilla preparada,
+y las ya renderizadas se guardan en una caché para volver a ensamblar solo las filas que cambiaron.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import pandas as pd
+
+from docx.opc.coreprops import CoreProperties
+from docx.opc.oxml import serialize_part_xml
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsmap
+from docxtpl import DocxTemplate
+from jinja2 import Environment, meta
+
+TIPO_NOTAS_AL_PIE = "application/vnd.openxmlformats-officedocument.wordprocessingml.footnotes+xml"
+# Las mismas propiedades del documento que renderiza docxtpl
+PROPIEDADES_RENDERIZABLES = ("author", "comments", "identifier", "language", "subject", "title")
+# Entra en la huella de las fichas cacheadas: cambiarla cuando cambie el resultado del renderizado
+VERSION_RENDERIZADO = "2"
+# Por debajo de esta cantidad de fichas por proceso, arrancar procesos cuesta más de lo que ahorra
+MIN_FICHAS_POR_PROCESO = 50
+
+def _preparar_fuente(xml):
+    return re.sub(r"<w:p([ >])", r"\n<w:p\1", xml)
+
+class PlantillaFicha:
+    """Plantilla .docx analizada y compilada una vez, lista para renderizar muchas fichas.
+
+    Produce el mismo resultado que `DocxTemplate(plantilla).render(contexto, autoescape=True)` para
+    contextos de texto, sin volver a descomprimir la plantilla ni recompilar su Jinja en cada ficha.
+    Los valores se escapan al insertarse en el XML: los textos del Excel ya limpios de HTML pueden
+    traer `&`, `<` y `>`.
+    """
+
+    def __init__(self, plantilla_bytes):
+        self._tpl = DocxTemplate(BytesIO(plantilla_bytes))
+        docx = self._tpl.get_docx()
+        entorno = Environment(autoescape=True)
+
+        with zipfile.ZipFile(BytesIO(plantilla_bytes)) as zip_plantilla:
+            self._entradas = [(info, zip_plantilla.read(info)) for info in zip_plantilla.infolist()]
+        nombres = {info.filename for info, _ in self._entradas}
+
+        # Variables de Jinja de todas las partes que se renderizan
+        self.variables = set()
+
+        def compilar(fuente, entorno=entorno):
+            self.variables |= meta.find_undeclared_variables(entorno.parse(fuente))
+            return entorno.from_string(fuente)
+
+        self._documento = docx.element
+        self._ruta_documento = docx.part.partname.lstrip("/")
+        self._cuerpo = compilar(_preparar_fuente(self._tpl.patch_xml(self._tpl.get_xml())))
+
+        # ruta dentro del .docx -> (plantilla compilada, codificación, reserializar como parte XML)
+        self._partes = {}
+        for uri in (DocxTemplate.HEADER_URI, DocxTemplate.FOOTER_URI):
+            for _, parte in self._tpl.get_headers_footers(uri):
+                xml = self._tpl.get_part_xml(parte)
+                self._partes[parte.partname.lstrip("/")] = (
+                    compilar(_preparar_fuente(self._tpl.patch_xml(xml))),
+                    self._tpl.get_headers_footers_encoding(xml),
+                    True,
+                )
+        for parte in docx.part.package.iter_parts():
+            if parte.content_type == TIPO_NOTAS_AL_PIE:
+                xml = parte.blob.decode("utf-8") if isinstance(parte.blob, bytes) else parte.blob
+                self._partes[parte.partname.lstrip("/")] = (
+                    compilar(_preparar_fuente(self._tpl.patch_xml(xml))), "utf-8", False
+                )
+
+        # Las propiedades solo se reescriben si alguna lleva Jinja y la plantilla ya trae core.xml
+        self._propiedades = {}
+        parte_propiedades = docx.part.package._core_properties_part
+        self._ruta_propiedades = parte_propiedades.partname.lstrip("/")
+        if self._ruta_propiedades in nombres:
+            for propiedad in PROPIEDADES_RENDERIZABLES:
+                valor = getattr(docx.core_properties, propiedad) or ""
+                if "{" in valor:
+                    # python-docx ya escapa el texto de las propiedades al guardarlo
+                    self._propiedades[propiedad] = compilar(valor, Environment())
+            self._elemento_propiedades = parte_propiedades.element
+
+    def _finalizar(self, xml):
+        """Postproceso de docxtpl tras renderizar una parte (`render_xml_part`)."""
+        xml = re.sub(r"\n<w:p([ >])", r"<w:p\1", xml)
+        xml = xml.replace("{_{", "{{").replace("}_}", "}}").replace("{_%", "{%").replace("%_}", "%}")
+        return self._tpl.resolve_listing(xml)
+
+    def _renderizar_documento(self, contexto):
+        arbol = self._tpl.fix_tables(self._finalizar(self._cuerpo.render(contexto)))
+        for indice, elemento in enumerate(arbol.xpath("//wp:docPr", namespaces=nsmap), start=1001):
+            elemento.attrib["id"] = str(indice)
+        cuerpo_original = self._documento.body
+        self._documento.replace(cuerpo_original, arbol)
+        try:
+            return serialize_part_xml(self._documento)
+        finally:
+            self._documento.replace(arbol, cuerpo_original)
+
+    def _renderizar_propiedades(self, contexto):
+        elemento = parse_xml(serialize_part_xml(self._elemento_propiedades))
+        propiedades = CoreProperties(elemento)
+        for propiedad, plantilla in self._propiedades.items():
+            setattr(propiedades, propiedad, plantilla.render(contexto))
+        return serialize_part_xml(elemento)
+
+    def renderizar(self, contexto):
+        """Retorna los bytes del .docx de una ficha."""
+        reemplazos = {self._ruta_documento: self._renderizar_documento(contexto)}
+        for ruta, (plantilla, codificacion, es_parte_xml) in self._partes.items():
+            xml = self._finalizar(plantilla.render(contexto)).encode(codificacion)
+            reemplazos[ruta] = serialize_part_xml(parse_xml(xml)) if es_parte_xml else xml
+        if self._propiedades:
+            reemplazos[self._ruta_propiedades] = self._renderizar_propiedades(contexto)
+
+        salida = BytesIO()
+        with zipfile.ZipFile(salida, "w", zipfile.ZIP_DEFLATED) as docx_zip:
+            for info, contenido in self._entradas:
+                docx_zip.writestr(info, reemplazos.get(info.filename, contenido))
+        return salida.getvalue()
+
+def variables_plantilla(plantilla_bytes):
+    """Columnas que la plantilla usa como variables de Jinja (para leer solo esas del Excel).
+
+    Incluye las de todas las partes que renderiza PlantillaFicha, también notas al pie y propiedades.
+    """
+    return PlantillaFicha(plantilla_bytes).variables
+
+def renderizar_ficha_docxtpl(plantilla_bytes, contexto):
+    """Camino original: abre y renderiza la plantilla con docxtpl para una sola ficha."""
+    doc = DocxTemplate(BytesIO(plantilla_bytes))
+    doc.render(contexto, autoescape=True)
+    salida = BytesIO()
+    doc.save(salida)
+    return salida.getvalue()
+
+# --- RENDERIZADO EN PARALELO ---
+
+_plantilla_del_proceso = None
+
+def _inicializar_proceso(plantilla_bytes):
+    global _plantilla_del_proceso
+    _plantilla_del_proceso = PlantillaFicha(plantilla_bytes)
+
+def _renderizar_en_proceso(contexto):
+    return _plantilla_del_proceso.renderizar(contexto)
+
+def renderizar_fichas(plantilla_bytes, contextos, max_procesos=1, tamano_lote=8):
+    """Genera los bytes de cada ficha en el mismo orden que `contextos`.
+
+    Con `max_procesos` > 1 las fichas se reparten en lotes entre procesos que preparan la
+    plantilla una vez al arrancar, siempre que haya al menos MIN_FICHAS_POR_PROCESO fichas para
+    cada uno (arrancar un proceso cuesta más que renderizar unas pocas fichas). Los procesos se
+    crean con 'spawn' porque el proceso de Streamlit tiene hilos activos (gRPC, servidor), con los
+    que 'fork' no es seguro.
+    """
+    contextos = list(contextos)
+    max_procesos = min(max_procesos, len(contextos) // MIN_FICHAS_POR_PROCESO)
+    if max_procesos <= 1 or len(contextos) <= tamano_lote:
+        plantilla = PlantillaFicha(plantilla_bytes)
+        for contexto in contextos:
+            yield plantilla.renderizar(contexto)
+        return
+    with ProcessPoolExecutor(
+        max_workers=max_procesos,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_inicializar_proceso,
+        initargs=(plantilla_bytes,),
+    ) as executor:
+        yield from executor.map(_renderizar_en_proceso, contextos, chunksize=tamano_lote)
+
+# --- CACHÉ DE FICHAS RENDERIZADAS ---
+
+def huella_plantilla(plantilla_bytes):
+    return hashlib.sha256(VERSION_RENDERIZADO.encode("utf-8") + plantilla_bytes).hexdigest()
+
+def huella_ficha(huella_de_plantilla, contexto, variables):
+    """Huella de una ficha: misma plantilla y mismos valores en las `variables` que usa producen el mismo .docx.
+
+    Las demás columnas de la fila (telemetría, columnas auxiliares) no entran en la huella.
+    """
+    valores = {variable: contexto.get(variable, "") for variable in variables}
+    material = json.dumps([huella_de_plantilla, valores], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+class CacheFichas:
+    """Caché persistente en SQLite de fichas ya renderizadas (.docx), direccionada por huella_ficha.
+
+    Tras una reparación o la edición de unas pocas celdas, solo las filas con huella nueva se
+    vuelven a renderizar. Cuando supera `max_bytes` elimina las fichas usadas hace más tiempo (LRU).
+    """
+
+    def __init__(self, ruta, max_bytes=1024 * 1024 * 1024):
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        self.ruta = ruta
+        self.max_bytes = max_bytes
+        self.aciertos = 0
+        self.fallos = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(ruta, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fichas ("
+            "huella TEXT PRIMARY KEY, docx BLOB NOT NULL, tamano INTEGER NOT NULL, ultimo_acceso REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ultimo_acceso ON fichas (ultimo_acceso)")
+        self._conn.commit()
+        self._tamano_total = self._conn.execute("SELECT COALESCE(SUM(tamano), 0) FROM fichas").fetchone()[0]
+
+    def reservar(self, huellas, tamano_lote=500):
+        """Retorna cuáles de `huellas` están guardadas y las marca como recién usadas, para que no se
+        desalojen antes que otras mientras se ensambla el .zip."""
+        huellas = list(dict.fromkeys(huellas))
+        guardadas = set()
+        ahora = time.time()
+        with self._lock:
+            for inicio in range(0, len(huellas), tamano_lote):
+                lote = huellas[inicio:inicio + tamano_lote]
+                marcadores = ",".join("?" * len(lote))
+                guardadas.update(fila[0] for fila in self._conn.execute(
+                    f"SELECT huella FROM fichas WHERE huella IN ({marcadores})", lote
+                ))
+                self._conn.execute(f"UPDATE fichas SET ultimo_acceso = ? WHERE huella IN ({marcadores})", (ahora, *lote))
+            self._conn.commit()
+        return guardadas
+
+    def obtener(self, huella):
+        with self._lock:
+            fila = self._conn.execute("SELECT docx FROM fichas WHERE huella = ?", (huella,)).fetchone()
+            if fila is None:
+                self.fallos += 1
+                return None
+            self.aciertos += 1
+            return fila[0]
+
+    def guardar(self, huella, docx_bytes):
+        with self._lock:
+            anterior = self._conn.execute("SELECT tamano FROM fichas WHERE huella = ?", (huella,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO fichas (huella, docx, tamano, ultimo_acceso) VALUES (?, ?, ?, ?)",
+                (huella, docx_bytes, len(docx_bytes), time.time()),
+            )
+            self._tamano_total += len(docx_bytes) - (anterior[0] if anterior else 0)
+            self._desalojar()
+            self._conn.commit()
+
+    def _desalojar(self):
+        while self._tamano_total > self.max_bytes:
+            lote = self._conn.execute("SELECT huella, tamano FROM fichas ORDER BY ultimo_acceso LIMIT 100").fetchall()
+            if not lote:
+                self._tamano_total = 0
+                return
+            for huella, tamano in lote:
+                self._conn.execute("DELETE FROM fichas WHERE huella = ?", (huella,))
+                self._tamano_total -= tamano
+                if self._tamano_total <= self.max_bytes:
+                    return
+
+    def vaciar(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM fichas")
+            self._conn.commit()
+            self._tamano_total = 0
+
+    def reiniciar_contadores(self):
+        with self._lock:
+            self.aciertos = 0
+            self.fallos = 0
+
+    @property
+    def tamano_mb(self):
+        return self._tamano_total / (1024 * 1024)
+
+# --- ENSAMBLAJE DEL ZIP ---
+
+def contextos_fichas(df, columna_nombre_archivo="ItemId"):
+    """Retorna (nombres de archivo, contextos de la plantilla) de cada fila, en orden."""
+    contextos = df.astype(object).where(df.notna(), "").to_dict("records")
+    if columna_nombre_archivo in df.columns:
+        nombres_base = df[columna_nombre_archivo].map(str)
+    else:
+        nombres_base = pd.Series([f"ficha_{i+1}" for i in df.index], index=df.index)
+    nombres_archivo = (nombres_base.str.replace('/', '_').str.replace('\\', '_') + ".docx").tolist()
+    return nombres_archivo, contextos
+
+def ensamblar_zip_fichas(df, plantilla_bytes, archivo, columna_nombre_archivo="ItemId", max_procesos=1, al_avanzar=None,
+                         cache=None):
+    """Escribe en `archivo` (cualquier archivo binario, aunque no admita seek) el .zip con una ficha por fila.
+
+    Con `cache` (una CacheFichas) solo se renderizan las filas cuya huella no está guardada; las demás
+    se copian tal cual. Las fichas van sin recomprimir: un .docx ya es un zip comprimido.
+    `al_avanzar(n, total)` se llama tras añadir cada ficha. Retorna la cantidad de fichas.
+    """
+    nombres_archivo, contextos = contextos_fichas(df, columna_nombre_archivo)
+    total_docs = len(contextos)
+    huellas = [None] * total_docs
+    guardadas = set()
+    if cache is not None:
+        huella_de_plantilla = huella_plantilla(plantilla_bytes)
+        variables = variables_plantilla(plantilla_bytes)
+        huellas = [huella_ficha(huella_de_plantilla, contexto, variables) for contexto in contextos]
+        guardadas = cache.reservar(huellas)
+    plantilla_local = None
+    with zipfile.ZipFile(archivo, "w", zipfile.ZIP_STORED, False) as zip_file:
+        fichas = renderizar_fichas(
+            plantilla_bytes, [c for c, h in zip(contextos, huellas) if h not in guardadas], max_procesos=max_procesos
+        )
+        for n, (nombre_archivo_salida, contexto, huella) in enumerate(zip(nombres_archivo, contextos, huellas), start=1):
+            if huella in guardadas:
+                docx_bytes = cache.obtener(huella)
+                if docx_bytes is None:  # Desalojada mientras se ensamblaba (caché más chica que el banco)
+                    plantilla_local = plantilla_local or PlantillaFicha(plantilla_bytes)
+                    docx_bytes = plantilla_local.renderizar(contexto)
+            else:
+                docx_bytes = next(fichas)
+                if cache is not None:
+                    cache.guardar(huella, docx_bytes)
+            zip_file.writestr(nombre_archivo_salida, docx_bytes)
+            if al_avanzar:
+                al_avanzar(n, total_docs)
+    return total_docs
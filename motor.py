@@ -0,0 +1,2542 @@
+# -*- coding: utf-8 -*-
+"""Motor de enriquecimiento de ítems con Vertex AI, sin dependencias de la interfaz.
+
+Lo usan la app de Streamlit (app.py) y la línea de comandos (cli.py): prompts, llamadas al
+modelo con límite de cuota y reintentos, cachés, modo por lotes, puntos de control y la
+ejecución completa de un banco de ítems.
+"""
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import copy
+import hashlib
+import html
+import importlib.util
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+from types import SimpleNamespace
+
+# --- Importaciones de Google Cloud (CORREGIDAS) ---
+import vertexai
+from google.api_core import exceptions as google_exceptions
+from google.auth import exceptions as google_auth_exceptions
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from google.cloud import storage
+from google.cloud.aiplatform_v1beta1.types import (
+    CachedContent as GapicCachedContent, Content as GapicContent, CreateCachedContentRequest, Part as GapicPart,
+)
+from vertexai.batch_prediction import BatchPredictionJob
+from vertexai.generative_models import GenerationConfig, GenerativeModel, HarmCategory, HarmBlockThreshold
+from vertexai.preview import caching
+from vertexai.preview.generative_models import GenerativeModel as GenerativeModelPreview
+
+# --- MODELOS DISPONIBLES ---
+MODEL_OPTIONS = {
+    "Gemini 2.5 Pro": "gemini-2.5-pro",
+    "Gemini 2.5 Flash": "gemini-2.5-flash",
+    "Gemini 2.5 Flash Lite": "gemini-2.5-flash-lite",
+}
+
+# --- CUOTAS POR MODELO (peticiones y tokens por minuto) ---
+# Valores por defecto del límite del lado del cliente; ajústalos a la cuota real de tu proyecto.
+LIMITES_MODELO = {
+    "gemini-2.5-pro": {"rpm": 60, "tpm": 1_000_000},
+    "gemini-2.5-flash": {"rpm": 300, "tpm": 2_000_000},
+    "gemini-2.5-flash-lite": {"rpm": 600, "tpm": 4_000_000},
+}
+
+# --- PRECIOS POR MODELO (USD por millón de tokens) ---
+# Precios de lista de Vertex AI para prompts de hasta 200k tokens; sirven para estimar, no para facturar.
+PRECIOS_MODELO = {
+    "gemini-2.5-pro": {"entrada": 1.25, "salida": 10.00},
+    "gemini-2.5-flash": {"entrada": 0.30, "salida": 2.50},
+    "gemini-2.5-flash-lite": {"entrada": 0.10, "salida": 0.40},
+}
+# Los tokens leídos de un cached content se cobran a esta fracción del precio de entrada
+FACTOR_PRECIO_TOKENS_CACHEADOS = 0.25
+
+# --- ALMACENAMIENTO LOCAL (cachés y puntos de control) ---
+DIRECTORIO_DATOS = os.environ.get("DIRECTORIO_DATOS", ".datos")
+
+# --- COLUMNAS DEL BANCO DE ÍTEMS ---
+# Columnas que leen los constructores de prompts; sin las requeridas el análisis no tiene sentido
+COLUMNAS_PROMPT = [
+    "ItemId", "ItemContexto", "ItemEnunciado", "ComponenteNombre", "CompetenciaNombre", "AfirmacionNombre",
+    "EvidenciaNombre", "Tipologia Textual", "ItemGradoId", "Analisis_Errores", "AlternativaClave",
+    "OpcionA", "OpcionB", "OpcionC", "OpcionD",
+]
+COLUMNAS_REQUERIDAS = ["ItemContexto", "ItemEnunciado", "AlternativaClave", "OpcionA", "OpcionB", "OpcionC", "OpcionD"]
+
+# --- COLUMNAS GENERADAS POR LA IA ---
+COLUMNAS_NUEVAS = ["Que_Evalua", "Justificacion_Correcta", "Analisis_Distractores", "Recomendacion_Fortalecer", "Recomendacion_Avanzar"]
+# Columnas que produce cada paso de la cadena
+COLUMNAS_POR_PASO = {
+    1: ["Justificacion_Correcta", "Analisis_Distractores"],
+    2: ["Que_Evalua"],
+    3: ["Recomendacion_Fortalecer", "Recomendacion_Avanzar"],
+}
+# Las columnas de los pasos que fallaron llevan esta marca y el motivo va en COLUMNA_ERROR
+MARCA_ERROR = "ERROR EN PROCESAMIENTO"
+COLUMNA_ERROR = "Error_IA"
+# Totales de consumo por ítem que se agregan al Excel enriquecido (columna -> clave de `uso`)
+COLUMNAS_USO = {
+    "IA_Llamadas": "llamadas",
+    "IA_Reintentos": "reintentos",
+    "IA_Tokens_Entrada": "tokens_entrada",
+    "IA_Tokens_Salida": "tokens_salida",
+    "IA_Latencia_s": "latencia_s",
+    "IA_Costo_USD": "costo_usd",
+}
+
+# --- FUNCIONES DE LÓGICA ---
+
+PATRON_ETIQUETA_HTML = re.compile(r"<[^>]*>")
+
+def limpiar_html(texto_html):
+    """Limpia etiquetas y entidades HTML (&nbsp;, &amp;...) de un texto."""
+    if not isinstance(texto_html, str):
+        return texto_html
+    return html.unescape(PATRON_ETIQUETA_HTML.sub("", texto_html)).replace("\xa0", " ")
+
+def _limpiar_html_valores(serie):
+    limpia = serie.str.replace(PATRON_ETIQUETA_HTML, "", regex=True)
+    # html.unescape solo donde hay entidades
+    con_entidades = limpia.str.contains("&", regex=False, na=False)
+    if con_entidades.any():
+        limpia = limpia.where(~con_entidades, limpia[con_entidades].map(html.unescape))
+    limpia = limpia.str.replace("\xa0", " ", regex=False)
+    # En columnas mixtas, .str deja NaN en las celdas que no son texto (números, fechas)
+    return limpia.where(limpia.notna(), serie)
+
+def limpiar_html_columna(serie):
+    """`limpiar_html` vectorizado para una columna entera; deja intactas las celdas que no son texto.
+
+    Cada valor distinto se limpia una sola vez: en un banco de ítems se repiten pasajes, opciones y competencias.
+    """
+    codigos, unicos = pd.factorize(serie)
+    if not len(unicos):
+        return serie
+    limpios = _limpiar_html_valores(pd.Series(unicos, dtype=object)).to_numpy(dtype=object)
+    valores = np.where(codigos >= 0, limpios[codigos], serie.to_numpy(dtype=object))
+    return pd.Series(valores, index=serie.index, name=serie.name).astype(serie.dtype)
+
+# --- CONFIGURACIÓN DE GENERACIÓN ---
+
+GENERATION_CONFIG = {
+    "temperature": 0.6,
+    "top_p": 1.0,
+    "top_k": 32,
+    "max_output_tokens": 8192,
+}
+
+# Forma correcta de definir las configuraciones de seguridad
+SAFETY_SETTINGS = {
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+}
+
+# Clientes ya creados en este proceso, por (proyecto, región, modelo): se reutilizan entre ejecuciones y trabajos
+_CLIENTES_MODELO = {}
+_LOCK_CLIENTES = threading.Lock()
+
+def inicializar_vertex(project_id, location):
+    """Fija el proyecto y la región por defecto de vertexai, que usan los trabajos por lotes.
+
+    Es configuración global del proceso: los clientes de modelo (setup_model) y los prefijos
+    cacheados (ContextoFewShotCacheado) llevan su región en el nombre de recurso y no dependen de ella.
+    """
+    with _LOCK_CLIENTES:
+        vertexai.init(project=project_id, location=location)
+
+def setup_model(project_id, location, model_name):
+    """Retorna el cliente para el modelo Gemini en Vertex AI.
+
+    El cliente queda fijado a `location` por su nombre de recurso completo (pueden convivir clientes
+    de varias regiones) y se crea una sola vez por proceso, junto con su conexión.
+    """
+    clave = (project_id, location, model_name)
+    with _LOCK_CLIENTES:
+        if clave not in _CLIENTES_MODELO:
+            _CLIENTES_MODELO[clave] = GenerativeModel(
+                f"projects/{project_id}/locations/{location}/publishers/google/models/{model_name}",
+                generation_config=GENERATION_CONFIG,
+                safety_settings=SAFETY_SETTINGS
+            )
+        return _CLIENTES_MODELO[clave]
+
+# --- EJEMPLOS DE ALTA CALIDAD (FEW-SHOT PROMPTING) ---
+
+EJEMPLOS_ANALISIS_PREMIUM = """
+A continuación, te muestro ejemplos de análisis de la más alta calidad. Tu respuesta debe seguir este mismo estilo, tono y nivel de detalle.
+
+### EJEMPLO 1: LECTURA LITERAL (TEXTO NARRATIVO) ###
+**INSUMOS:**
+- Competencia: Comprensión de textos
+- Componente: Lectura literal
+- Evidencia: Reconoce información específica en el texto.
+- Enunciado: Los personajes del cuento son:
+- Opciones: A: "Un hombre, un hombrecito y alguien que sostiene unas pinzas.", B: "Un narrador, un hombre y un hombrecito.", C: Un hombrecito y alguien que sostiene unas pinzas., D: Un hombre y el narrador.
+
+**RESULTADO ESPERADO:**
+Ruta Cognitiva Correcta:
+Para responder la pregunta, el estudiante debe leer el cuento prestando atención a las entidades que realizan acciones o a quienes les suceden eventos en el texto. En el tercer párrafo, se menciona a "un hombre" que armó el barquito y a un "hombrecito diminuto" dentro de la botella. En el último párrafo, se describe que un "ojo enorme lo atisbaba desde fuera" al primer hombre y que "unas enormes pinzas que avanzaban hacia él". Este "ojo enorme" y las "enormes pinzas" implican la existencia de un tercer personaje, un ser que se encuentra mirando al primer personaje. El estudiante debe identificar a todos estos personajes que interactúan o son afectados por la trama.
+
+Análisis de Opciones No Válidas:
+- **Opción B:** No es correcta porque, en este cuento, el "narrador" es la voz que cuenta la historia, no un personaje que participe en los eventos del cuento. El relato está escrito en tercera persona y el narrador se mantiene fuera de la acción.
+- **Opción C:** No es correcta porque omite al primer personaje introducido y central en la trama: "un hombre" que construye el barquito y observa al "hombrecito". Sin este personaje, la secuencia de eventos no se establece.
+- **Opción D:** No es correcta porque, al igual que la opción B, incluye al "narrador" como personaje, lo cual es incorrecto. Además, omite al "hombrecito" y al ser con "unas pinzas", reduciendo el número de personajes activos en la historia.
+
+### EJEMPLO 2: LECTURA INFERENCIAL (TEXTO NARRATIVO-INFORMATIVO) ###
+**INSUMOS:**
+- Competencia: Comprensión de textos
+- Componente: Lectura inferencial
+- Evidencia: Integra y compara diferentes partes del texto y analiza la estructura para hacer inferencias.
+- Enunciado: Lee el siguiente fragmento del texto: “Los manglares están muriendo, por lo que el desequilibrio es cada vez mayor. La carretera lo cambió todo. Para construirla arrasaron veinte mil hectáreas de manglar...”. ¿Qué función cumple la parte subrayada dentro del fragmento?
+- Opciones: A: Señalar la causa de un problema medioambiental., B: Establecer una comparación entre dos acciones de un proceso., C: Mostrar la consecuencia del daño medioambiental., D: Explicar el motivo por el que se decidió realizar una acción.
+
+**RESULTADO ESPERADO:**
+Ruta Cognitiva Correcta:
+El estudiante debe comprender el contenido del fragmento y la estructura global del texto, para luego identificar cuál es la función que cumple dentro de esta. En este caso específico, el estudiante debe comprender que el fragmento señala la principal causa que ha llevado al desequilibrio del ecosistema de los manglares en la zona, y que este fragmento del texto justamente cumple con la función de señalar esa causa.
+
+Análisis de Opciones No Válidas:
+- **Opción B:** Es incorrecta porque la pregunta busca la causa del problema, no la comparación de acciones.
+- **Opción C:** Es incorrecta porque el estudiante confunde la causa con la consecuencia del problema medioambiental. Identifica un efecto del problema, pero no su origen.
+- **Opción D:** Es incorrecta porque se centra en la motivación detrás de una acción, en lugar de la causa del problema en sí mismo. La pregunta busca el origen del problema medioambiental.
+
+### EJEMPLO 3: LECTURA CRÍTICA (TEXTO NARRATIVO-INFORMATIVO) ###
+**INSUMOS:**
+- Competencia: Comprensión de textos
+- Componente: Lectura crítica
+- Evidencia: Evalúa la credibilidad, confiabilidad y objetividad del texto, emitiendo juicios críticos sobre la información.
+- Enunciado: ¿Por qué el autor cita el testimonio de Jesús Suárez en el texto?
+- Opciones: A: Porque es el vocero que la comunidad palafítica ha designado., B: Porque es causante de la situación que ocurre en la población., C: Porque al ser experto en ecosistemas acuáticos su opinión es confiable., D: Porque al ser investigador puede verificar lo dicho por otro testigo de los hechos.
+
+**RESULTADO ESPERADO:**
+Ruta Cognitiva Correcta:
+El estudiante analiza las opciones presentadas considerando la relación entre la justificación dada y la confiabilidad de la fuente. Evalúa la opción C y reconoce que la experticia en ecosistemas acuáticos otorga mayor credibilidad a la opinión de un individuo sobre una situación relacionada con este tema. Justifica la selección de la opción C al contrastarla con las demás opciones, considerando la relevancia de la experticia para la situación planteada.
+
+Análisis de Opciones No Válidas:
+- **Opción A:** Es incorrecta porque ser vocero no implica necesariamente tener el conocimiento experto para opinar sobre situaciones específicas.
+- **Opción B:** Es incorrecta porque ser causante de un problema no implica tener el conocimiento o la imparcialidad para analizarlo y ofrecer una opinión confiable.
+- **Opción D:** Es incorrecta porque la verificación de un testimonio en este contexto requiere una experticia específica en el tema, que en este caso es ecosistemas acuáticos.
+"""
+
+EJEMPLOS_RECOMENDACIONES_PREMIUM = """
+A continuación, te muestro ejemplos de recomendaciones pedagógicas de la más alta calidad. Tu respuesta debe seguir este mismo estilo, estructura y enfoque creativo.
+
+### EJEMPLO 1 DE RECOMENDACIONES PERFECTAS (TEXTO DISCONTINUO) ###
+**INSUMOS:**
+- Qué Evalúa la pregunta: la pregunta evalúa la habilidad del estudiante para relacionar diferentes elementos del contenido e identificar nueva información en textos no literarios.
+- Evidencia: Relaciona diferentes partes del texto para hacer inferencias sobre significados o sobre el propósito general.
+
+**RESULTADO ESPERADO:**
+RECOMENDACIÓN PARA FORTALECER EL APRENDIZAJE EVALUADO EN la pregunta
+Para reforzar la habilidad de vincular diferentes elementos del contenido y descubrir nuevas ideas, se sugiere la realización de actividades que impliquen el análisis de textos no literarios de carácter discontinuo como infografías. Los estudiantes podrían empezar por leer estas fuentes y marcar los datos que consideren relevantes. Posteriormente, en un esfuerzo colectivo, podrían construir un mapa conceptual que refleje la relación entre los diferentes datos resaltados. Finalmente, podrían trabajar en la identificación de las ideas principales y secundarias que emergen de este mapa, lo que les permitirá tener una comprensión más profunda del texto.
+
+RECOMENDACIÓN PARA AVANZAR EN EL APRENDIZAJE EVALUADO EN la pregunta
+Para consolidar la capacidad de identificar las funciones de los diferentes elementos que componen un texto no literario de carácter discontinuo, se sugiere fomentar la práctica de reorganizar textos desordenados. Los estudiantes pueden recibir fragmentos de una infografía que deben arreglar en el orden correcto, identificando la introducción, el desarrollo y la conclusión. Durante esta actividad, se pueden formular preguntas como: ¿Cuál fragmento introduce el tema? ¿Qué información proporciona esta imagen o gráfico? ¿Cómo se relaciona con el texto?
+
+### EJEMPLO 2 DE RECOMENDACIONES PERFECTAS (TEXTO INFORMATIVO) ###
+**INSUMOS:**
+- Qué Evalúa la pregunta: Este ítem evalúa la capacidad del estudiante para hacer una inferencia integrando información implícita presente en una parte del texto.
+- Evidencia: Integra y compara diferentes partes del texto y analiza la estructura para hacer inferencias.
+
+**RESULTADO ESPERADO:**
+RECOMENDACIÓN PARA FORTALECER EL APRENDIZAJE EVALUADO EN la pregunta
+Para fortalecer la habilidad de hacer inferencias a partir de un segmento de un texto informativo, se sugiere implementar una dinámica de "lectura de pistas". Esta estrategia se enfoca en que los estudiantes identifiquen información implícita en fragmentos textuales cortos para inferir contextos o emociones que no se mencionan directamente. El docente puede presentar al grupo tres o cuatro fragmentos muy breves y evocadores (de noticias o crónicas) que insinúen una situación sin describirla por completo. Por ejemplo: "El teléfono sonó por décima vez. Al otro lado de la línea, solo se oía una respiración agitada. Afuera, la sirena de una ambulancia se acercaba". Los estudiantes, en parejas, leen el fragmento y discuten qué pueden deducir de la escena. Las preguntas orientadoras pueden ser: ¿Qué pistas te da el texto sobre el estado de ánimo de la persona?, ¿Qué crees que pasó justo antes de la escena descrita?
+
+RECOMENDACIÓN PARA AVANZAR EN EL APRENDIZAJE EVALUADO EN la pregunta
+Para avanzar en la habilidad de hacer inferencias complejas a partir de la comparación de diferentes partes de un texto, se sugiere proponer un análisis de perspectivas múltiples dentro de una misma crónica o texto informativo. El objetivo es que los estudiantes superen la inferencia local y aprendan a contrastar voces, datos o argumentos presentados en un mismo relato. El docente puede seleccionar una crónica periodística sobre un tema urbano actual que incluya las voces de distintos actores sociales (un vendedor, un residente, un funcionario). Los estudiantes deben leer el texto e identificar y comparar las diferentes posturas frente al mismo hecho. Las preguntas orientadoras pueden ser: ¿Qué similitudes y diferencias encuentras entre las perspectivas?, ¿Qué visión del problema se formaría un lector si el texto solo hubiera incluido una de estas voces?
+"""
+
+# --- FUNCIONES DE PROMPTS SECUENCIALES ---
+
+def _insumos_paso1(fila, incluir_contexto=True):
+    """Lista de insumos de un ítem para el Paso 1 (la fila ya debe venir sin NaN)."""
+    lineas = [f"- Texto/Fragmento: {fila.get('ItemContexto', 'No aplica')}"] if incluir_contexto else []
+    lineas += [
+        f"- Descripción dla pregunta: {fila.get('ItemEnunciado', 'No aplica')}",
+        f"- Componente: {fila.get('ComponenteNombre', 'No aplica')}",
+        f"- Competencia: {fila.get('CompetenciaNombre', '')}",
+        f"- Aprendizaje Priorizado: {fila.get('AfirmacionNombre', '')}",
+        f"- Evidencia de Aprendizaje: {fila.get('EvidenciaNombre', '')}",
+        f"- Tipología Textual (Solo para Lectura Crítica): {fila.get('Tipologia Textual', 'No aplica')}",
+        f"- Grado Escolar: {fila.get('ItemGradoId', '')}",
+        f"- Análisis de Errores Comunes: {fila.get('Analisis_Errores', 'No aplica')}",
+        f"- Respuesta correcta: {fila.get('AlternativaClave', 'No aplica')}",
+        f"- Opción A: {fila.get('OpcionA', 'No aplica')}",
+        f"- Opción B: {fila.get('OpcionB', 'No aplica')}",
+        f"- Opción C: {fila.get('OpcionC', 'No aplica')}",
+        f"- Opción D: {fila.get('OpcionD', 'No aplica')}",
+    ]
+    return "\n".join(lineas)
+
+def _insumos_paso3(que_evalua_sintetizado, analisis_central_generado, fila, incluir_contexto=True):
+    """Lista de insumos de un ítem para el Paso 3 (la fila ya debe venir sin NaN)."""
+    lineas = [
+        f"- Qué Evalúa la pregunta: {que_evalua_sintetizado}",
+        f"- Análisis Detallado dla pregunta: {analisis_central_generado}",
+    ]
+    if incluir_contexto:
+        lineas.append(f"- Texto/Fragmento: {fila.get('ItemContexto', 'No aplica')}")
+    lineas += [
+        f"- Descripción dla pregunta: {fila.get('ItemEnunciado', 'No aplica')}",
+        f"- Componente: {fila.get('ComponenteNombre', 'No aplica')}",
+        f"- Competencia: {fila.get('CompetenciaNombre', '')}",
+        f"- Aprendizaje Priorizado: {fila.get('AfirmacionNombre', '')}",
+        f"- Evidencia de Aprendizaje: {fila.get('EvidenciaNombre', '')}",
+        f"- Tipología Textual (Solo para Lectura Crítica): {fila.get('Tipologia Textual', 'No aplica')}",
+        f"- Grado Escolar: {fila.get('ItemGradoId', '')}",
+        f"- Análisis de Errores Comunes: {fila.get('Analisis_Errores', 'No aplica')}",
+        f"- Respuesta correcta: {fila.get('AlternativaClave', 'No aplica')}",
+    ]
+    return "\n".join(lineas)
+
+# Prefijo estático del Paso 1: rol, ejemplos, instrucciones y formato. Va primero y no cambia
+# entre ítems, para que Vertex pueda reutilizarlo (context caching explícito o implícito).
+PREFIJO_PASO1 = f"""
+🎯 ROL DEL SISTEMA
+Eres un experto psicómetra y pedagogo. Tu misión es deconstruir un ítem de evaluación siguiendo el estilo y la calidad de los ejemplos proporcionados.
+
+{EJEMPLOS_ANALISIS_PREMIUM}
+
+📝 INSTRUCCIONES
+Basándote en los ejemplos de alta calidad y en los INSUMOS DE ENTRADA del nuevo ítem (al final de este mensaje), realiza el siguiente proceso en dos fases:
+
+FASE 1: RUTA COGNITIVA
+Describe, en un párrafo continuo y de forma impersonal, el procedimiento mental que un estudiante debe ejecutar para llegar a la respuesta correcta.
+1.  **Genera la Ruta Cognitiva:** Describe el paso a paso mental y lógico que un estudiante debe seguir para llegar a la respuesta correcta. Usa verbos que representen procesos cognitivos.
+2.  **Auto-Verificación:** Revisa que la ruta se alinee con la Competencia y la Evidencia de Aprendizaje indicadas en los insumos.
+3.  **Justificación Final:** El último paso debe justificar la elección de la respuesta correcta.
+
+FASE 2: ANÁLISIS DE OPCIONES NO VÁLIDAS
+- Para cada opción incorrecta, identifica la naturaleza del error y explica el razonamiento fallido.
+- Luego, explica el posible razonamiento que lleva al estudiante a cometer ese error.
+- Finalmente, clarifica por qué esa opción es incorrecta en el contexto de la tarea evaluativa.
+
+✍️ FORMATO DE SALIDA
+**REGLA CRÍTICA:** Responde únicamente con los dos títulos siguientes, en este orden y sin añadir texto adicional.
+
+Ruta Cognitiva Correcta:
+[Párrafo continuo y detallado.] Debe describir como es la secuencia de procesos cognitivos. Ejemplo: Para resolver correctamente este ítem, el estudiante primero debe [verbo cognitivo 1]... Luego, necesita [verbo cognitivo 2]... Este proceso le permite [verbo cognitivo 3]..., lo que finalmente lo lleva a concluir que la opción [letra de la respuesta correcta] es la correcta porque [justificación final].
+
+Análisis de Opciones No Válidas:
+- **Opción [Letra del distractor]:** El estudiante podría escoger esta opción si comete un error de [naturaleza de la confusión u error], lo que lo lleva a pensar que [razonamiento erróneo]. Sin embargo, esto es incorrecto porque [razón clara y concisa].
+"""
+
+def construir_prompt_paso1_analisis_central(fila, instruccion_adicional="", incluir_prefijo=True):
+    """Paso 1: Genera la Ruta Cognitiva y el Análisis de Distractores, guiado por ejemplos.
+
+    Con `incluir_prefijo=False` retorna solo la parte variable, para modelos que ya tienen
+    PREFIJO_PASO1 como contenido cacheado.
+    """
+    fila = fila.fillna('')
+    instruccion_formateada = f"\n**Instrucción Adicional del Usuario:** {instruccion_adicional}\n" if instruccion_adicional else ""
+    parte_variable = f"""
+🧠 INSUMOS DE ENTRADA (Para el nuevo ítem que debes analizar):
+{_insumos_paso1(fila)}
+{instruccion_formateada}
+Analiza ahora este ítem siguiendo las INSTRUCCIONES y el FORMATO DE SALIDA indicados.
+"""
+    return PREFIJO_PASO1 + parte_variable if incluir_prefijo else parte_variable
+
+def construir_prompt_paso2_sintesis_que_evalua(analisis_central_generado, fila, instruccion_adicional=""):
+    """Paso 2: Sintetiza el "Qué Evalúa" a partir del análisis central."""
+    fila = fila.fillna('')
+    try:
+        header_distractores = "Análisis de Opciones No Válidas:"
+        idx_distractores = analisis_central_generado.find(header_distractores)
+        ruta_cognitiva_texto = analisis_central_generado[:idx_distractores].strip() if idx_distractores != -1 else analisis_central_generado
+    except:
+        ruta_cognitiva_texto = analisis_central_generado
+    instruccion_formateada = f"\n**Instrucción Adicional del Usuario:** {instruccion_adicional}\n" if instruccion_adicional else ""
+    return f"""
+🎯 ROL DEL SISTEMA
+Eres un experto en evaluación que sintetiza análisis complejos en una sola frase concisa.
+
+🧠 INSUMOS DE ENTRADA
+A continuación, te proporciono un análisis detallado de la ruta cognitiva necesaria para resolver un ítem.
+
+ANÁLISIS DE LA RUTA COGNITIVA:
+---
+{ruta_cognitiva_texto}
+---
+
+TAXONOMÍA DE REFERENCIA:
+- Competencia: {fila.get('CompetenciaNombre', '')}
+- Aprendizaje Priorizado: {fila.get('AfirmacionNombre', '')}
+- Evidencia de Aprendizaje: {fila.get('EvidenciaNombre', '')}
+
+📝 INSTRUCCIONES
+{instruccion_formateada}
+Basándote **exclusivamente** en el ANÁLISIS DE LA RUTA COGNITIVA, redacta una única frase (máximo 2 renglones) que resuma la habilidad principal que se está evaluando.
+- **Regla 1:** La frase debe comenzar obligatoriamente con "Este ítem evalúa la capacidad del estudiante para...".
+- **Regla 2:** La frase debe describir los **procesos cognitivos**, no debe contener especificamene ninguno de los elementos del texto o dla pregunta, busca en cambio palabras/expresiones genéricas en reemplazo de elementos del item/texto cuando es necesario.
+- **Regla 3:** Utiliza la TAXONOMÍA DE REFERENCIA para asegurar que el lenguaje sea preciso y alineado.
+
+✍️ FORMATO DE SALIDA
+Responde únicamente con la frase solicitada, sin el título "Qué Evalúa".
+"""
+
+# Prefijo estático del Paso 3 (ver PREFIJO_PASO1).
+PREFIJO_PASO3 = f"""
+🎯 ROL DEL SISTEMA
+Eres un diseñador instruccional experto y un docente de aula con mucha experiencia. Tu especialidad es crear actividades de lectura que son novedosas, lúdicas y, sobre todo, prácticas y realizables en un salón de clases con recursos limitados.
+
+{EJEMPLOS_RECOMENDACIONES_PREMIUM}
+
+📝 INSTRUCCIONES PARA GENERAR LAS RECOMENDACIONES
+Basándote en los ejemplos y en los INSUMOS DE ENTRADA del nuevo ítem (al final de este mensaje), genera dos recomendaciones (Fortalecer y Avanzar) que cumplan con estas reglas inviolables:
+1.  **ABSTRACCIÓN DE LA HABILIDAD:** # <-- CAMBIO CLAVE 1: Desanclar del ítem.
+    Las actividades deben enfocarse en la habilidad cognitiva descrita en 'Qué Evalúa la pregunta', no en el contenido específico del 'Texto/Fragmento' o la 'Descripción dla pregunta'. Usa los insumos solo para entender la habilidad, pero diseña una actividad que se pueda aplicar a OTROS textos o contextos.
+    CRÍTICO: Evita usar las mismas situaciones expuestas en el ítem. Deben ser diferentes pero debene estar dentro del mismo campo cognitivo de lo que evalúa el ítem.
+    
+2.  **VIABILIDAD EN EL AULA:** # <-- CAMBIO CLAVE 2: Realismo y practicidad.
+    Las actividades deben ser 100% realizables dentro de un salón de clases estándar. Esto significa:
+    - **Cero Materiales:** No requieren preparación de materiales especiales (fichas, tarjetas, proyectores). Se basan en la discusión, el análisis oral o la interacción con un texto genérico.
+    - **Cero Tareas Externas:** No implican actividades fuera del aula, ni uso de tecnología.
+    - **La novedad está en la dinámica, no en los recursos.**
+
+3.  **CERO PRODUCCIÓN ESCRITA:** Deben ser actividades exclusivas de lectura, selección, debate corto, clasificación oral o argumentación.
+
+4.  **CREATIVIDAD BASADA EN EL ESCENARIO:** # <-- ESTA ES LA REGLA CLAVE MODIFICADA
+    La novedad y el factor lúdico deben residir en la **situación o el contexto** que se plantea, no necesariamente en el formato de la interacción.
+    - **EVITA** escenarios clichés o abstractos típicos de libros de texto. Por ejemplo, en lugar de "lanzar un dado 20 veces", que es un escenario aburrido...
+    - **FAVORECE** escenarios concretos, imaginativos y con una narrativa. Por ejemplo, para la misma habilidad de probabilidad, podrías proponer: "se organiza un pequeño 'casino' en clase con barajas de colores donde los estudiantes deben calcular sus posibilidades de ganar en diferentes juegos inventados". O "los estudiantes son exploradores que deben decidir qué camino tomar en una jungla basándose en las probabilidades de encontrar recursos o peligros".
+    - El objetivo es crear un "mini-mundo" o un reto temático donde se aplique la habilidad.
+
+5.  **REDACCIÓN IMPERSONAL.**
+
+RECOMENDACIÓN PARA FORTALECER EL APRENDIZAJE EVALUADO EN la pregunta
+Para fortalecer la habilidad de [verbo clave extraído de la Evidencia de Aprendizaje], se sugiere [descripción de la estrategia de andamiaje para ese proceso exacto].
+Una actividad que se puede hacer es: [Descripción detallada de la actividad novedosa y creativa, que no implica escritura].
+Las preguntas orientadoras para esta actividad, entre otras, pueden ser:
+- [Pregunta 1: Que guíe el primer paso del proceso cognitivo]
+- [Pregunta 2: Que ayude a analizar un componente clave del proceso]
+- [Pregunta 3: Que conduzca a la conclusión del proceso base]
+
+RECOMENDACIÓN PARA AVANZAR EN EL APRENDIZAJE EVALUADO EN la pregunta
+Para avanzar desde [proceso cognitivo de Fortalecer] hacia la habilidad de [verbo clave del proceso cognitivo superior], se sugiere [descripción de la estrategia de complejización].
+Una actividad que se puede hacer es: [Descripción detallada de la actividad estimulante y poco convencional, que no implique escritura].
+Las preguntas orientadoras para esta actividad, entre otras, pueden ser:
+- [Pregunta 1: De análisis o evaluación que requiera un razonamiento más profundo]
+- [Pregunta 2: De aplicación, comparación o transferencia a un nuevo contexto]
+- [Pregunta 3: De metacognición o pensamiento crítico sobre el proceso completo]
+"""
+
+def construir_prompt_paso3_recomendaciones(que_evalua_sintetizado, analisis_central_generado, fila, instruccion_adicional="", incluir_prefijo=True):
+    """Paso 3: Genera las recomendaciones, guiado por ejemplos (ver `incluir_prefijo` en el Paso 1)."""
+    fila = fila.fillna('')
+    instruccion_formateada = f"\n**Instrucción Adicional del Usuario:** {instruccion_adicional}\n" if instruccion_adicional else ""
+    parte_variable = f"""
+🧠 INSUMOS DE ENTRADA (Para el nuevo ítem):
+# Se mantienen los insumos para dar contexto, pero las instrucciones forzarán a la IA a no usarlos literalmente.
+{_insumos_paso3(que_evalua_sintetizado, analisis_central_generado, fila)}
+{instruccion_formateada}
+Genera ahora las dos recomendaciones para este ítem siguiendo las INSTRUCCIONES indicadas.
+"""
+    return PREFIJO_PASO3 + parte_variable if incluir_prefijo else parte_variable
+
+# --- PROMPT DE LLAMADA ÚNICA (SALIDA ESTRUCTURADA) ---
+
+ESQUEMA_RESPUESTA_UNICA = {
+    "type": "object",
+    "properties": {col: {"type": "string"} for col in COLUMNAS_NUEVAS},
+    "required": COLUMNAS_NUEVAS,
+}
+
+CONFIG_RESPUESTA_UNICA = {
+    **GENERATION_CONFIG,
+    "response_mime_type": "application/json",
+    "response_schema": ESQUEMA_RESPUESTA_UNICA,
+}
+
+def construir_prompt_unico(fila, instruccion_paso1="", instruccion_paso2="", instruccion_paso3=""):
+    """Modo de llamada única: pide en un solo JSON las cinco columnas que produce la cadena de 3 pasos."""
+    fila = fila.fillna('')
+    instrucciones = [
+        f"- {nombre}: {texto}" for nombre, texto in (
+            ("Análisis central", instruccion_paso1),
+            ("Qué Evalúa", instruccion_paso2),
+            ("Recomendaciones", instruccion_paso3),
+        ) if texto
+    ]
+    instruccion_formateada = ("\n**Instrucciones Adicionales del Usuario:**\n" + "\n".join(instrucciones) + "\n") if instrucciones else ""
+    return f"""
+🎯 ROL DEL SISTEMA
+Eres un experto psicómetra, pedagogo y diseñador instruccional. Tu misión es deconstruir un ítem de evaluación y proponer recomendaciones de aula, siguiendo el estilo y la calidad de los ejemplos proporcionados.
+
+{EJEMPLOS_ANALISIS_PREMIUM}
+
+{EJEMPLOS_RECOMENDACIONES_PREMIUM}
+
+🧠 INSUMOS DE ENTRADA (Para el nuevo ítem):
+{_insumos_paso1(fila)}
+
+📝 INSTRUCCIONES
+{instruccion_formateada}
+Responde con un objeto JSON con exactamente estos cinco campos de texto:
+- "Justificacion_Correcta": la Ruta Cognitiva Correcta, en un párrafo continuo e impersonal que describa la secuencia de procesos cognitivos para llegar a la respuesta correcta y termine justificando esa opción.
+- "Analisis_Distractores": empieza con "Análisis de Opciones No Válidas:" y sigue con una viñeta "- **Opción X:**" por cada opción incorrecta, explicando la naturaleza del error, el razonamiento que lleva a escogerla y por qué es incorrecta.
+- "Que_Evalua": una única frase (máximo 2 renglones) que empiece con "Este ítem evalúa la capacidad del estudiante para..." y describa procesos cognitivos sin mencionar elementos específicos del texto o de la pregunta.
+- "Recomendacion_Fortalecer": empieza con "RECOMENDACIÓN PARA FORTALECER EL APRENDIZAJE EVALUADO EN la pregunta" y describe una actividad creativa, realizable en el aula sin materiales ni producción escrita, con tres preguntas orientadoras.
+- "Recomendacion_Avanzar": empieza con "RECOMENDACIÓN PARA AVANZAR EN EL APRENDIZAJE EVALUADO EN la pregunta" y describe una actividad de mayor complejidad con las mismas reglas, con tres preguntas orientadoras.
+Las recomendaciones deben abstraer la habilidad evaluada y aplicarse a otros textos o situaciones distintas a las del ítem. Redacción impersonal.
+"""
+
+# --- PROMPTS AGRUPADOS POR PASAJE ---
+
+MARCA_ITEM_GRUPO = "=== ÍTEM {n} ==="
+PATRON_MARCA_ITEM_GRUPO = re.compile(r"^\s*=+\s*ÍTEM\s+(\d+)\s*=+\s*$", re.MULTILINE | re.IGNORECASE)
+
+def normalizar_contexto(texto):
+    """Forma canónica de un ItemContexto para detectar ítems que comparten el mismo pasaje."""
+    if not isinstance(texto, str):
+        return ""
+    return " ".join(texto.split()).casefold()
+
+def _bloques_items_grupo(filas, insumos):
+    return "\n\n".join(
+        f"{MARCA_ITEM_GRUPO.format(n=n)}\n{insumos(fila)}" for n, fila in enumerate(filas, start=1)
+    )
+
+def construir_prompt_paso1_grupo(filas, instruccion_adicional=""):
+    """Paso 1 para varios ítems del mismo pasaje: el Texto/Fragmento se envía una sola vez."""
+    filas = [fila.fillna('') for fila in filas]
+    instruccion_formateada = f"\n**Instrucción Adicional del Usuario:** {instruccion_adicional}\n" if instruccion_adicional else ""
+    return f"""
+🎯 ROL DEL SISTEMA
+Eres un experto psicómetra y pedagogo. Tu misión es deconstruir varios ítems de evaluación que comparten el mismo texto, siguiendo el estilo y la calidad de los ejemplos proporcionados.
+
+{EJEMPLOS_ANALISIS_PREMIUM}
+
+📖 TEXTO/FRAGMENTO COMPARTIDO POR TODOS LOS ÍTEMS:
+{filas[0].get('ItemContexto', 'No aplica')}
+
+🧠 INSUMOS DE ENTRADA ({len(filas)} ítems que debes analizar por separado):
+{_bloques_items_grupo(filas, lambda fila: _insumos_paso1(fila, incluir_contexto=False))}
+
+
+📝 INSTRUCCIONES
+Para CADA ítem, basándote en los ejemplos de alta calidad, en el texto compartido y en sus insumos, realiza el siguiente proceso en dos fases:
+{instruccion_formateada}
+
+FASE 1: RUTA COGNITIVA
+Describe, en un párrafo continuo y de forma impersonal, el procedimiento mental que un estudiante debe ejecutar para llegar a la respuesta correcta de ese ítem. Usa verbos que representen procesos cognitivos, verifica que la ruta se alinee con la Competencia y la Evidencia del ítem, y termina justificando la elección de la respuesta correcta.
+
+FASE 2: ANÁLISIS DE OPCIONES NO VÁLIDAS
+- Para cada opción incorrecta, identifica la naturaleza del error y explica el razonamiento fallido.
+- Luego, explica el posible razonamiento que lleva al estudiante a cometer ese error.
+- Finalmente, clarifica por qué esa opción es incorrecta en el contexto de la tarea evaluativa.
+
+✍️ FORMATO DE SALIDA
+**REGLA CRÍTICA:** Responde con una sección por ítem, en el mismo orden. Cada sección empieza con su encabezado exacto ({MARCA_ITEM_GRUPO.format(n=1)}, {MARCA_ITEM_GRUPO.format(n=2)}, ...) seguido únicamente de los dos títulos siguientes, sin texto adicional:
+
+Ruta Cognitiva Correcta:
+[Párrafo continuo y detallado.]
+
+Análisis de Opciones No Válidas:
+- **Opción [Letra del distractor]:** El estudiante podría escoger esta opción si comete un error de [naturaleza de la confusión u error], lo que lo lleva a pensar que [razonamiento erróneo]. Sin embargo, esto es incorrecto porque [razón clara y concisa].
+"""
+
+def construir_prompt_paso3_grupo(items, instruccion_adicional=""):
+    """Paso 3 para varios ítems del mismo pasaje; `items` es una lista de (que_evalua, analisis_central, fila)."""
+    items = [(que_evalua, analisis, fila.fillna('')) for que_evalua, analisis, fila in items]
+    instruccion_formateada = f"\n**Instrucción Adicional del Usuario:** {instruccion_adicional}\n" if instruccion_adicional else ""
+    bloques = "\n\n".join(
+        f"{MARCA_ITEM_GRUPO.format(n=n)}\n{_insumos_paso3(que_evalua, analisis, fila, incluir_contexto=False)}"
+        for n, (que_evalua, analisis, fila) in enumerate(items, start=1)
+    )
+    return f"""
+🎯 ROL DEL SISTEMA
+Eres un diseñador instruccional experto y un docente de aula con mucha experiencia. Tu especialidad es crear actividades de lectura que son novedosas, lúdicas y, sobre todo, prácticas y realizables en un salón de clases con recursos limitados.
+
+{EJEMPLOS_RECOMENDACIONES_PREMIUM}
+
+📖 TEXTO/FRAGMENTO COMPARTIDO POR TODOS LOS ÍTEMS (solo como contexto; no lo uses literalmente en las actividades):
+{items[0][2].get('ItemContexto', 'No aplica')}
+
+🧠 INSUMOS DE ENTRADA ({len(items)} ítems, cada uno con sus propias recomendaciones):
+{bloques}
+
+📝 INSTRUCCIONES PARA GENERAR LAS RECOMENDACIONES
+{instruccion_formateada}
+Para CADA ítem genera dos recomendaciones (Fortalecer y Avanzar) que cumplan con estas reglas inviolables:
+1.  **ABSTRACCIÓN DE LA HABILIDAD:** Las actividades se enfocan en la habilidad descrita en 'Qué Evalúa la pregunta' de ese ítem, no en el contenido del texto compartido, y se pueden aplicar a OTROS textos o contextos.
+2.  **VIABILIDAD EN EL AULA:** Cero materiales especiales, cero tareas externas y sin tecnología. La novedad está en la dinámica, no en los recursos.
+3.  **CERO PRODUCCIÓN ESCRITA:** Solo lectura, selección, debate corto, clasificación oral o argumentación.
+4.  **CREATIVIDAD BASADA EN EL ESCENARIO:** Plantea un "mini-mundo" o reto temático concreto e imaginativo; evita escenarios clichés de libro de texto. No repitas el mismo escenario entre ítems.
+5.  **REDACCIÓN IMPERSONAL.**
+
+✍️ FORMATO DE SALIDA
+Responde con una sección por ítem, en el mismo orden. Cada sección empieza con su encabezado exacto ({MARCA_ITEM_GRUPO.format(n=1)}, {MARCA_ITEM_GRUPO.format(n=2)}, ...) seguido de:
+
+RECOMENDACIÓN PARA FORTALECER EL APRENDIZAJE EVALUADO EN la pregunta
+Para fortalecer la habilidad de [verbo clave extraído de la Evidencia de Aprendizaje], se sugiere [estrategia de andamiaje].
+Una actividad que se puede hacer es: [actividad novedosa y creativa, sin escritura].
+Las preguntas orientadoras para esta actividad, entre otras, pueden ser:
+- [Pregunta 1]
+- [Pregunta 2]
+- [Pregunta 3]
+
+RECOMENDACIÓN PARA AVANZAR EN EL APRENDIZAJE EVALUADO EN la pregunta
+Para avanzar desde [proceso cognitivo de Fortalecer] hacia la habilidad de [proceso cognitivo superior], se sugiere [estrategia de complejización].
+Una actividad que se puede hacer es: [actividad estimulante y poco convencional, sin escritura].
+Las preguntas orientadoras para esta actividad, entre otras, pueden ser:
+- [Pregunta 1]
+- [Pregunta 2]
+- [Pregunta 3]
+"""
+
+def dividir_secciones_grupo(texto, n_items):
+    """Separa la respuesta de un prompt agrupado en una lista de `n_items` secciones (None si falta alguna)."""
+    marcas = list(PATRON_MARCA_ITEM_GRUPO.finditer(texto))
+    secciones = [None] * n_items
+    for pos, marca in enumerate(marcas):
+        n = int(marca.group(1))
+        fin = marcas[pos + 1].start() if pos + 1 < len(marcas) else len(texto)
+        if 1 <= n <= n_items:
+            secciones[n - 1] = texto[marca.end():fin].strip()
+    return secciones
+
+# --- CANCELACIÓN ---
+
+class EjecucionCancelada(Exception):
+    """Se canceló la ejecución: no se hacen más llamadas al modelo."""
+
+def comprobar_cancelacion(cancelado):
+    """Lanza EjecucionCancelada si el evento `cancelado` (un threading.Event, o None) está activo."""
+    if cancelado is not None and cancelado.is_set():
+        raise EjecucionCancelada("Ejecución cancelada.")
+
+def es_cancelacion(error):
+    """Un ítem que terminó por la cancelación (directa o dentro de un ErrorPaso) no es un error del ítem."""
+    return isinstance(error, EjecucionCancelada) or isinstance(getattr(error, "causa", None), EjecucionCancelada)
+
+# --- LÍMITE DE CUOTA Y REINTENTOS ---
+
+# Errores de Vertex AI que vale la pena reintentar (cuota agotada y fallos transitorios del servidor).
+ERRORES_REINTENTABLES = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+)
+TOKENS_SALIDA_ESTIMADOS = 1500
+
+def estimar_tokens(texto):
+    """Estimación rápida de tokens (aprox. 4 caracteres por token)."""
+    return len(texto) // 4
+
+class LimitadorAdaptativo:
+    """Token bucket de peticiones/min y tokens/min que se frena ante los 429 observados.
+
+    Cuando hay holgura deja pasar las llamadas sin esperar; tras un 429 reduce su ritmo
+    multiplicativamente y lo recupera poco a poco con cada respuesta exitosa.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.factor = 1.0
+        self._peticiones = float(rpm)
+        self._tokens = float(tpm)
+        self._ultima_recarga = time.monotonic()
+        self._ultimo_429 = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def para_modelo(cls, model_name):
+        """Limitador con la cuota de `model_name`; acepta 'modelo@región' (la cuota de Vertex es por región)."""
+        limites = LIMITES_MODELO.get(model_name.split("@")[0], {"rpm": 60, "tpm": 1_000_000})
+        return cls(limites["rpm"], limites["tpm"])
+
+    def _recargar(self):
+        ahora = time.monotonic()
+        transcurrido = ahora - self._ultima_recarga
+        self._ultima_recarga = ahora
+        self._peticiones = min(self.rpm * self.factor, self._peticiones + transcurrido * self.rpm * self.factor / 60)
+        self._tokens = min(self.tpm * self.factor, self._tokens + transcurrido * self.tpm * self.factor / 60)
+
+    def adquirir(self, tokens_estimados, cancelado=None):
+        """Bloquea hasta que haya cupo para una petición de `tokens_estimados` tokens.
+
+        Si se activa el evento `cancelado` mientras espera, deja de esperar y lanza EjecucionCancelada.
+        """
+        tokens_estimados = min(tokens_estimados, self.tpm * self.factor)
+        while True:
+            comprobar_cancelacion(cancelado)
+            with self._lock:
+                self._recargar()
+                if self._peticiones >= 1 and self._tokens >= tokens_estimados:
+                    self._peticiones -= 1
+                    self._tokens -= tokens_estimados
+                    return
+                espera = max(
+                    (1 - self._peticiones) * 60 / (self.rpm * self.factor),
+                    (tokens_estimados - self._tokens) * 60 / (self.tpm * self.factor),
+                )
+            espera = min(max(espera, 0.01), 5)
+            if cancelado is not None:
+                cancelado.wait(espera)
+            else:
+                time.sleep(espera)
+
+    def holgura(self):
+        """Peticiones que se podrían enviar ahora mismo sin esperar (limitadas también por los tokens libres)."""
+        with self._lock:
+            self._recargar()
+            return max(0.0, min(self._peticiones, self._tokens * self.rpm / self.tpm))
+
+    def ajustar_tokens(self, estimados, reales):
+        """Corrige el bucket con el consumo real reportado por la API."""
+        with self._lock:
+            self._tokens += estimados - reales
+
+    def registrar_exito(self):
+        with self._lock:
+            self.factor = min(1.0, self.factor + 0.01)
+
+    def registrar_limite(self):
+        """Reacciona a un 429: baja el ritmo (una sola vez por ráfaga de errores) y vacía el cupo acumulado."""
+        with self._lock:
+            ahora = time.monotonic()
+            if ahora - self._ultimo_429 > 2:
+                self.factor = max(0.1, self.factor * 0.7)
+                self._ultimo_429 = ahora
+            self._peticiones = min(self._peticiones, 0.0)
+
+# --- CACHÉ DE RESPUESTAS ---
+
+PATRON_RECURSO_REGIONAL = re.compile(r"^projects/[^/]+/locations/[^/]+/")
+
+def nombre_modelo(model):
+    """Nombre del modelo de Vertex AI detrás de un cliente (o del cliente si no lo expone).
+
+    Los modelos creados desde contenido cacheado incluyen el nombre del caché, que lleva el hash del prefijo.
+    """
+    # Sin 'projects/<p>/locations/<región>/': la misma respuesta sirve para cualquier región
+    nombre = PATRON_RECURSO_REGIONAL.sub("", getattr(model, "_model_name", type(model).__name__))
+    contenido_cacheado = getattr(model, "_cached_content", None)
+    if contenido_cacheado is not None:
+        return f"{nombre}@{contenido_cacheado.display_name}"
+    return nombre
+
+class CacheRespuestas:
+    """Caché persistente en SQLite de respuestas de la IA, direccionada por contenido.
+
+    La clave es un hash de (modelo, generation_config, safety_settings, prompt), así que un
+    prompt idéntico nunca se paga dos veces. Cuando supera `max_bytes` elimina las entradas
+    usadas hace más tiempo (LRU).
+    """
+
+    def __init__(self, ruta, max_bytes=500 * 1024 * 1024):
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        self.ruta = ruta
+        self.max_bytes = max_bytes
+        self.aciertos = 0
+        self.fallos = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(ruta, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS respuestas ("
+            "clave TEXT PRIMARY KEY, texto TEXT NOT NULL, tamano INTEGER NOT NULL, ultimo_acceso REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ultimo_acceso ON respuestas (ultimo_acceso)")
+        self._conn.commit()
+        self._tamano_total = self._conn.execute("SELECT COALESCE(SUM(tamano), 0) FROM respuestas").fetchone()[0]
+
+    @staticmethod
+    def clave(model_name, prompt, generation_config=None, safety_settings=None):
+        generation_config = GENERATION_CONFIG if generation_config is None else generation_config
+        safety_settings = SAFETY_SETTINGS if safety_settings is None else safety_settings
+        material = json.dumps(
+            [
+                model_name,
+                generation_config,
+                sorted((str(k), str(v)) for k, v in safety_settings.items()),
+                prompt,
+            ],
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str,
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def obtener(self, clave):
+        with self._lock:
+            fila = self._conn.execute("SELECT texto FROM respuestas WHERE clave = ?", (clave,)).fetchone()
+            if fila is None:
+                self.fallos += 1
+                return None
+            self.aciertos += 1
+            self._conn.execute("UPDATE respuestas SET ultimo_acceso = ? WHERE clave = ?", (time.time(), clave))
+            self._conn.commit()
+            return fila[0]
+
+    def guardar(self, clave, texto):
+        tamano = len(texto.encode("utf-8"))
+        with self._lock:
+            anterior = self._conn.execute("SELECT tamano FROM respuestas WHERE clave = ?", (clave,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO respuestas (clave, texto, tamano, ultimo_acceso) VALUES (?, ?, ?, ?)",
+                (clave, texto, tamano, time.time()),
+            )
+            self._tamano_total += tamano - (anterior[0] if anterior else 0)
+            self._desalojar()
+            self._conn.commit()
+
+    def _desalojar(self):
+        while self._tamano_total > self.max_bytes:
+            lote = self._conn.execute(
+                "SELECT clave, tamano FROM respuestas ORDER BY ultimo_acceso LIMIT 100"
+            ).fetchall()
+            if not lote:
+                self._tamano_total = 0
+                return
+            for clave, tamano in lote:
+                self._conn.execute("DELETE FROM respuestas WHERE clave = ?", (clave,))
+                self._tamano_total -= tamano
+                if self._tamano_total <= self.max_bytes:
+                    return
+
+    def vaciar(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM respuestas")
+            self._conn.commit()
+            self._tamano_total = 0
+
+    def reiniciar_contadores(self):
+        with self._lock:
+            self.aciertos = 0
+            self.fallos = 0
+
+    @property
+    def tamano_mb(self):
+        return self._tamano_total / (1024 * 1024)
+
+# --- VALIDACIÓN DE RESPUESTAS ---
+
+def validar_paso1(texto):
+    if texto.find("Análisis de Opciones No Válidas:") == -1:
+        raise ValueError("La respuesta de la IA (Paso 1) no contiene el separador 'Análisis de Opciones No Válidas'.")
+
+def validar_paso3(texto):
+    if texto.upper().find("RECOMENDACIÓN PARA AVANZAR") == -1:
+        raise ValueError("La respuesta de la IA (Paso 3) no contiene el separador 'RECOMENDACIÓN PARA AVANZAR'.")
+
+def validar_respuesta_unica(texto):
+    datos = json.loads(texto)
+    faltantes = [col for col in COLUMNAS_NUEVAS if not isinstance(datos.get(col), str) or not datos[col].strip()]
+    if faltantes:
+        raise ValueError(f"La respuesta de la IA (llamada única) no trae las columnas: {', '.join(faltantes)}.")
+
+def estimar_costo(modelo, tokens_entrada, tokens_salida, tokens_cacheados=0):
+    """Costo estimado en USD de una llamada según PRECIOS_MODELO (0 si el modelo no tiene precio)."""
+    precios = PRECIOS_MODELO.get(modelo)
+    if not precios:
+        return 0.0
+    tokens_cacheados = min(tokens_cacheados, tokens_entrada)
+    return (
+        (tokens_entrada - tokens_cacheados) * precios["entrada"]
+        + tokens_cacheados * precios["entrada"] * FACTOR_PRECIO_TOKENS_CACHEADOS
+        + tokens_salida * precios["salida"]
+    ) / 1_000_000
+
+def registrar_uso(uso, response, segundos, model=None, paso=None, reintentos=0, segundos_totales=None,
+                  primer_fragmento_s=None, abortada=False):
+    """Acumula en `uso` los tokens, la latencia y el costo de una llamada al modelo.
+
+    Además agrega a `uso["llamadas_detalle"]` un registro de la llamada (paso, modelo, tokens,
+    latencia del intento que respondió, tiempo total con esperas y reintentos, y costo estimado).
+    En streaming se registra también el tiempo hasta el primer fragmento y si la respuesta se cortó.
+    """
+    if uso is None:
+        return
+    metadata = getattr(response, "usage_metadata", None)
+    tokens_entrada = getattr(metadata, "prompt_token_count", 0) or 0
+    tokens_salida = getattr(metadata, "candidates_token_count", 0) or 0
+    tokens_cacheados = getattr(metadata, "cached_content_token_count", 0) or 0
+    modelo = nombre_corto_modelo(model).split("@")[0] if model is not None else None
+    costo = estimar_costo(modelo, tokens_entrada, tokens_salida, tokens_cacheados)
+    uso["llamadas"] = uso.get("llamadas", 0) + 1
+    uso["reintentos"] = uso.get("reintentos", 0) + reintentos
+    uso["latencia_modelo_s"] = uso.get("latencia_modelo_s", 0.0) + segundos
+    uso["tokens_entrada"] = uso.get("tokens_entrada", 0) + tokens_entrada
+    uso["tokens_salida"] = uso.get("tokens_salida", 0) + tokens_salida
+    uso["costo_usd"] = uso.get("costo_usd", 0.0) + costo
+    uso["abortos"] = uso.get("abortos", 0) + int(abortada)
+    uso.setdefault("llamadas_detalle", []).append({
+        "paso": paso,
+        "modelo": modelo,
+        "tokens_entrada": tokens_entrada,
+        "tokens_salida": tokens_salida,
+        "tokens_cacheados": tokens_cacheados,
+        "latencia_s": segundos,
+        "duracion_total_s": segundos if segundos_totales is None else segundos_totales,
+        "reintentos": reintentos,
+        "costo_usd": costo,
+        "primer_fragmento_s": primer_fragmento_s,
+        "abortada": abortada,
+    })
+
+# --- RESPUESTAS EN STREAMING ---
+
+# Estructura que debe mostrar la respuesta de cada paso mientras llega: `inicio` es el título con el que
+# empieza, `separador` el que debe aparecer antes de `separador_antes_de` caracteres y `max_caracteres`
+# el presupuesto de largo (las respuestas normales rondan los 2.000-4.000 caracteres).
+FORMATO_STREAMING = {
+    1: {"inicio": "Ruta Cognitiva Correcta:", "separador": "Análisis de Opciones No Válidas:", "separador_antes_de": 8000,
+        "max_caracteres": 12000},
+    2: {"inicio": "Este ítem evalúa", "max_caracteres": 600},
+    3: {"separador": "RECOMENDACIÓN PARA AVANZAR", "separador_antes_de": 8000, "max_caracteres": 12000},
+}
+MAX_ABORTOS_STREAMING = 2
+
+class RespuestaAbortada(ValueError):
+    """Respuesta en streaming cortada porque rompió el formato esperado o superó el presupuesto de largo."""
+
+    def __init__(self, mensaje, texto="", respuesta=None):
+        super().__init__(mensaje)
+        self.texto = texto
+        self.respuesta = respuesta
+
+def validador_parcial(paso):
+    """Validador del texto recibido hasta el momento: lanza RespuestaAbortada en cuanto ya no puede terminar bien."""
+    formato = FORMATO_STREAMING[paso]
+    inicio = formato.get("inicio", "").upper()
+    separador = formato.get("separador", "").upper()
+
+    def validar(texto):
+        if len(texto) > formato["max_caracteres"]:
+            raise RespuestaAbortada(f"La respuesta (Paso {paso}) superó el presupuesto de {formato['max_caracteres']} caracteres.")
+        recibido = texto.lstrip(" \t\r\n*#\"'").upper()[:len(inicio)]
+        if inicio and recibido and not inicio.startswith(recibido):
+            raise RespuestaAbortada(f"La respuesta (Paso {paso}) no empieza con '{formato['inicio']}'.")
+        if separador and len(texto) > formato["separador_antes_de"] and separador not in texto.upper():
+            raise RespuestaAbortada(
+                f"La respuesta (Paso {paso}) no trae '{formato['separador']}' en los primeros {formato['separador_antes_de']} caracteres."
+            )
+    return validar
+
+class Streaming:
+    """Pide las respuestas en streaming para validarlas mientras llegan y cortar las que se desvían.
+
+    `al_fragmento(indices, paso, texto)` recibe el texto acumulado de cada respuesta y
+    `al_abortar(indices, paso, motivo)` cada respuesta cortada; `para(indices)` liga esos avisos
+    a los ítems de una unidad de trabajo. Una respuesta cortada se vuelve a pedir hasta `max_abortos` veces.
+    """
+
+    def __init__(self, al_fragmento=None, al_abortar=None, max_abortos=MAX_ABORTOS_STREAMING, indices=()):
+        self.al_fragmento = al_fragmento
+        self.al_abortar = al_abortar
+        self.max_abortos = max_abortos
+        self.indices = tuple(indices)
+
+    def para(self, indices):
+        return Streaming(self.al_fragmento, self.al_abortar, self.max_abortos, indices)
+
+    def fragmento(self, paso, texto):
+        if self.al_fragmento:
+            self.al_fragmento(self.indices, paso, texto)
+
+    def abortar(self, paso, motivo):
+        if self.al_abortar:
+            self.al_abortar(self.indices, paso, motivo)
+
+def _texto_fragmento(respuesta):
+    try:
+        return respuesta.text
+    except ValueError:  # Fragmento sin texto (p. ej. el último, que solo trae metadatos)
+        return ""
+
+def _leer_streaming(model, prompt, generation_config, streaming, paso=None, validar_parcial=None):
+    """Consume una respuesta en streaming; retorna (texto, último fragmento, segundos hasta el primer fragmento).
+
+    Si `validar_parcial` rechaza el texto acumulado se cierra la conexión y se lanza RespuestaAbortada
+    con lo recibido y un uso de tokens (el reportado por Vertex o, si aún no llegó, uno estimado).
+    """
+    inicio = time.monotonic()
+    if generation_config is None:
+        fragmentos = model.generate_content(prompt, stream=True)
+    else:
+        fragmentos = model.generate_content(prompt, generation_config=GenerationConfig(**generation_config), stream=True)
+    partes, ultimo, primer_fragmento_s = [], None, None
+    try:
+        for ultimo in fragmentos:
+            parte = _texto_fragmento(ultimo)
+            if not parte:
+                continue
+            if primer_fragmento_s is None:
+                primer_fragmento_s = time.monotonic() - inicio
+            partes.append(parte)
+            texto = "".join(partes)
+            streaming.fragmento(paso, texto)
+            if validar_parcial:
+                validar_parcial(texto)
+    except RespuestaAbortada as e:
+        e.texto = "".join(partes)
+        e.respuesta = ultimo
+        if not getattr(getattr(ultimo, "usage_metadata", None), "prompt_token_count", 0):
+            e.respuesta = SimpleNamespace(usage_metadata=SimpleNamespace(
+                prompt_token_count=estimar_tokens(prompt), candidates_token_count=estimar_tokens(e.texto),
+            ))
+        raise
+    finally:
+        if hasattr(fragmentos, "close"):
+            fragmentos.close()
+    texto = "".join(partes)
+    if not texto:
+        raise ValueError(f"La respuesta en streaming (Paso {paso}) llegó vacía o fue bloqueada.")
+    return texto, ultimo, primer_fragmento_s
+
+def generar_texto(model, prompt, limitador=None, cache=None, validar=None, generation_config=None, uso=None, max_reintentos=6,
+                  paso=None, streaming=None, validar_parcial=None, cancelado=None):
+    """Llama al modelo respetando el limitador y reintenta los errores transitorios con backoff exponencial y jitter.
+
+    Si se pasa una `cache`, primero busca el prompt ahí; solo se guardan respuestas que pasan `validar`.
+    `generation_config` reemplaza la configuración del modelo para esta llamada y `uso` acumula tokens,
+    latencia y costo (`paso` etiqueta el registro de la llamada). Con `streaming` (un Streaming) la
+    respuesta se lee por fragmentos y se corta y se vuelve a pedir en cuanto `validar_parcial` la rechaza.
+    Con `cancelado` activo no se hace ninguna llamada más (se lanza EjecucionCancelada).
+    """
+    clave = CacheRespuestas.clave(nombre_modelo(model), prompt, generation_config) if cache else None
+    if clave:
+        texto = cache.obtener(clave)
+        if texto is not None:
+            return texto
+
+    inicio_total = time.monotonic()
+    abortos = 0
+    for intento in range(max_reintentos + 1):
+        tokens_estimados = estimar_tokens(prompt) + TOKENS_SALIDA_ESTIMADOS
+        comprobar_cancelacion(cancelado)
+        if limitador:
+            limitador.adquirir(tokens_estimados, cancelado)
+        texto, primer_fragmento_s = None, None
+        try:
+            inicio = time.monotonic()
+            if streaming is not None:
+                texto, response, primer_fragmento_s = _leer_streaming(model, prompt, generation_config, streaming, paso, validar_parcial)
+            elif generation_config is None:
+                response = model.generate_content(prompt)
+            else:
+                response = model.generate_content(prompt, generation_config=GenerationConfig(**generation_config))
+        except ERRORES_REINTENTABLES as e:
+            if limitador and isinstance(e, google_exceptions.TooManyRequests):
+                limitador.registrar_limite()
+            if intento == max_reintentos:
+                raise
+            espera = random.uniform(0, min(60, 2 ** intento))
+            if cancelado is not None:
+                cancelado.wait(espera)
+            else:
+                time.sleep(espera)
+            continue
+        except RespuestaAbortada as e:
+            # La respuesta cortada también consumió tokens; se vuelve a pedir sin esperar
+            fin = time.monotonic()
+            registrar_uso(uso, e.respuesta, fin - inicio, model, paso, reintentos=intento, segundos_totales=fin - inicio_total,
+                          abortada=True)
+            streaming.abortar(paso, str(e))
+            abortos += 1
+            if abortos > streaming.max_abortos or intento == max_reintentos:
+                raise
+            continue
+
+        fin = time.monotonic()
+        registrar_uso(uso, response, fin - inicio, model, paso, reintentos=intento, segundos_totales=fin - inicio_total,
+                      primer_fragmento_s=primer_fragmento_s)
+        if limitador:
+            limitador.registrar_exito()
+            metadata = getattr(response, "usage_metadata", None)
+            if metadata is not None and getattr(metadata, "total_token_count", 0):
+                limitador.ajustar_tokens(tokens_estimados, metadata.total_token_count)
+        texto = (texto if texto is not None else response.text).strip()
+        if validar:
+            validar(texto)
+        if clave:
+            cache.guardar(clave, texto)
+        return texto
+
+# --- CONTEXT CACHING DE VERTEX (PREFIJOS FEW-SHOT) ---
+
+PREFIJOS_ESTATICOS = {1: PREFIJO_PASO1, 3: PREFIJO_PASO3}
+
+def nombre_corto_modelo(model):
+    """'publishers/google/models/gemini-2.5-pro' -> 'gemini-2.5-pro'."""
+    return nombre_modelo(model).rsplit("/", 1)[-1]
+
+def crear_contenido_cacheado(project_id, location, model_name, texto, ttl, display_name):
+    """Como caching.CachedContent.create, pero en `location` y sin depender de vertexai.init.
+
+    CachedContent.create toma la región de la configuración global del proceso; aquí la solicitud y
+    el cliente se fijan a la región del modelo que va a usar el prefijo.
+    """
+    solicitud = CreateCachedContentRequest(
+        parent=f"projects/{project_id}/locations/{location}",
+        cached_content=GapicCachedContent(
+            model=f"projects/{project_id}/locations/{location}/publishers/google/models/{model_name}",
+            contents=[GapicContent(role="user", parts=[GapicPart(text=texto)])],
+            ttl=ttl,
+            display_name=display_name,
+        ),
+    )
+    recurso = caching.CachedContent._instantiate_client(location=location).create_cached_content(solicitud)
+    # Con el nombre completo, el cliente del objeto (update/delete) queda en la misma región
+    return caching.CachedContent(recurso.name)
+
+def region_modelo(model):
+    """Región a la que está fijado un cliente creado con setup_model, o None si no se sabe."""
+    coincidencia = re.match(r"projects/[^/]+/locations/([^/]+)/", getattr(model, "_model_name", ""))
+    return coincidencia.group(1) if coincidencia else None
+
+class ContextoFewShotCacheado:
+    """Prefijos estáticos de los pasos 1 y 3 guardados como cached content de Vertex durante una ejecución.
+
+    `modelos` es un nombre de modelo o un dict {paso: [nombres]} (cuando cada paso usa modelos
+    distintos): el cached content está ligado a un modelo y a una región, así que se crea uno por
+    (paso, modelo, región) en cada una de `regiones`. Se crean al entrar (`with`), se les extiende
+    el TTL si la ejecución dura más de lo previsto y se eliminan al salir. Si Vertex rechaza un
+    prefijo (p. ej. por debajo del mínimo de tokens cacheables) en todas las regiones, ese paso
+    sigue enviando el prompt completo.
+    """
+
+    def __init__(self, modelos, project_id, regiones, ttl_minutos=60):
+        if isinstance(modelos, str):
+            modelos = {paso: [modelos] for paso in PREFIJOS_ESTATICOS}
+        self.modelos = {paso: list(dict.fromkeys(modelos.get(paso, []))) for paso in PREFIJOS_ESTATICOS}
+        self.project_id = project_id
+        self.regiones = list(dict.fromkeys([regiones] if isinstance(regiones, str) else regiones))
+        self.ttl = timedelta(minutes=ttl_minutos)
+        self.errores = {}
+        self._cacheados = {}
+        self._modelos = {}
+        self._vence = 0.0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        for paso, nombres in self.modelos.items():
+            prefijo = PREFIJOS_ESTATICOS[paso]
+            huella = hashlib.sha256(prefijo.encode("utf-8")).hexdigest()[:12]
+            for model_name in nombres:
+                for region in self.regiones:
+                    try:
+                        cacheado = crear_contenido_cacheado(
+                            self.project_id, region, model_name, prefijo, self.ttl, f"fichas-paso{paso}-{huella}"
+                        )
+                    except Exception as e:  # Prefijo bajo el mínimo cacheable, permisos, región sin soporte...
+                        self.errores[(paso, f"{model_name}@{region}")] = str(e)
+                        continue
+                    self._cacheados[(paso, model_name, region)] = cacheado
+                    self._modelos[(paso, model_name, region)] = GenerativeModelPreview.from_cached_content(
+                        cacheado, generation_config=GENERATION_CONFIG, safety_settings=SAFETY_SETTINGS
+                    )
+        self._vence = time.monotonic() + self.ttl.total_seconds()
+        return self
+
+    def __exit__(self, *exc):
+        for cacheado in self._cacheados.values():
+            try:
+                cacheado.delete()
+            except google_exceptions.GoogleAPICallError:
+                pass  # Si no se puede borrar, Vertex lo elimina al vencer el TTL
+        self._cacheados.clear()
+        self._modelos.clear()
+        return False
+
+    def _renovar_si_vence(self):
+        with self._lock:
+            if time.monotonic() < self._vence - 300:
+                return
+            for cacheado in self._cacheados.values():
+                cacheado.update(ttl=self.ttl)
+            self._vence = time.monotonic() + self.ttl.total_seconds()
+
+    def modelos_por_region(self, paso, model_name):
+        """{región: modelo ligado al prefijo cacheado del paso para `model_name`} (vacío si no está cacheado)."""
+        modelos = {region: m for (p, nombre, region), m in self._modelos.items() if p == paso and nombre == model_name}
+        if modelos:
+            self._renovar_si_vence()
+        return modelos
+
+    @property
+    def cacheados(self):
+        return sorted((paso, f"{nombre}@{region}") for paso, nombre, region in self._modelos)
+
+def _modelo_y_prompt(model, contexto_fewshot, paso, construir_prompt, *args):
+    """Usa el modelo ligado al prefijo cacheado del paso si existe; si no, el modelo base con el prompt completo.
+
+    Con un PoolRegiones, la llamada cacheada sigue pasando por el pool, restringido a las regiones
+    que tienen el prefijo cacheado: cada región usa su propio prefijo y su propio limitador.
+    """
+    cacheados = contexto_fewshot.modelos_por_region(paso, nombre_corto_modelo(model)) if contexto_fewshot else {}
+    if isinstance(model, PoolRegiones):
+        cacheados = {region: m for region, m in cacheados.items() if region in model.modelos}
+        if cacheados:
+            return model.con_modelos(cacheados), construir_prompt(*args, incluir_prefijo=False)
+    elif region_modelo(model) in cacheados:
+        return cacheados[region_modelo(model)], construir_prompt(*args, incluir_prefijo=False)
+    return model, construir_prompt(*args)
+
+# --- POOL DE CLIENTES MULTIRREGIÓN ---
+
+# Regiones adicionales de Vertex AI entre las que se reparte la carga (separadas por comas)
+REGIONES_ADICIONALES = [region.strip() for region in os.environ.get("GCP_REGIONES", "").split(",") if region.strip()]
+# Una región que acumula estos 429/503 seguidos sale del reparto durante PAUSA_REGION_S segundos
+MAX_FALLOS_SEGUIDOS_REGION = 3
+PAUSA_REGION_S = 60
+
+class PoolRegiones:
+    """Un mismo modelo en varias regiones de Vertex AI, usado como si fuera un solo modelo.
+
+    Cada llamada va a la región con más cupo libre según su limitador (la cuota de Vertex es por
+    región y modelo); ante un 429/503 se prueba de inmediato otra región (en streaming, mientras no
+    haya llegado ningún fragmento), y una región con fallos sostenidos queda en pausa un tiempo. Lleva
+    por región llamadas, errores y throughput observado. Las llamadas en streaming se cuentan al terminar de leerse.
+    """
+
+    def __init__(self, modelos, limitadores=None, max_fallos_seguidos=MAX_FALLOS_SEGUIDOS_REGION, pausa_s=PAUSA_REGION_S):
+        self.modelos = modelos
+        self.regiones = list(modelos)
+        self.limitadores = limitadores or {}
+        self.max_fallos_seguidos = max_fallos_seguidos
+        self.pausa_s = pausa_s
+        self._model_name = nombre_modelo(next(iter(modelos.values())))
+        self._estado = {
+            region: {"llamadas": 0, "errores_429": 0, "errores_5xx": 0, "fallos_seguidos": 0, "pausada_hasta": 0.0,
+                     "en_curso": 0, "tokens": 0, "latencia_total_s": 0.0, "primera": None, "ultima": None}
+            for region in self.regiones
+        }
+        self._lock = threading.Lock()
+
+    @classmethod
+    def crear(cls, project_id, regiones, model_name, limitador_de=LimitadorAdaptativo.para_modelo):
+        """Pool de `model_name` en `regiones`; `limitador_de('modelo@región')` da el limitador de cada región."""
+        return cls(
+            {region: setup_model(project_id, region, model_name) for region in regiones},
+            {region: limitador_de(f"{model_name}@{region}") for region in regiones},
+        )
+
+    def con_modelos(self, modelos):
+        """Vista del pool que llama a `modelos` ({región: modelo}, p. ej. los ligados a un prefijo cacheado)
+        en esas regiones, compartiendo con el pool el estado, los limitadores y las estadísticas."""
+        vista = copy.copy(self)
+        vista.modelos = modelos
+        # Mismo nombre que los modelos cacheados (lleva el hash del prefijo), para la caché de respuestas y la telemetría
+        vista._model_name = nombre_modelo(next(iter(modelos.values())))
+        vista.regiones = [region for region in self.regiones if region in modelos]
+        return vista
+
+    def _elegir(self, descartadas):
+        """Región disponible con más holgura de cuota; si todas están en pausa, la que sale antes."""
+        ahora = time.monotonic()
+        with self._lock:
+            candidatas = [r for r in self.regiones if r not in descartadas]
+            activas = [r for r in candidatas if self._estado[r]["pausada_hasta"] <= ahora]
+            if not activas:
+                region = min(candidatas, key=lambda r: self._estado[r]["pausada_hasta"])
+            else:
+                holgura = {r: self.limitadores[r].holgura() if r in self.limitadores else 0.0 for r in activas}
+                region = max(activas, key=lambda r: (holgura[r], -self._estado[r]["en_curso"], -(self._estado[r]["ultima"] or 0.0)))
+            self._estado[region]["en_curso"] += 1
+            return region
+
+    def _terminar(self, region, respuesta, segundos):
+        limitador = self.limitadores.get(region)
+        metadata = getattr(respuesta, "usage_metadata", None)
+        tokens = getattr(metadata, "total_token_count", 0) or 0
+        if limitador:
+            limitador.registrar_exito()
+        with self._lock:
+            estado = self._estado[region]
+            estado["en_curso"] -= 1
+            estado["llamadas"] += 1
+            estado["fallos_seguidos"] = 0
+            estado["tokens"] += tokens
+            estado["latencia_total_s"] += segundos
+            estado["ultima"] = time.monotonic()
+            estado["primera"] = estado["primera"] or estado["ultima"] - segundos
+
+    def _fallar(self, region, error):
+        limitador = self.limitadores.get(region)
+        es_429 = isinstance(error, google_exceptions.TooManyRequests)
+        if limitador and es_429:
+            limitador.registrar_limite()
+        with self._lock:
+            estado = self._estado[region]
+            estado["en_curso"] -= 1
+            estado["errores_429" if es_429 else "errores_5xx"] += 1
+            estado["fallos_seguidos"] += 1
+            if estado["fallos_seguidos"] >= self.max_fallos_seguidos:
+                estado["pausada_hasta"] = time.monotonic() + self.pausa_s
+                estado["fallos_seguidos"] = 0
+
+    def _liberar(self, region):
+        with self._lock:
+            self._estado[region]["en_curso"] -= 1
+
+    def generate_content(self, prompt, **kwargs):
+        """Como GenerativeModel.generate_content, con conmutación de región ante 429/503."""
+        tokens_estimados = estimar_tokens(prompt) + TOKENS_SALIDA_ESTIMADOS
+        if kwargs.get("stream"):
+            return self._generar_streaming(prompt, tokens_estimados, kwargs)
+        descartadas = set()
+        while True:
+            region = self._elegir(descartadas)
+            if region in self.limitadores:
+                self.limitadores[region].adquirir(tokens_estimados)
+            inicio = time.monotonic()
+            try:
+                respuesta = self.modelos[region].generate_content(prompt, **kwargs)
+            except ERRORES_REINTENTABLES as e:
+                self._fallar(region, e)
+                descartadas.add(region)
+                if len(descartadas) == len(self.regiones):
+                    raise
+                continue
+            except Exception:
+                self._liberar(region)
+                raise
+            self._terminar(region, respuesta, time.monotonic() - inicio)
+            return respuesta
+
+    def _generar_streaming(self, prompt, tokens_estimados, kwargs):
+        """Entrega los fragmentos de una respuesta en streaming con la misma conmutación de región.
+
+        Un 429/503 al pedir la respuesta o durante su lectura cuenta como fallo de la región. Si aún no
+        se entregó ningún fragmento, se pide de nuevo en otra región; si ya se entregaron, el error
+        sube a generar_texto (que reintenta desde cero) porque el texto recibido no se puede retomar.
+        """
+        descartadas = set()
+        while True:
+            region = self._elegir(descartadas)
+            if region in self.limitadores:
+                self.limitadores[region].adquirir(tokens_estimados)
+            inicio = time.monotonic()
+            fragmentos, ultimo, entregados = None, None, False
+            try:
+                fragmentos = self.modelos[region].generate_content(prompt, **kwargs)
+                for ultimo in fragmentos:
+                    entregados = True
+                    yield ultimo
+            except ERRORES_REINTENTABLES as e:
+                self._fallar(region, e)
+                descartadas.add(region)
+                if entregados or len(descartadas) == len(self.regiones):
+                    raise
+                continue
+            except BaseException:  # Incluye el cierre anticipado de una respuesta cortada
+                self._liberar(region)
+                raise
+            finally:
+                if hasattr(fragmentos, "close"):
+                    fragmentos.close()
+            self._terminar(region, ultimo, time.monotonic() - inicio)
+            return
+
+    def estadisticas(self):
+        """Filas por región: estado, llamadas, errores, llamadas/min y tokens/min observados, latencia media y holgura."""
+        ahora = time.monotonic()
+        with self._lock:
+            estados = {region: dict(estado) for region, estado in self._estado.items()}
+        filas = []
+        for region, e in estados.items():
+            minutos = (e["ultima"] - e["primera"]) / 60 if e["primera"] is not None and e["ultima"] > e["primera"] else None
+            filas.append({
+                "region": region,
+                "estado": f"en pausa ({e['pausada_hasta'] - ahora:.0f} s)" if e["pausada_hasta"] > ahora else "activa",
+                "llamadas": e["llamadas"],
+                "errores_429": e["errores_429"],
+                "errores_5xx": e["errores_5xx"],
+                "llamadas_por_min": e["llamadas"] / minutos if minutos else None,
+                "tokens_por_min": e["tokens"] / minutos if minutos else None,
+                "latencia_media_s": e["latencia_total_s"] / e["llamadas"] if e["llamadas"] else None,
+                "holgura": self.limitadores[region].holgura() if region in self.limitadores else None,
+            })
+        return filas
+
+# --- ENRUTAMIENTO DE MODELOS POR PASO ---
+
+def validar_formato_paso1(texto):
+    """Validador más estricto que decide si una respuesta de un modelo económico debe escalarse."""
+    validar_paso1(texto)
+    if not texto.lstrip().startswith("Ruta Cognitiva Correcta:"):
+        raise ValueError("La respuesta (Paso 1) no empieza con 'Ruta Cognitiva Correcta:'.")
+    idx_distractores = texto.find("Análisis de Opciones No Válidas:")
+    if len(texto[:idx_distractores].strip()) < 200:
+        raise ValueError("La Ruta Cognitiva (Paso 1) es demasiado corta.")
+    if len(re.findall(r"Opci[oó]n\s+[A-D]", texto[idx_distractores:])) < 2:
+        raise ValueError("El Análisis de Opciones No Válidas (Paso 1) no cubre los distractores.")
+
+def validar_formato_paso2(texto):
+    if not texto.lower().startswith("este ítem evalúa"):
+        raise ValueError("El 'Qué Evalúa' (Paso 2) no empieza con 'Este ítem evalúa'.")
+    if len(texto) > 400 or "\n" in texto.strip():
+        raise ValueError("El 'Qué Evalúa' (Paso 2) no es una única frase breve.")
+
+def validar_formato_paso3(texto):
+    validar_paso3(texto)
+    if "RECOMENDACIÓN PARA FORTALECER" not in texto.upper():
+        raise ValueError("La respuesta (Paso 3) no contiene 'RECOMENDACIÓN PARA FORTALECER'.")
+    if len(texto) < 600:
+        raise ValueError("Las recomendaciones (Paso 3) son demasiado cortas.")
+
+VALIDADORES_CASCADA = {1: validar_formato_paso1, 2: validar_formato_paso2, 3: validar_formato_paso3}
+
+def modelos_cascada(model_name):
+    """Modelos desde el más económico hasta `model_name` (MODEL_OPTIONS va del más potente al más económico)."""
+    por_costo = list(reversed(list(MODEL_OPTIONS.values())))
+    if model_name not in por_costo:
+        return [model_name]
+    return por_costo[:por_costo.index(model_name) + 1]
+
+class EnrutadorModelos:
+    """Asigna a cada paso una cadena de modelos: el primero que produce una respuesta válida gana.
+
+    Sin cascada la cadena tiene un solo modelo. Con cascada se prueba primero el más económico
+    y se escala al siguiente solo si la respuesta no pasa el validador de formato del paso.
+    Cada modelo tiene su propio limitador de cuota y se registran por paso las llamadas,
+    escalamientos y latencias.
+    """
+
+    def __init__(self, cadenas, limitadores=None):
+        self.cadenas = cadenas
+        self.limitadores = limitadores or {}
+        self._estadisticas = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def unico(cls, model, limitador=None):
+        return cls({paso: [model] for paso in (1, 2, 3)}, {nombre_corto_modelo(model): limitador} if limitador else {})
+
+    def cadena(self, paso):
+        return self.cadenas[paso]
+
+    def limitador(self, model):
+        return self.limitadores.get(nombre_corto_modelo(model))
+
+    def limitador_llamada(self, model, limitador=None):
+        """Limitador de una llamada: un PoolRegiones (también con prefijo cacheado) aplica el de cada región por su cuenta."""
+        if isinstance(model, PoolRegiones):
+            return None
+        return self.limitador(model) or limitador
+
+    def nombres_por_paso(self):
+        return {paso: [nombre_corto_modelo(m) for m in modelos] for paso, modelos in self.cadenas.items()}
+
+    def registrar(self, paso, model, segundos, escalado):
+        with self._lock:
+            registro = self._estadisticas.setdefault(
+                (paso, nombre_corto_modelo(model)), {"llamadas": 0, "escalados": 0, "latencia_total_s": 0.0}
+            )
+            registro["llamadas"] += 1
+            registro["escalados"] += int(escalado)
+            registro["latencia_total_s"] += segundos
+
+    def estadisticas(self):
+        """Tabla por paso y modelo con llamadas, tasa de escalamiento y latencia media."""
+        with self._lock:
+            filas = [
+                {
+                    "paso": paso,
+                    "modelo": modelo,
+                    "llamadas": r["llamadas"],
+                    "escalados": r["escalados"],
+                    "tasa_escalado": r["escalados"] / r["llamadas"] if r["llamadas"] else 0.0,
+                    "latencia_media_s": r["latencia_total_s"] / r["llamadas"] if r["llamadas"] else 0.0,
+                }
+                for (paso, modelo), r in sorted(self._estadisticas.items())
+            ]
+        return pd.DataFrame(filas)
+
+    def estadisticas_regiones(self):
+        """Filas por modelo y región de los PoolRegiones del enrutador (vacío si todo va a una sola región)."""
+        pools = {id(m): m for modelos in self.cadenas.values() for m in modelos if isinstance(m, PoolRegiones)}
+        return [
+            {"modelo": nombre_corto_modelo(pool), **fila}
+            for pool in pools.values()
+            for fila in pool.estadisticas()
+        ]
+
+def crear_enrutador(project_id, location, modelos_por_paso, cascada=False, limitador_de=LimitadorAdaptativo.para_modelo,
+                    regiones_adicionales=()):
+    """Construye el enrutador a partir de {paso: nombre de modelo}; con `cascada`, cada paso parte del modelo más económico.
+
+    `limitador_de(nombre)` da el limitador de cada modelo (por defecto, uno nuevo por modelo). Con
+    `regiones_adicionales` cada modelo es un PoolRegiones sobre `location` y esas regiones, con un
+    limitador por región (`limitador_de('modelo@región')`).
+    """
+    cadenas = {paso: modelos_cascada(nombre) if cascada else [nombre] for paso, nombre in modelos_por_paso.items()}
+    regiones = list(dict.fromkeys([location, *regiones_adicionales]))
+    modelos = {}
+    limitadores = {}
+    for nombre in dict.fromkeys(n for nombres in cadenas.values() for n in nombres):
+        if len(regiones) > 1:
+            modelos[nombre] = PoolRegiones.crear(project_id, regiones, nombre, limitador_de)
+        else:
+            modelos[nombre] = setup_model(project_id, location, nombre)
+            limitadores[nombre] = limitador_de(nombre)
+    return EnrutadorModelos(
+        {paso: [modelos[n] for n in nombres] for paso, nombres in cadenas.items()},
+        limitadores,
+    )
+
+def _como_enrutador(model, limitador=None):
+    return model if isinstance(model, EnrutadorModelos) else EnrutadorModelos.unico(model, limitador)
+
+def _registrar_latencia_paso(uso, paso, segundos):
+    """Acumula en `uso["latencia_pasos_s"]` el tiempo de cada paso (incluidos los escalamientos)."""
+    if uso is not None:
+        latencias = uso.setdefault("latencia_pasos_s", {})
+        latencias[paso] = latencias.get(paso, 0.0) + segundos
+
+def generar_paso(model, paso, construir_prompt, args, validar=None, validar_cascada=None, limitador=None, cache=None,
+                 uso=None, contexto_fewshot=None, generation_config=None, streaming=None, validar_parcial=None, cancelado=None):
+    """Genera la respuesta de un paso recorriendo la cadena de modelos asignada a ese paso.
+
+    `model` puede ser un modelo o un EnrutadorModelos. Los modelos intermedios de la cadena se
+    validan con `validar_cascada` (por defecto `validar`); el último, solo con `validar`. Con
+    `streaming`, `validar_parcial` revisa la respuesta mientras llega (ver generar_texto).
+    """
+    enrutador = _como_enrutador(model, limitador)
+    cadena = enrutador.cadena(paso)
+    for nivel, modelo in enumerate(cadena):
+        ultimo = nivel == len(cadena) - 1
+        modelo_efectivo, prompt = _modelo_y_prompt(modelo, contexto_fewshot, paso, construir_prompt, *args)
+        inicio = time.monotonic()
+        try:
+            texto = generar_texto(
+                modelo_efectivo, prompt, enrutador.limitador_llamada(modelo, limitador), cache,
+                validar=validar if ultimo else (validar_cascada or validar),
+                generation_config=generation_config, uso=uso, paso=paso, streaming=streaming, validar_parcial=validar_parcial,
+                cancelado=cancelado,
+            )
+        except ValueError:
+            _registrar_latencia_paso(uso, paso, time.monotonic() - inicio)
+            enrutador.registrar(paso, modelo, time.monotonic() - inicio, escalado=not ultimo)
+            if ultimo:
+                raise
+            continue
+        _registrar_latencia_paso(uso, paso, time.monotonic() - inicio)
+        enrutador.registrar(paso, modelo, time.monotonic() - inicio, escalado=False)
+        return texto
+
+# --- MOTOR DE ENRIQUECIMIENTO ---
+
+class ErrorPaso(Exception):
+    """Falla de un paso de la cadena que conserva lo que ya generaron los pasos anteriores.
+
+    `parciales` es {paso: texto validado} de los pasos que sí terminaron.
+    """
+
+    def __init__(self, paso, causa, parciales):
+        super().__init__(f"Paso {paso}: {causa}")
+        self.paso = paso
+        self.causa = causa
+        self.parciales = parciales
+
+def columnas_paso(paso, texto):
+    """Columnas del Excel que salen de la respuesta validada de un paso."""
+    if paso == 1:
+        header_correcta = "Ruta Cognitiva Correcta:"
+        header_distractores = "Análisis de Opciones No Válidas:"
+        idx_distractores = texto.find(header_distractores)
+        return {
+            "Justificacion_Correcta": texto[len(header_correcta):idx_distractores].strip(),
+            "Analisis_Distractores": texto[idx_distractores:].strip(),
+        }
+    if paso == 2:
+        return {"Que_Evalua": texto}
+    idx_avanzar = texto.upper().find("RECOMENDACIÓN PARA AVANZAR")
+    return {
+        "Recomendacion_Fortalecer": texto[:idx_avanzar].strip(),
+        "Recomendacion_Avanzar": texto[idx_avanzar:].strip(),
+    }
+
+def armar_resultado(analisis_central, que_evalua, recomendaciones):
+    """Separa las respuestas validadas de los 3 pasos en las columnas finales del Excel."""
+    return {
+        **columnas_paso(2, que_evalua),
+        **columnas_paso(1, analisis_central),
+        **columnas_paso(3, recomendaciones),
+    }
+
+def resultado_parcial(error):
+    """Columnas de los pasos que terminaron antes de `error` (vacío si no es un ErrorPaso)."""
+    resultado = {}
+    for paso, texto in getattr(error, "parciales", {}).items():
+        resultado.update(columnas_paso(paso, texto))
+    return resultado
+
+def _paso_o_conocido(conocidos, parciales, paso, model, construir_prompt, args, **opciones):
+    """Usa la respuesta ya conocida del paso o la genera; si falla, lanza ErrorPaso con los pasos previos."""
+    if paso in conocidos:
+        texto = conocidos[paso]
+    else:
+        try:
+            texto = generar_paso(model, paso, construir_prompt, args, **opciones)
+        except Exception as e:
+            raise ErrorPaso(paso, e, dict(parciales)) from e
+    parciales[paso] = texto
+    return texto
+
+def procesar_item(model, fila, instruccion_paso1="", instruccion_paso2="", instruccion_paso3="", limitador=None, cache=None, uso=None,
+                  contexto_fewshot=None, conocidos=None, streaming=None, cancelado=None):
+    """Ejecuta la cadena de 3 pasos para un ítem y retorna las columnas generadas.
+
+    `model` puede ser un modelo único o un EnrutadorModelos con modelos distintos por paso.
+    Los pasos presentes en `conocidos` ({paso: respuesta}) no se vuelven a pedir. Si un paso
+    falla se lanza ErrorPaso con las respuestas de los pasos anteriores. Con `streaming`, cada
+    respuesta se valida contra FORMATO_STREAMING mientras llega.
+    """
+    opciones = {"limitador": limitador, "cache": cache, "uso": uso, "contexto_fewshot": contexto_fewshot, "streaming": streaming,
+                "cancelado": cancelado}
+    conocidos = conocidos or {}
+    parciales = {}
+
+    # --- LLAMADA 1: ANÁLISIS CENTRAL ---
+    analisis_central = _paso_o_conocido(
+        conocidos, parciales, 1, model, construir_prompt_paso1_analisis_central, (fila, instruccion_paso1),
+        validar=validar_paso1, validar_cascada=validar_formato_paso1, validar_parcial=validador_parcial(1), **opciones
+    )
+
+    # --- LLAMADA 2: SÍNTESIS DEL "QUÉ EVALÚA" ---
+    que_evalua = _paso_o_conocido(
+        conocidos, parciales, 2, model, construir_prompt_paso2_sintesis_que_evalua, (analisis_central, fila, instruccion_paso2),
+        validar_cascada=validar_formato_paso2, validar_parcial=validador_parcial(2), **opciones
+    )
+
+    # --- LLAMADA 3: GENERACIÓN DE RECOMENDACIONES ---
+    recomendaciones = _paso_o_conocido(
+        conocidos, parciales, 3, model, construir_prompt_paso3_recomendaciones, (que_evalua, analisis_central, fila, instruccion_paso3),
+        validar=validar_paso3, validar_cascada=validar_formato_paso3, validar_parcial=validador_parcial(3), **opciones
+    )
+
+    return armar_resultado(analisis_central, que_evalua, recomendaciones)
+
+def procesar_item_unico(model, fila, instruccion_paso1="", instruccion_paso2="", instruccion_paso3="", limitador=None, cache=None, uso=None,
+                        contexto_fewshot=None, streaming=None, cancelado=None):
+    """Pide las cinco columnas en una sola llamada con salida JSON; si no valida, recurre a la cadena de 3 pasos.
+
+    Con un EnrutadorModelos, la llamada única usa la cadena de modelos del Paso 1.
+    """
+    try:
+        texto = generar_paso(
+            model, 1, construir_prompt_unico, (fila, instruccion_paso1, instruccion_paso2, instruccion_paso3),
+            validar=validar_respuesta_unica, limitador=limitador, cache=cache, uso=uso,
+            generation_config=CONFIG_RESPUESTA_UNICA, streaming=streaming, cancelado=cancelado,
+        )
+    except ValueError:
+        if uso is not None:
+            uso["modo"] = "3 pasos (respaldo)"
+        return procesar_item(model, fila, instruccion_paso1, instruccion_paso2, instruccion_paso3, limitador, cache, uso, contexto_fewshot,
+                             streaming=streaming, cancelado=cancelado)
+    datos = json.loads(texto)
+    return {col: datos[col].strip() for col in COLUMNAS_NUEVAS}
+
+def _validar_secciones(n_items, validar_seccion):
+    """Validador para respuestas agrupadas: exige una sección válida por cada ítem."""
+    def validar(texto):
+        for n, seccion in enumerate(dividir_secciones_grupo(texto, n_items), start=1):
+            if seccion is None:
+                raise ValueError(f"La respuesta agrupada no trae la sección del ítem {n}.")
+            validar_seccion(seccion)
+    return validar
+
+def agrupar_por_pasaje(df, max_por_grupo=5):
+    """Agrupa los índices de las filas con el mismo ItemContexto (normalizado) en bloques de hasta `max_por_grupo`."""
+    por_pasaje = {}
+    sueltos = []
+    for i, fila in df.iterrows():
+        clave = normalizar_contexto(fila.get('ItemContexto'))
+        if clave:
+            por_pasaje.setdefault(clave, []).append(i)
+        else:
+            sueltos.append([i])
+    grupos = []
+    for indices in por_pasaje.values():
+        for inicio in range(0, len(indices), max_por_grupo):
+            grupos.append(indices[inicio:inicio + max_por_grupo])
+    return grupos + sueltos
+
+def procesar_grupo(model, filas, instruccion_paso1="", instruccion_paso2="", instruccion_paso3="", limitador=None, cache=None, uso=None,
+                   contexto_fewshot=None, streaming=None, cancelado=None):
+    """Cadena de 3 pasos para ítems que comparten pasaje: los pasos 1 y 3 se piden una sola vez por grupo.
+
+    `filas` es una lista de (indice, fila). Retorna {indice: resultado o excepción}. Si la respuesta
+    agrupada de un paso no trae todas sus secciones válidas o la llamada falla, ese paso se repite ítem por ítem.
+    """
+    if len(filas) == 1:
+        i, fila = filas[0]
+        try:
+            return {i: procesar_item(model, fila, instruccion_paso1, instruccion_paso2, instruccion_paso3, limitador, cache, uso, contexto_fewshot,
+                                     streaming=streaming, cancelado=cancelado)}
+        except Exception as e:
+            return {i: e}
+
+    resultados = {}
+    ahorro = 0
+    # Los prompts agrupados no usan el prefijo cacheado (llevan sus propias instrucciones de formato) y en streaming
+    # solo se validan al final: FORMATO_STREAMING describe la respuesta de un ítem
+    opciones = {"limitador": limitador, "cache": cache, "uso": uso, "streaming": streaming, "cancelado": cancelado}
+
+    # --- PASO 1 AGRUPADO: ANÁLISIS CENTRAL ---
+    analisis = {}
+    prompt_grupo = construir_prompt_paso1_grupo([fila for _, fila in filas], instruccion_paso1)
+    prompts_individuales = {i: construir_prompt_paso1_analisis_central(fila, instruccion_paso1) for i, fila in filas}
+    try:
+        texto = generar_paso(
+            model, 1, construir_prompt_paso1_grupo, ([fila for _, fila in filas], instruccion_paso1),
+            validar=_validar_secciones(len(filas), validar_paso1),
+            validar_cascada=_validar_secciones(len(filas), validar_formato_paso1), **opciones
+        )
+        analisis = dict(zip([i for i, _ in filas], dividir_secciones_grupo(texto, len(filas))))
+        ahorro += sum(estimar_tokens(p) for p in prompts_individuales.values()) - estimar_tokens(prompt_grupo)
+    except EjecucionCancelada:
+        raise
+    except Exception:
+        # Respuesta agrupada incompleta o llamada fallida (argumento inválido, cuota agotada tras los reintentos...):
+        # se repite ítem por ítem, y los errores quedan en cada ítem con el uso ya acumulado del grupo
+        for i, fila in filas:
+            try:
+                analisis[i] = generar_paso(
+                    model, 1, construir_prompt_paso1_analisis_central, (fila, instruccion_paso1),
+                    validar=validar_paso1, validar_cascada=validar_formato_paso1, validar_parcial=validador_parcial(1),
+                    contexto_fewshot=contexto_fewshot, **opciones
+                )
+            except Exception as e:
+                resultados[i] = ErrorPaso(1, e, {})
+
+    # --- PASO 2: SÍNTESIS DEL "QUÉ EVALÚA" (por ítem; no incluye el pasaje) ---
+    que_evalua = {}
+    for i, fila in filas:
+        if i in analisis:
+            try:
+                que_evalua[i] = generar_paso(
+                    model, 2, construir_prompt_paso2_sintesis_que_evalua, (analisis[i], fila, instruccion_paso2),
+                    validar_cascada=validar_formato_paso2, validar_parcial=validador_parcial(2), **opciones
+                )
+            except Exception as e:
+                resultados[i] = ErrorPaso(2, e, {1: analisis[i]})
+
+    # --- PASO 3 AGRUPADO: RECOMENDACIONES ---
+    pendientes = [(i, fila) for i, fila in filas if i in que_evalua]
+    recomendaciones = {}
+    if len(pendientes) > 1:
+        prompt_grupo = construir_prompt_paso3_grupo([(que_evalua[i], analisis[i], fila) for i, fila in pendientes], instruccion_paso3)
+        try:
+            texto = generar_paso(
+                model, 3, construir_prompt_paso3_grupo, ([(que_evalua[i], analisis[i], fila) for i, fila in pendientes], instruccion_paso3),
+                validar=_validar_secciones(len(pendientes), validar_paso3),
+                validar_cascada=_validar_secciones(len(pendientes), validar_formato_paso3), **opciones
+            )
+            recomendaciones = dict(zip([i for i, _ in pendientes], dividir_secciones_grupo(texto, len(pendientes))))
+            ahorro += sum(
+                estimar_tokens(construir_prompt_paso3_recomendaciones(que_evalua[i], analisis[i], fila, instruccion_paso3))
+                for i, fila in pendientes
+            ) - estimar_tokens(prompt_grupo)
+        except EjecucionCancelada:
+            raise
+        except Exception:
+            # Igual que en el paso 1: los ítems sin recomendación se piden por separado y conservan los pasos 1 y 2
+            pass
+    for i, fila in pendientes:
+        if i not in recomendaciones:
+            try:
+                recomendaciones[i] = generar_paso(
+                    model, 3, construir_prompt_paso3_recomendaciones, (que_evalua[i], analisis[i], fila, instruccion_paso3),
+                    validar=validar_paso3, validar_cascada=validar_formato_paso3, validar_parcial=validador_parcial(3),
+                    contexto_fewshot=contexto_fewshot, **opciones
+                )
+            except Exception as e:
+                resultados[i] = ErrorPaso(3, e, {1: analisis[i], 2: que_evalua[i]})
+
+    for i, texto in recomendaciones.items():
+        resultados[i] = armar_resultado(analisis[i], que_evalua[i], texto)
+    if uso is not None:
+        uso["tokens_ahorrados"] = uso.get("tokens_ahorrados", 0) + max(ahorro, 0)
+    return resultados
+
+MODOS_GENERACION = {
+    "3 pasos": procesar_item,
+    "Llamada única": procesar_item_unico,
+}
+
+# --- REPARACIÓN DE CELDAS CON ERROR ---
+
+MODO_REPARACION = "Reparar celdas con error"
+
+def celda_fallida(valor):
+    """Una columna generada falta si está vacía o quedó marcada como error (incluido el formato antiguo "Error: ...")."""
+    if not isinstance(valor, str):
+        return True
+    valor = valor.strip()
+    return not valor or valor == MARCA_ERROR or valor.startswith("Error:")
+
+def pasos_pendientes(fila):
+    """Pasos a regenerar en una fila ya enriquecida: el primero con alguna columna fallida y todos los siguientes,
+    porque cada paso se construye sobre los anteriores."""
+    for paso, columnas in COLUMNAS_POR_PASO.items():
+        if any(celda_fallida(fila.get(col)) for col in columnas):
+            return list(range(paso, len(COLUMNAS_POR_PASO) + 1))
+    return []
+
+def conocidos_de_fila(fila, pendientes):
+    """Reconstruye, desde las columnas del Excel, la respuesta de los pasos que no hay que regenerar."""
+    conocidos = {}
+    if 1 not in pendientes:
+        conocidos[1] = f"Ruta Cognitiva Correcta:\n{fila['Justificacion_Correcta']}\n\n{fila['Analisis_Distractores']}"
+    if 2 not in pendientes:
+        conocidos[2] = fila["Que_Evalua"]
+    if 3 not in pendientes:
+        conocidos[3] = f"{fila['Recomendacion_Fortalecer']}\n\n{fila['Recomendacion_Avanzar']}"
+    return conocidos
+
+def reparar_item(model, fila, instruccion_paso1="", instruccion_paso2="", instruccion_paso3="", limitador=None, cache=None, uso=None,
+                 contexto_fewshot=None, streaming=None, cancelado=None):
+    """Regenera solo los pasos fallidos de una fila, reutilizando como entrada las respuestas guardadas de los anteriores."""
+    return procesar_item(
+        model, fila, instruccion_paso1, instruccion_paso2, instruccion_paso3, limitador, cache, uso, contexto_fewshot,
+        conocidos=conocidos_de_fila(fila, pasos_pendientes(fila)), streaming=streaming, cancelado=cancelado,
+    )
+
+def filas_a_reparar(df):
+    """Índices de las filas con alguna columna generada vacía o con error."""
+    return [i for i, fila in df.iterrows() if pasos_pendientes(fila)]
+
+MODOS_PROCESAMIENTO = {**MODOS_GENERACION, MODO_REPARACION: reparar_item}
+
+def _procesar_con_uso(funcion, modo, model, i, fila, instrucciones, opciones):
+    uso = {"modo": modo, "llamadas": 0, "tokens_entrada": 0, "tokens_salida": 0}
+    inicio = time.monotonic()
+    try:
+        resultado = funcion(model, fila, *instrucciones, uso=uso, **opciones)
+    except Exception as e:
+        # Las llamadas de un ítem fallido también consumieron tiempo y tokens
+        uso["latencia_s"] = time.monotonic() - inicio
+        return {i: (None, e, uso)}
+    uso["latencia_s"] = time.monotonic() - inicio
+    return {i: (resultado, None, uso)}
+
+def _procesar_grupo_con_uso(model, filas, instrucciones, opciones):
+    uso = {"llamadas": 0, "tokens_entrada": 0, "tokens_salida": 0, "tokens_ahorrados": 0}
+    inicio = time.monotonic()
+    resultados = procesar_grupo(model, filas, *instrucciones, uso=uso, **opciones)
+    latencia = time.monotonic() - inicio
+    # El consumo del grupo se reparte por igual entre sus ítems; la latencia por paso es la de las llamadas del grupo
+    # y el detalle de las llamadas viaja solo con el primer ítem, para no contarlas n veces
+    n = len(filas)
+    detalle = uso.pop("llamadas_detalle", [])
+    uso_item = {clave: valor if isinstance(valor, dict) else valor / n for clave, valor in uso.items()}
+    uso_item.update(modo="3 pasos agrupado" if n > 1 else "3 pasos", latencia_s=latencia)
+    salidas = {}
+    for posicion, (i, resultado) in enumerate(resultados.items()):
+        uso_i = dict(uso_item, llamadas_detalle=detalle if posicion == 0 else [])
+        salidas[i] = (None, resultado, uso_i) if isinstance(resultado, Exception) else (resultado, None, uso_i)
+    return salidas
+
+def enriquecer_concurrente(model, df, instrucciones=("", "", ""), max_concurrencia=8, limitador=None, cache=None,
+                           modo="3 pasos", agrupar_pasajes=False, max_por_grupo=5, contexto_fewshot=None, al_empezar=None,
+                           streaming=None, cancelado=None):
+    """Procesa varios ítems a la vez y entrega (indice, resultado, error, uso) a medida que terminan.
+
+    Cada ítem conserva el orden de sus pasos; lo que corre en paralelo son ítems distintos.
+    `uso` trae el modo efectivo, la latencia del ítem y sus tokens de entrada y salida.
+    Con `agrupar_pasajes` la unidad de trabajo es un grupo de ítems que comparten ItemContexto
+    (siempre con la cadena de 3 pasos). `contexto_fewshot` envía los pasos 1 y 3 contra sus prefijos cacheados.
+    `al_empezar(indices)` se llama cuando un hilo toma una unidad de trabajo. Con `modo=MODO_REPARACION`
+    solo se regeneran los pasos fallidos de cada fila. `streaming` (un Streaming) lee las respuestas por
+    fragmentos y avisa el texto parcial de cada unidad de trabajo. Con `cancelado` activo, las unidades que
+    aún no empezaron no se lanzan y las que están en curso no hacen más llamadas (ver es_cancelacion).
+    """
+    funcion = MODOS_PROCESAMIENTO[modo]
+    if modo == MODO_REPARACION:
+        # La reparación va fila por fila: cada una retoma desde un paso distinto
+        agrupar_pasajes = False
+
+    def empezar(indices, procesar, *args):
+        comprobar_cancelacion(cancelado)
+        if al_empezar:
+            al_empezar(indices)
+        return procesar(*args)
+
+    opciones = {"limitador": limitador, "cache": cache, "contexto_fewshot": contexto_fewshot, "cancelado": cancelado}
+
+    def opciones_de(indices):
+        return dict(opciones, streaming=streaming.para(indices)) if streaming else opciones
+    executor = ThreadPoolExecutor(max_workers=max(1, int(max_concurrencia)))
+    try:
+        futuros = {}
+        if agrupar_pasajes:
+            for indices in agrupar_por_pasaje(df, max_por_grupo):
+                filas = [(i, df.loc[i]) for i in indices]
+                futuros[executor.submit(empezar, indices, _procesar_grupo_con_uso, model, filas, instrucciones, opciones_de(indices))] = indices
+        else:
+            for i, fila in df.iterrows():
+                futuros[executor.submit(empezar, [i], _procesar_con_uso, funcion, modo, model, i, fila, instrucciones, opciones_de([i]))] = [i]
+        for futuro in as_completed(futuros):
+            try:
+                salidas = futuro.result()
+            except Exception as e:
+                for i in futuros[futuro]:
+                    yield i, None, e, None
+                continue
+            for i, (resultado, error, uso) in salidas.items():
+                yield i, resultado, error, uso
+    finally:
+        # Si la ejecución se interrumpe (rerun, desconexión), no se lanzan los ítems que aún esperan turno.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def resumir_uso(usos):
+    """Resume latencia y tokens por modo efectivo para comparar estrategias de generación."""
+    if not usos:
+        return pd.DataFrame()
+    df_uso = pd.DataFrame(usos)
+    for columna in ("tokens_ahorrados", "costo_usd"):
+        if columna not in df_uso.columns:
+            df_uso[columna] = 0
+        df_uso[columna] = df_uso[columna].fillna(0)
+    return df_uso.groupby("modo").agg(
+        items=("latencia_s", "size"),
+        latencia_media_s=("latencia_s", "mean"),
+        latencia_p95_s=("latencia_s", lambda x: x.quantile(0.95)),
+        llamadas_por_item=("llamadas", "mean"),
+        tokens_entrada_por_item=("tokens_entrada", "mean"),
+        tokens_salida_por_item=("tokens_salida", "mean"),
+        tokens_ahorrados_por_item=("tokens_ahorrados", "mean"),
+        costo_usd_por_item=("costo_usd", "mean"),
+    ).reset_index()
+
+# --- TELEMETRÍA POR LLAMADA ---
+
+def registros_llamadas(usos_por_item):
+    """Aplana el detalle de llamadas de cada ítem: [(item_id, uso), ...] -> una fila por llamada al modelo."""
+    return [
+        {"item_id": str(item_id), **llamada}
+        for item_id, uso in usos_por_item if uso
+        for llamada in uso.get("llamadas_detalle", [])
+    ]
+
+def resumir_llamadas(registros):
+    """Llamadas, reintentos, respuestas cortadas, tokens, latencia (p50/p95, y hasta el primer fragmento en
+    streaming) y costo estimado por paso y modelo."""
+    if not registros:
+        return pd.DataFrame()
+    df_llamadas = pd.DataFrame(registros)
+    df_llamadas["paso"] = df_llamadas["paso"].fillna(0).astype(int)
+    df_llamadas["primer_fragmento_s"] = pd.to_numeric(df_llamadas["primer_fragmento_s"])
+    return df_llamadas.groupby(["paso", "modelo"]).agg(
+        llamadas=("latencia_s", "size"),
+        reintentos=("reintentos", "sum"),
+        abortadas=("abortada", "sum"),
+        tokens_entrada=("tokens_entrada", "sum"),
+        tokens_salida=("tokens_salida", "sum"),
+        tokens_cacheados=("tokens_cacheados", "sum"),
+        latencia_p50_s=("latencia_s", "median"),
+        latencia_p95_s=("latencia_s", lambda x: x.quantile(0.95)),
+        primer_fragmento_p50_s=("primer_fragmento_s", "median"),
+        costo_usd=("costo_usd", "sum"),
+    ).reset_index()
+
+def histograma_latencias(registros, n_intervalos=20):
+    """{paso: {"desde_s": [...], "llamadas": [...]}} con intervalos iguales de latencia por paso."""
+    if not registros:
+        return {}
+    df_llamadas = pd.DataFrame(registros)
+    df_llamadas["paso"] = df_llamadas["paso"].fillna(0).astype(int)
+    histogramas = {}
+    for paso, latencias in df_llamadas.groupby("paso")["latencia_s"]:
+        conteos, bordes = np.histogram(latencias, bins=n_intervalos)
+        histogramas[int(paso)] = {"desde_s": [round(b, 3) for b in bordes[:-1]], "llamadas": conteos.tolist()}
+    return histogramas
+
+FORMATOS_TELEMETRIA = {"JSONL": ("jsonl", "application/jsonl"), "CSV": ("csv", "text/csv")}
+
+def serializar_telemetria(registros, extension):
+    """Registros de llamadas como JSONL o CSV, para comparar ejecuciones al cambiar prompts o modelos."""
+    if extension == "jsonl":
+        return "".join(json.dumps(registro, ensure_ascii=False) + "\n" for registro in registros).encode("utf-8")
+    return pd.DataFrame(registros).to_csv(index=False).encode("utf-8-sig")
+
+# --- MODO POR LOTES (VERTEX BATCH PREDICTION) ---
+
+def serializar_solicitudes_lote(solicitudes):
+    """Convierte {clave: prompt} al JSONL de entrada de Vertex Batch Prediction para Gemini."""
+    generation_config = {
+        "temperature": GENERATION_CONFIG["temperature"],
+        "topP": GENERATION_CONFIG["top_p"],
+        "topK": GENERATION_CONFIG["top_k"],
+        "maxOutputTokens": GENERATION_CONFIG["max_output_tokens"],
+    }
+    safety_settings = [
+        {"category": categoria.name, "threshold": umbral.name}
+        for categoria, umbral in SAFETY_SETTINGS.items()
+    ]
+    lineas = []
+    for clave, prompt in solicitudes.items():
+        lineas.append(json.dumps({
+            "request": {
+                "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                "generationConfig": generation_config,
+                "safetySettings": safety_settings,
+                # Vertex devuelve la solicitud junto a la respuesta; la etiqueta permite emparejarlas.
+                "labels": {"clave": clave},
+            }
+        }, ensure_ascii=False))
+    return "\n".join(lineas) + "\n"
+
+def parsear_predicciones_lote(lineas):
+    """Lee el JSONL de salida de un trabajo por lotes y retorna {clave: texto o excepción}."""
+    resultados = {}
+    for linea in lineas:
+        if not linea.strip():
+            continue
+        registro = json.loads(linea)
+        clave = registro.get("request", {}).get("labels", {}).get("clave")
+        if clave is None:
+            continue
+        try:
+            partes = registro["response"]["candidates"][0]["content"]["parts"]
+            resultados[clave] = "".join(parte.get("text", "") for parte in partes).strip()
+        except (KeyError, IndexError, TypeError):
+            resultados[clave] = RuntimeError(registro.get("status") or "El trabajo por lotes devolvió una respuesta vacía.")
+    return resultados
+
+class BackendLotesVertex:
+    """Ejecuta cada ola como un trabajo de Vertex Batch Prediction, con entrada y salida en GCS."""
+
+    def __init__(self, bucket, prefijo="batch", intervalo_sondeo=30):
+        self.bucket = bucket
+        self.prefijo = prefijo
+        self.intervalo_sondeo = intervalo_sondeo
+
+    def ejecutar(self, ruta_modelo, solicitudes, cancelado=None):
+        cliente = storage.Client()
+        carpeta = f"{self.prefijo}/{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        cliente.bucket(self.bucket).blob(f"{carpeta}/input.jsonl").upload_from_string(
+            serializar_solicitudes_lote(solicitudes), content_type="application/jsonl"
+        )
+        job = BatchPredictionJob.submit(
+            source_model=ruta_modelo,
+            input_dataset=f"gs://{self.bucket}/{carpeta}/input.jsonl",
+            output_uri_prefix=f"gs://{self.bucket}/{carpeta}/output",
+        )
+        while not job.has_ended:
+            if cancelado is not None and cancelado.wait(self.intervalo_sondeo):
+                job.cancel()
+                raise EjecucionCancelada(f"Se canceló el trabajo por lotes {job.resource_name}.")
+            if cancelado is None:
+                time.sleep(self.intervalo_sondeo)
+            job.refresh()
+        if not job.has_succeeded:
+            raise RuntimeError(f"El trabajo por lotes {job.resource_name} terminó con error: {job.error}")
+
+        prefijo_salida = job.output_location.replace(f"gs://{self.bucket}/", "", 1)
+        lineas = []
+        for blob in cliente.list_blobs(self.bucket, prefix=prefijo_salida):
+            if blob.name.endswith(".jsonl"):
+                lineas.extend(blob.download_as_text().splitlines())
+        return parsear_predicciones_lote(lineas)
+
+class BackendLotesDirectorio:
+    """Sustituto local del backend por lotes: mismo formato JSONL que Vertex, pero en un directorio.
+
+    Cada ola crea `<directorio>/<trabajo>/input.jsonl` y espera `predictions.jsonl` en la misma
+    carpeta. Con un `respondedor` (cualquier objeto con `generate_content`, p. ej. un modelo falso)
+    el trabajo se resuelve en el acto; sin él, otro proceso debe dejar el archivo de salida.
+    """
+
+    def __init__(self, directorio, respondedor=None, intervalo_sondeo=1.0, timeout=None):
+        self.directorio = directorio
+        self.respondedor = respondedor
+        self.intervalo_sondeo = intervalo_sondeo
+        self.timeout = timeout
+
+    def ejecutar(self, ruta_modelo, solicitudes, cancelado=None):
+        carpeta = os.path.join(self.directorio, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}")
+        os.makedirs(carpeta, exist_ok=True)
+        entrada = os.path.join(carpeta, "input.jsonl")
+        salida = os.path.join(carpeta, "predictions.jsonl")
+        with open(entrada, "w", encoding="utf-8") as f:
+            f.write(serializar_solicitudes_lote(solicitudes))
+
+        if self.respondedor is not None:
+            self._simular(entrada, salida)
+        inicio = time.monotonic()
+        while not os.path.exists(salida):
+            comprobar_cancelacion(cancelado)
+            if self.timeout is not None and time.monotonic() - inicio > self.timeout:
+                raise TimeoutError(f"No apareció {salida} a tiempo.")
+            time.sleep(self.intervalo_sondeo)
+        with open(salida, encoding="utf-8") as f:
+            return parsear_predicciones_lote(f.read().splitlines())
+
+    def _simular(self, entrada, salida):
+        lineas_salida = []
+        with open(entrada, encoding="utf-8") as f:
+            for linea in f:
+                solicitud = json.loads(linea)["request"]
+                prompt = solicitud["contents"][0]["parts"][0]["text"]
+                try:
+                    texto = self.respondedor.generate_content(prompt).text
+                    registro = {"request": solicitud, "status": "", "response": {
+                        "candidates": [{"content": {"role": "model", "parts": [{"text": texto}]}}]
+                    }}
+                except Exception as e:
+                    registro = {"request": solicitud, "status": str(e)}
+                lineas_salida.append(json.dumps(registro, ensure_ascii=False))
+        temporal = salida + ".tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            f.write("\n".join(lineas_salida) + "\n")
+        os.replace(temporal, salida)
+
+def crear_backend_lotes(destino):
+    """`gs://bucket[/prefijo]` usa Vertex Batch Prediction; cualquier otra ruta, el backend local por directorio."""
+    if destino.startswith("gs://"):
+        bucket, _, prefijo = destino[len("gs://"):].partition("/")
+        return BackendLotesVertex(bucket, prefijo.strip("/") or "batch")
+    return BackendLotesDirectorio(destino)
+
+def _resolver_ola(backend, ruta_modelo, prompts, cache=None, validar=None, cancelado=None):
+    """Resuelve {indice: prompt} en un solo trabajo por lotes (omitiendo lo que ya está en caché)."""
+    textos, errores, por_enviar = {}, {}, {}
+    for i, prompt in prompts.items():
+        clave_cache = CacheRespuestas.clave(ruta_modelo, prompt) if cache else None
+        texto = cache.obtener(clave_cache) if clave_cache else None
+        if texto is not None:
+            textos[i] = texto
+        else:
+            por_enviar[str(i)] = (i, prompt, clave_cache)
+
+    if por_enviar:
+        comprobar_cancelacion(cancelado)
+        respuestas = backend.ejecutar(ruta_modelo, {clave: prompt for clave, (_, prompt, _) in por_enviar.items()}, cancelado=cancelado)
+        for clave, (i, prompt, clave_cache) in por_enviar.items():
+            respuesta = respuestas.get(clave, RuntimeError("El trabajo por lotes no devolvió respuesta para este ítem."))
+            if isinstance(respuesta, Exception):
+                errores[i] = respuesta
+                continue
+            try:
+                if validar:
+                    validar(respuesta)
+            except ValueError as e:
+                errores[i] = e
+                continue
+            if clave_cache:
+                cache.guardar(clave_cache, respuesta)
+            textos[i] = respuesta
+    return textos, errores
+
+def enriquecer_por_lotes(backend, model_name, df, instrucciones=("", "", ""), cache=None, al_iniciar_ola=None, cancelado=None):
+    """Ejecuta los 3 pasos como tres olas de batch prediction y entrega (indice, resultado, error, uso).
+
+    Los errores se entregan en cuanto se conocen; los ítems exitosos, al terminar la tercera ola.
+    El uso por ítem no está disponible en este modo y se entrega como None. Con `cancelado` activo
+    no se envía la siguiente ola, se cancela el trabajo en curso y se lanza EjecucionCancelada.
+    """
+    ruta_modelo = f"publishers/google/models/{model_name}"
+    filas = dict(df.iterrows())
+
+    # --- OLA 1: ANÁLISIS CENTRAL ---
+    prompts = {i: construir_prompt_paso1_analisis_central(fila, instrucciones[0]) for i, fila in filas.items()}
+    if al_iniciar_ola:
+        al_iniciar_ola(1, len(prompts))
+    analisis, errores = _resolver_ola(backend, ruta_modelo, prompts, cache, validar_paso1, cancelado)
+    for i, e in errores.items():
+        yield i, None, ErrorPaso(1, e, {}), None
+
+    # --- OLA 2: SÍNTESIS DEL "QUÉ EVALÚA" ---
+    prompts = {i: construir_prompt_paso2_sintesis_que_evalua(analisis[i], filas[i], instrucciones[1]) for i in analisis}
+    if al_iniciar_ola:
+        al_iniciar_ola(2, len(prompts))
+    que_evalua, errores = _resolver_ola(backend, ruta_modelo, prompts, cache, cancelado=cancelado)
+    for i, e in errores.items():
+        yield i, None, ErrorPaso(2, e, {1: analisis[i]}), None
+
+    # --- OLA 3: RECOMENDACIONES ---
+    prompts = {
+        i: construir_prompt_paso3_recomendaciones(que_evalua[i], analisis[i], filas[i], instrucciones[2])
+        for i in que_evalua
+    }
+    if al_iniciar_ola:
+        al_iniciar_ola(3, len(prompts))
+    recomendaciones, errores = _resolver_ola(backend, ruta_modelo, prompts, cache, validar_paso3, cancelado)
+    for i, e in errores.items():
+        yield i, None, ErrorPaso(3, e, {1: analisis[i], 2: que_evalua[i]}), None
+
+    for i, texto in recomendaciones.items():
+        yield i, armar_resultado(analisis[i], que_evalua[i], texto), None, None
+
+# --- PUNTOS DE CONTROL ---
+
+def clave_item(fila, i):
+    """Identificador estable de un ítem dentro de su Excel: su ItemId junto con su posición.
+
+    La posición evita que dos filas con el mismo ItemId se pisen en el punto de control; sin
+    columna ItemId basta con la posición. La clave de ejecución ya fija el contenido del Excel.
+    """
+    posicion = str(i + 1)
+    return f"{fila['ItemId']}@{posicion}" if 'ItemId' in fila.index else posicion
+
+class PuntoControl:
+    """Registro durable (JSONL) de los ítems ya enriquecidos, para reanudar ejecuciones interrumpidas.
+
+    Cada ítem terminado se añade como una línea y se fuerza a disco. Si se indica un bucket de
+    GCS, el archivo se sube cada `sincronizar_cada` ítems y se recupera de allí si falta localmente
+    (p. ej. tras reciclarse la instancia de Cloud Run).
+    """
+
+    def __init__(self, ruta, bucket_gcs=None, sincronizar_cada=25):
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        self.ruta = ruta
+        self.bucket_gcs = bucket_gcs
+        self.sincronizar_cada = sincronizar_cada
+        self._pendientes_sync = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def clave_ejecucion(contenido_excel, model_name, instrucciones=("", "", "")):
+        """Identifica una ejecución por el contenido del Excel, el modelo usado y las instrucciones de cada paso."""
+        material = json.dumps([model_name, list(instrucciones)], ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(contenido_excel + material).hexdigest()[:16]
+
+    def _blob(self):
+        return storage.Client().bucket(self.bucket_gcs).blob(f"checkpoints/{os.path.basename(self.ruta)}")
+
+    def cargar(self):
+        """Retorna {clave_item: columnas generadas} de los ítems ya completados."""
+        if not os.path.exists(self.ruta) and self.bucket_gcs:
+            blob = self._blob()
+            if blob.exists():
+                blob.download_to_filename(self.ruta)
+        completados = {}
+        if not os.path.exists(self.ruta):
+            return completados
+        with open(self.ruta, encoding="utf-8") as f:
+            lineas = f.readlines()
+        for linea in lineas:
+            try:
+                registro = json.loads(linea)
+            except json.JSONDecodeError:
+                continue  # Línea truncada por una caída a mitad de escritura
+            completados[registro["item"]] = registro["resultado"]
+        if lineas and not lineas[-1].endswith("\n"):
+            # Cierra la línea truncada para que el próximo registro empiece en una línea propia
+            with open(self.ruta, "a", encoding="utf-8") as f:
+                f.write("\n")
+        return completados
+
+    def registrar(self, item, resultado):
+        linea = json.dumps({"item": item, "resultado": resultado, "ts": time.time()}, ensure_ascii=False)
+        with self._lock:
+            with open(self.ruta, "a", encoding="utf-8") as f:
+                f.write(linea + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._pendientes_sync += 1
+            if self.bucket_gcs and self._pendientes_sync >= self.sincronizar_cada:
+                self._subir()
+
+    def sincronizar(self):
+        with self._lock:
+            if self.bucket_gcs and self._pendientes_sync:
+                self._subir()
+
+    def _subir(self):
+        self._blob().upload_from_filename(self.ruta)
+        self._pendientes_sync = 0
+
+    def reiniciar(self):
+        with self._lock:
+            if os.path.exists(self.ruta):
+                os.remove(self.ruta)
+            if self.bucket_gcs:
+                blob = self._blob()
+                if blob.exists():
+                    blob.delete()
+            self._pendientes_sync = 0
+
+def calcular_items_por_minuto(completados, segundos):
+    """Throughput del enriquecimiento en ítems por minuto."""
+    return completados * 60 / segundos if segundos > 0 else 0.0
+
+# --- EJECUCIÓN COMPLETA DE UN BANCO DE ÍTEMS ---
+
+MODOS_EJECUCION = ("En línea", "Por lotes")
+
+# Lector de Excel en Rust (mucho más rápido que openpyxl) si está instalado
+MOTOR_LECTURA_EXCEL = "calamine" if importlib.util.find_spec("python_calamine") else "openpyxl"
+
+class ErrorEsquemaExcel(ValueError):
+    """El Excel no trae las columnas que necesita el análisis."""
+
+def columnas_excel(origen):
+    """Encabezados de la primera hoja, leyendo solo la primera fila (openpyxl en modo streaming)."""
+    libro = openpyxl.load_workbook(origen, read_only=True)
+    try:
+        primera_fila = next(libro.worksheets[0].iter_rows(max_row=1, values_only=True), ())
+    finally:
+        libro.close()
+    if hasattr(origen, "seek"):
+        origen.seek(0)
+    return [str(valor) for valor in primera_fila if valor is not None]
+
+def validar_esquema_excel(columnas):
+    """Lanza ErrorEsquemaExcel si faltan columnas de COLUMNAS_REQUERIDAS."""
+    faltantes = [col for col in COLUMNAS_REQUERIDAS if col not in columnas]
+    if faltantes:
+        raise ErrorEsquemaExcel(
+            f"Al Excel le faltan columnas requeridas: {', '.join(faltantes)}. "
+            f"Columnas encontradas: {', '.join(map(str, columnas))}."
+        )
+
+def columnas_a_leer(columnas_extra):
+    """Proyección de la lectura: lo que usan los prompts, lo que genera la IA y `columnas_extra` (p. ej. las de la plantilla)."""
+    return set(COLUMNAS_PROMPT) | set(COLUMNAS_NUEVAS) | {COLUMNA_ERROR} | set(COLUMNAS_USO) | set(columnas_extra)
+
+def leer_excel(origen, columnas_extra=None):
+    """Lee el banco de ítems, limpia el HTML de las columnas de texto y agrega las columnas a generar.
+
+    Primero valida los encabezados (ErrorEsquemaExcel si faltan columnas requeridas). Con
+    `columnas_extra` solo se leen esas columnas más las que usan los prompts (`columnas_a_leer`);
+    sin ella se leen todas.
+    """
+    validar_esquema_excel(columnas_excel(origen))
+    usecols = None
+    if columnas_extra is not None:
+        proyeccion = columnas_a_leer(columnas_extra)
+        usecols = lambda columna: columna in proyeccion
+    df = pd.read_excel(origen, usecols=usecols, engine=MOTOR_LECTURA_EXCEL)
+    for col in df.columns:
+        if pd.api.types.infer_dtype(df[col], skipna=True) in ("string", "mixed", "mixed-integer"):
+            df[col] = limpiar_html_columna(df[col])
+
+    for col in COLUMNAS_NUEVAS:
+        if col not in df.columns:
+            df[col] = ""
+    # Una columna generada o de error toda vacía (p. ej. Error_IA tras una ejecución sin fallos) se lee como
+    # float64, que no admite texto: se lee como texto para poder reparar o volver a escribir sus celdas
+    for col in [*COLUMNAS_NUEVAS, COLUMNA_ERROR]:
+        if col in df.columns:
+            df[col] = df[col].fillna("").astype(str)
+    return df
+
+def clave_modelos(model_name, enrutador=None):
+    """Identifica los modelos de una ejecución (para el punto de control y las comparativas)."""
+    if enrutador:
+        return json.dumps(enrutador.nombres_por_paso(), sort_keys=True)
+    return model_name
+
+def abrir_punto_control(contenido_excel, clave, bucket_gcs=None, instrucciones=("", "", "")):
+    """Punto de control de la ejecución; cambiar el Excel, los modelos o las instrucciones empieza uno nuevo."""
+    return PuntoControl(
+        os.path.join(
+            DIRECTORIO_DATOS, "checkpoints", f"{PuntoControl.clave_ejecucion(contenido_excel, clave, instrucciones)}.jsonl"
+        ),
+        bucket_gcs=bucket_gcs,
+    )
+
+def restaurar_punto_control(df, punto_control, reanudar=True):
+    """Copia en `df` los ítems ya completados y retorna sus índices; sin `reanudar`, borra el punto de control."""
+    if reanudar:
+        previos = punto_control.cargar()
+    else:
+        punto_control.reiniciar()
+        previos = {}
+    ya_completados = []
+    for i, fila in df.iterrows():
+        resultado_previo = previos.get(clave_item(fila, i))
+        if resultado_previo:
+            for col, valor in resultado_previo.items():
+                df.loc[i, col] = valor
+            ya_completados.append(i)
+    return ya_completados
+
+def aplicar_resultado(df, i, resultado, error):
+    """Escribe las columnas generadas del ítem `i`.
+
+    Si hubo error, `resultado` trae solo las columnas de los pasos que terminaron (resultado_parcial):
+    las demás quedan con MARCA_ERROR y el motivo va en COLUMNA_ERROR, para repararlas después.
+    """
+    for col, valor in (resultado or {}).items():
+        df.loc[i, col] = valor
+    if error is None:
+        df.loc[i, COLUMNA_ERROR] = ""
+        return
+    for col in COLUMNAS_NUEVAS:
+        if not (resultado and col in resultado):
+            df.loc[i, col] = MARCA_ERROR
+    df.loc[i, COLUMNA_ERROR] = str(error)
+
+def aplicar_uso(df, i, uso):
+    """Escribe en la fila `i` los totales de consumo del ítem (COLUMNAS_USO)."""
+    if not uso:
+        return
+    for columna, clave in COLUMNAS_USO.items():
+        if clave in uso:
+            df.loc[i, columna] = round(uso[clave], 6) if isinstance(uso[clave], float) else uso[clave]
+
+def ejecutar_enriquecimiento(model, model_name, df, df_pendiente, instrucciones=("", "", ""), punto_control=None,
+                             modo_ejecucion="En línea", destino_lotes=None, max_concurrencia=8, limitador=None, cache=None,
+                             modo="3 pasos", agrupar_pasajes=False, max_por_grupo=5, contexto_fewshot=None, al_iniciar_ola=None,
+                             al_empezar=None, streaming=None, cancelado=None):
+    """Enriquece las filas de `df_pendiente`, escribe cada resultado en `df` y en el punto de control.
+
+    Genera (indice, resultado, error, uso) a medida que termina cada ítem, para que quien llama
+    (la app o la CLI) informe el avance; en los ítems con error, `resultado` trae las columnas de
+    los pasos que sí terminaron. `model` puede ser un modelo o un EnrutadorModelos;
+    el modo por lotes usa siempre `model_name`. `al_empezar(indices)` avisa qué ítems entran en
+    curso (en el modo por lotes, todos los pendientes al enviar la primera ola). `streaming` solo
+    aplica en línea. Con `cancelado` (un threading.Event) activo no se hacen más llamadas al modelo y
+    la generación termina; los ítems cortados por la cancelación quedan pendientes, sin marcarse como error.
+    """
+    if modo_ejecucion == "Por lotes":
+        if modo == MODO_REPARACION:
+            raise ValueError("La reparación de celdas solo está disponible en el modo En línea.")
+        if al_empezar:
+            al_empezar(list(df_pendiente.index))
+        resultados = enriquecer_por_lotes(
+            crear_backend_lotes(destino_lotes), model_name, df_pendiente, instrucciones, cache, al_iniciar_ola=al_iniciar_ola,
+            cancelado=cancelado,
+        )
+    else:
+        resultados = enriquecer_concurrente(
+            model, df_pendiente, instrucciones, max_concurrencia, limitador, cache, modo,
+            agrupar_pasajes=agrupar_pasajes, max_por_grupo=max_por_grupo, contexto_fewshot=contexto_fewshot,
+            al_empezar=al_empezar, streaming=streaming, cancelado=cancelado,
+        )
+    try:
+        for i, resultado, error, uso in resultados:
+            if error is not None and es_cancelacion(error):
+                continue
+            if error is not None and resultado is None:
+                resultado = resultado_parcial(error)
+            # --- GUARDAR TODO EN EL DATAFRAME Y EN EL PUNTO DE CONTROL ---
+            aplicar_resultado(df, i, resultado, error)
+            aplicar_uso(df, i, uso)
+            if error is None and punto_control:
+                punto_control.registrar(clave_item(df.loc[i], i), resultado)
+            yield i, resultado, error, uso
+    except EjecucionCancelada:
+        return
+    finally:
+        resultados.close()
+        if punto_control:
+            punto_control.sincronizar()
+
+# --- EXPORTACIÓN DE DATOS ENRIQUECIDOS ---
+
+# Motor de Excel más rápido si está instalado; openpyxl sigue funcionando como respaldo
+MOTOR_EXCEL = "xlsxwriter" if importlib.util.find_spec("xlsxwriter") else "openpyxl"
+
+FORMATOS_EXPORTACION = {
+    "Excel (.xlsx)": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "CSV (.csv)": ("csv", "text/csv"),
+}
+if importlib.util.find_spec("pyarrow"):
+    FORMATOS_EXPORTACION["Parquet (.parquet)"] = ("parquet", "application/vnd.apache.parquet")
+
+def serializar_datos(df, formato, destino=None):
+    """Escribe el DataFrame enriquecido en el formato pedido; sin `destino`, retorna los bytes."""
+    extension, _ = FORMATOS_EXPORTACION[formato]
+    salida = destino if destino is not None else BytesIO()
+    if extension == "xlsx":
+        with pd.ExcelWriter(salida, engine=MOTOR_EXCEL) as writer:
+            df.to_excel(writer, index=False, sheet_name='Datos Enriquecidos')
+    elif extension == "csv":
+        df.to_csv(salida, index=False, encoding="utf-8-sig")
+    else:
+        df.to_parquet(salida, index=False)
+    if destino is None:
+        return salida.getvalue()
+
+# --- SALIDA DEL ZIP DE FICHAS ---
+
+class DestinoZipFichas:
+    """Archivo donde se escribe en streaming el .zip de fichas, en disco local o en un objeto de GCS.
+
+    Con bucket, el zip se sube con una carga reanudable de GCS a medida que se escribe, sin pasar
+    por disco ni por memoria. Sin bucket, se escribe en un archivo bajo `directorio` (por defecto,
+    una carpeta de trabajo de la que se borran los .zip viejos). En ambos casos la sesión solo
+    guarda la `referencia` (ruta local o URI y enlace firmado).
+    """
+
+    def __init__(self, bucket=None, directorio=None, nombre=None, horas_enlace=12):
+        self.bucket = bucket
+        self.directorio = directorio or os.path.join(DIRECTORIO_DATOS, "fichas")
+        self._limpiar = directorio is None
+        self.horas_enlace = horas_enlace
+        self.nombre = nombre or f"fichas_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.zip"
+        self.archivo = None
+        self.referencia = None
+        self._blob = None
+
+    def __enter__(self):
+        if self.bucket:
+            self._blob = storage.Client().bucket(self.bucket).blob(f"fichas/{self.nombre}")
+            self.archivo = self._blob.open("wb", chunk_size=8 * 1024 * 1024, content_type="application/zip")
+        else:
+            os.makedirs(self.directorio, exist_ok=True)
+            if self._limpiar:
+                limpiar_zips_antiguos(self.directorio)
+            self.archivo = open(os.path.join(self.directorio, self.nombre), "wb")
+        return self
+
+    def __exit__(self, tipo_error, *exc):
+        if tipo_error is not None:
+            if not self.bucket:
+                self.archivo.close()
+                os.remove(self.archivo.name)
+            # En GCS, una carga reanudable que no se cierra no crea el objeto
+            return False
+        self.archivo.close()
+        if self.bucket:
+            self.referencia = {
+                "tipo": "gcs",
+                "uri": f"gs://{self.bucket}/{self._blob.name}",
+                "url": url_firmada(self._blob, self.horas_enlace),
+            }
+        else:
+            self.referencia = {"tipo": "local", "ruta": self.archivo.name}
+        return False
+
+def limpiar_zips_antiguos(directorio, horas=24):
+    """Borra los .zip de fichas locales de ejecuciones anteriores que ya nadie va a descargar."""
+    limite = time.time() - horas * 3600
+    for nombre in os.listdir(directorio):
+        ruta = os.path.join(directorio, nombre)
+        if nombre.endswith(".zip") and os.path.getmtime(ruta) < limite:
+            os.remove(ruta)
+
+def url_firmada(blob, horas):
+    """Enlace firmado de descarga; con credenciales sin clave privada (Cloud Run) firma vía IAM. None si no se puede."""
+    expiracion = timedelta(hours=horas)
+    try:
+        return blob.generate_signed_url(version="v4", expiration=expiracion)
+    except AttributeError:
+        pass
+    try:
+        credenciales = blob.client._credentials
+        credenciales.refresh(GoogleAuthRequest())
+        return blob.generate_signed_url(
+            version="v4", expiration=expiracion,
+            service_account_email=credenciales.service_account_email, access_token=credenciales.token,
+        )
+    except (AttributeError, google_exceptions.GoogleAPICallError, google_auth_exceptions.GoogleAuthError):
+        return None
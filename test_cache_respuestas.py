@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Pruebas de la caché persistente de respuestas (python -m pytest -q)."""
+
+import os
+
+import pytest
+
+from conftest import ModeloFalso, banco_items
+from motor import CacheRespuestas, generar_texto, procesar_item, validar_paso1
+
+@pytest.fixture
+def cache(tmp_path):
+    return CacheRespuestas(os.path.join(tmp_path, "respuestas.sqlite"))
+
+def test_la_clave_depende_del_modelo_la_configuracion_y_el_prompt():
+    base = CacheRespuestas.clave("gemini-2.5-flash", "prompt")
+    assert base == CacheRespuestas.clave("gemini-2.5-flash", "prompt")
+    assert base != CacheRespuestas.clave("gemini-2.5-pro", "prompt")
+    assert base != CacheRespuestas.clave("gemini-2.5-flash", "prompt ")
+    assert base != CacheRespuestas.clave("gemini-2.5-flash", "prompt", {"temperature": 0})
+    assert base != CacheRespuestas.clave("gemini-2.5-flash", "prompt", safety_settings={"acoso": "bloquear"})
+
+def test_aciertos_y_fallos_persisten_entre_aperturas(cache):
+    clave = CacheRespuestas.clave("gemini-2.5-flash", "prompt")
+    assert cache.obtener(clave) is None
+    cache.guardar(clave, "respuesta")
+    reabierta = CacheRespuestas(cache.ruta)
+    assert reabierta.obtener(clave) == "respuesta"
+    assert (cache.aciertos, cache.fallos, reabierta.aciertos) == (0, 1, 1)
+    assert reabierta.tamano_mb > 0
+
+def test_desaloja_las_entradas_usadas_hace_mas_tiempo(tmp_path):
+    cache = CacheRespuestas(os.path.join(tmp_path, "respuestas.sqlite"), max_bytes=25)
+    cache.guardar("a", "x" * 10)
+    cache.guardar("b", "x" * 10)
+    cache.obtener("a")
+    cache.guardar("c", "x" * 10)
+    assert cache.obtener("b") is None
+    assert cache.obtener("a") and cache.obtener("c")
+
+def test_generar_texto_reutiliza_solo_respuestas_validas(cache):
+    model = ModeloFalso()
+    prompt_paso1 = "FASE 1: RUTA COGNITIVA"
+    assert generar_texto(model, prompt_paso1, cache=cache, validar=validar_paso1)
+    assert generar_texto(model, prompt_paso1, cache=cache, validar=validar_paso1)
+    assert len(model.prompts) == 1
+
+    # El paso 2 no trae el separador del paso 1: no pasa la validación y no se guarda
+    with pytest.raises(ValueError):
+        generar_texto(model, "otro prompt", cache=cache, validar=validar_paso1, max_reintentos=0)
+    assert cache.obtener(CacheRespuestas.clave("publishers/google/models/gemini-2.5-flash", "otro prompt")) is None
+
+def test_sin_cache_siempre_llama_al_modelo():
+    model = ModeloFalso()
+    generar_texto(model, "prompt")
+    generar_texto(model, "prompt")
+    assert len(model.prompts) == 2
+
+def test_cambiar_la_instruccion_del_paso3_solo_repite_el_paso3(cache):
+    fila = banco_items(1).loc[0]
+    model = ModeloFalso()
+    procesar_item(model, fila, "", "", "", cache=cache)
+    assert len(model.prompts) == 3
+    model.prompts.clear()
+    procesar_item(model, fila, "", "", "Actividades en parejas", cache=cache)
+    assert len(model.prompts) == 1
+    assert "Actividades en parejas" in model.prompts[0]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Pruebas de la cancelación de ejecuciones y trabajos (python -m pytest -q)."""
+
+import threading
+import time
+
+import pytest
+
+from conftest import ModeloFalso, banco_items
+from motor import EjecucionCancelada, LimitadorAdaptativo, ejecutar_enriquecimiento
+from trabajos import CuotaCompartida
+
+def limitador_agotado():
+    limitador = LimitadorAdaptativo(rpm=1, tpm=1_000_000)
+    limitador.adquirir(1)
+    return limitador
+
+def en_hilo(funcion, *args):
+    errores = []
+    def correr():
+        try:
+            funcion(*args)
+        except Exception as e:
+            errores.append(e)
+    hilo = threading.Thread(target=correr)
+    hilo.start()
+    return hilo, errores
+
+def test_limitador_deja_de_esperar_al_cancelar():
+    limitador, cancelado = limitador_agotado(), threading.Event()
+    hilo, errores = en_hilo(limitador.adquirir, 1, cancelado)
+    time.sleep(0.1)
+    inicio = time.monotonic()
+    cancelado.set()
+    hilo.join(2)
+    assert not hilo.is_alive() and time.monotonic() - inicio < 1
+    assert isinstance(errores[0], EjecucionCancelada)
+
+def test_trabajo_cancelado_deja_la_fila_de_la_cuota():
+    cuota = CuotaCompartida(limitador_agotado())
+    cancelado_a, cancelado_b = threading.Event(), threading.Event()
+    # "a" tiene el turno y espera cupo en el limitador; "b" espera su turno detrás
+    hilo_a, errores_a = en_hilo(cuota.adquirir, "a", 1, cancelado_a)
+    time.sleep(0.1)
+    hilo_b, errores_b = en_hilo(cuota.adquirir, "b", 1, cancelado_b)
+    time.sleep(0.1)
+
+    cancelado_b.set()
+    cuota.despertar()
+    hilo_b.join(2)
+    assert not hilo_b.is_alive() and isinstance(errores_b[0], EjecucionCancelada)
+    assert "b" not in cuota._esperando
+
+    cancelado_a.set()
+    hilo_a.join(2)
+    assert not hilo_a.is_alive() and isinstance(errores_a[0], EjecucionCancelada)
+    assert not cuota._esperando and not cuota._ocupado
+
+def test_ejecucion_cancelada_no_hace_mas_llamadas():
+    cancelado = threading.Event()
+    def cancelar_tras_dos_llamadas(prompt):
+        if len(model.prompts) >= 2:
+            cancelado.set()
+    model = ModeloFalso(fallar=cancelar_tras_dos_llamadas)
+    df = banco_items(6)
+    resultados = list(ejecutar_enriquecimiento(model, "gemini-2.5-flash", df, df, max_concurrencia=1, cancelado=cancelado))
+
+    # La llamada que activó la cancelación ya estaba hecha; los ítems cortados no se informan como errores
+    assert len(model.prompts) == 2
+    assert resultados == []
+
+@pytest.mark.parametrize("agrupar", [False, True])
+def test_cancelar_antes_de_empezar(agrupar):
+    cancelado = threading.Event()
+    cancelado.set()
+    model = ModeloFalso()
+    df = banco_items(4)
+    assert list(ejecutar_enriquecimiento(model, "gemini-2.5-flash", df, df, agrupar_pasajes=agrupar, cancelado=cancelado)) == []
+    assert model.prompts == []
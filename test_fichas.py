@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Pruebas de regresión del renderizado de fichas (python -m pytest -q)."""
+
+import os
+import zipfile
+from io import BytesIO
+
+import pandas as pd
+from docx import Document
+
+from fichas import CacheFichas, PlantillaFicha, contextos_fichas, ensamblar_zip_fichas, renderizar_ficha_docxtpl, variables_plantilla
+from motor import limpiar_html_columna
+
+def plantilla_con(*parrafos):
+    documento = Document()
+    for parrafo in parrafos:
+        documento.add_paragraph(parrafo)
+    salida = BytesIO()
+    documento.save(salida)
+    return salida.getvalue()
+
+NOTAS_AL_PIE_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<w:footnotes xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+    '<w:footnote w:id="1"><w:p><w:r><w:t>Fuente: {{ Fuente }}</w:t></w:r></w:p></w:footnote>'
+    '</w:footnotes>'
+)
+
+def con_nota_al_pie(plantilla_bytes):
+    """Agrega a la plantilla una parte de notas al pie con la variable `Fuente`."""
+    salida = BytesIO()
+    with zipfile.ZipFile(BytesIO(plantilla_bytes)) as origen, zipfile.ZipFile(salida, "w", zipfile.ZIP_DEFLATED) as destino:
+        for info in origen.infolist():
+            contenido = origen.read(info).decode("utf-8") if info.filename.endswith((".xml", ".rels")) else origen.read(info)
+            if info.filename == "[Content_Types].xml":
+                contenido = contenido.replace("</Types>", (
+                    '<Override PartName="/word/footnotes.xml" ContentType="application/'
+                    'vnd.openxmlformats-officedocument.wordprocessingml.footnotes+xml"/></Types>'
+                ))
+            elif info.filename == "word/_rels/document.xml.rels":
+                contenido = contenido.replace("</Relationships>", (
+                    '<Relationship Id="rIdNotas" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+                    'relationships/footnotes" Target="footnotes.xml"/></Relationships>'
+                ))
+            destino.writestr(info, contenido)
+        destino.writestr("word/footnotes.xml", NOTAS_AL_PIE_XML)
+    return salida.getvalue()
+
+def nota_al_pie_ficha(docx_bytes):
+    with zipfile.ZipFile(BytesIO(docx_bytes)) as ficha:
+        return ficha.read("word/footnotes.xml").decode("utf-8")
+
+def texto_ficha(docx_bytes):
+    return "\n".join(parrafo.text for parrafo in Document(BytesIO(docx_bytes)).paragraphs)
+
+def test_enunciado_con_entidades_html_conserva_el_texto():
+    df = pd.DataFrame({"ItemEnunciado": ["<p>Si x &lt; 5 &amp; y&nbsp;&gt; 2</p>", "Tom &amp; Jerry"]})
+    df["ItemEnunciado"] = limpiar_html_columna(df["ItemEnunciado"])
+    _, contextos = contextos_fichas(df)
+    plantilla_bytes = plantilla_con("Enunciado: {{ ItemEnunciado }}")
+    plantilla = PlantillaFicha(plantilla_bytes)
+    for contexto, esperado in zip(contextos, ["Enunciado: Si x < 5 & y > 2", "Enunciado: Tom & Jerry"]):
+        assert texto_ficha(plantilla.renderizar(contexto)) == esperado
+        assert texto_ficha(renderizar_ficha_docxtpl(plantilla_bytes, contexto)) == esperado
+
+def test_variable_solo_en_nota_al_pie(tmp_path):
+    plantilla_bytes = con_nota_al_pie(plantilla_con("Ítem {{ ItemId }}"))
+    assert variables_plantilla(plantilla_bytes) == {"ItemId", "Fuente"}
+
+    df = pd.DataFrame({"ItemId": ["A1", "A2"], "Fuente": ["Pisa 2018", "Pisa 2018"]})
+    cache = CacheFichas(os.path.join(tmp_path, "fichas.sqlite"))
+    ensamblar_zip_fichas(df, plantilla_bytes, BytesIO(), cache=cache)
+    df.loc[0, "Fuente"] = "Timss 2019"
+    cache.reiniciar_contadores()
+    salida = BytesIO()
+    ensamblar_zip_fichas(df, plantilla_bytes, salida, cache=cache)
+
+    assert cache.aciertos == 1
+    with zipfile.ZipFile(salida) as zip_fichas:
+        assert "Fuente: Timss 2019" in nota_al_pie_ficha(zip_fichas.read("A1.docx"))
+        assert "Fuente: Pisa 2018" in nota_al_pie_ficha(zip_fichas.read("A2.docx"))
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Pruebas de los prompts agrupados por pasaje (python -m pytest -q)."""
+
+from google.api_core import exceptions as google_exceptions
+
+from conftest import RESPUESTA_PASO1, RESPUESTA_PASO2, PATRON_ITEMS_GRUPO, ModeloFalso, banco_items
+from motor import COLUMNA_ERROR, MARCA_ERROR, agrupar_por_pasaje, dividir_secciones_grupo, ejecutar_enriquecimiento
+
+def enriquecer_agrupado(model, df):
+    resultados = list(ejecutar_enriquecimiento(model, "gemini-2.5-flash", df, df, agrupar_pasajes=True, max_por_grupo=8))
+    return {i: (error, uso) for i, _, error, uso in resultados}
+
+def banco(n):
+    df = banco_items(n)
+    for col in ("Que_Evalua", "Justificacion_Correcta", "Analisis_Distractores", "Recomendacion_Fortalecer", "Recomendacion_Avanzar"):
+        df[col] = ""
+    return df
+
+def fallar_agrupadas(paso):
+    marca = "FASE 1: RUTA COGNITIVA" if paso == 1 else "RECOMENDACIÓN PARA AVANZAR"
+    def fallar(prompt):
+        if marca in prompt and PATRON_ITEMS_GRUPO.search(prompt):
+            raise google_exceptions.InvalidArgument("El prompt agrupado excede el contexto.")
+    return fallar
+
+def test_dividir_secciones_grupo():
+    texto = "=== ÍTEM 2 ===\nsegunda\n\n== ítem 1 ==\nprimera\n=== ÍTEM 9 ===\nsobra"
+    assert dividir_secciones_grupo(texto, 3) == ["primera", "segunda", None]
+
+def test_agrupar_por_pasaje_respeta_el_tamano_maximo():
+    df = banco_items(5, contexto="Un   texto")
+    df.loc[4, "ItemContexto"] = "Otro texto"
+    assert agrupar_por_pasaje(df, max_por_grupo=3) == [[0, 1, 2], [3], [4]]
+
+def test_pasos_1_y_3_se_piden_una_vez_por_grupo():
+    model = ModeloFalso()
+    df = banco(4)
+    salidas = enriquecer_agrupado(model, df)
+    assert all(error is None for error, _ in salidas.values())
+    assert len(model.prompts) == 1 + 4 + 1
+    assert (df["Justificacion_Correcta"] != "").all() and (df["Recomendacion_Avanzar"] != "").all()
+
+def test_paso1_agrupado_fallido_se_repite_por_item():
+    model = ModeloFalso(fallar=fallar_agrupadas(1))
+    df = banco(8)
+    salidas = enriquecer_agrupado(model, df)
+    assert all(error is None for error, _ in salidas.values())
+    assert (df[COLUMNA_ERROR] == "").all()
+
+def test_paso3_agrupado_fallido_conserva_los_pasos_previos_y_el_uso():
+    def fallar(prompt):
+        if "RECOMENDACIÓN PARA AVANZAR" in prompt:
+            raise google_exceptions.InvalidArgument("Solicitud inválida.")
+    model = ModeloFalso(fallar=fallar)
+    df = banco(8)
+    salidas = enriquecer_agrupado(model, df)
+
+    assert all(error is not None and error.paso == 3 for error, _ in salidas.values())
+    assert (df["Justificacion_Correcta"] == RESPUESTA_PASO1.split("\n")[1]).all()
+    assert (df["Que_Evalua"] == RESPUESTA_PASO2).all()
+    assert (df["Recomendacion_Avanzar"] == MARCA_ERROR).all()
+    # El consumo de las llamadas que sí respondieron (paso 1 agrupado y pasos 2) se reparte entre los ítems
+    assert all(uso and uso["tokens_entrada"] > 0 for _, uso in salidas.values())
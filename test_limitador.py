@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Pruebas del limitador adaptativo y de los reintentos con backoff (python -m pytest -q)."""
+
+import time
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+import motor
+from conftest import RespuestaFalsa
+from motor import LIMITES_MODELO, LimitadorAdaptativo, generar_texto
+
+class ModeloIntermitente:
+    """Lanza los `errores` indicados en las primeras llamadas y luego responde."""
+
+    def __init__(self, *errores):
+        self._model_name = "publishers/google/models/gemini-2.5-flash"
+        self.errores = list(errores)
+        self.llamadas = 0
+
+    def generate_content(self, prompt, **kwargs):
+        self.llamadas += 1
+        if self.errores:
+            raise self.errores.pop(0)
+        return RespuestaFalsa("respuesta")
+
+@pytest.fixture
+def sin_esperas(monkeypatch):
+    """Backoff sin jitter ni pausas reales; registra las esperas pedidas."""
+    esperas = []
+    monkeypatch.setattr(motor.random, "uniform", lambda a, b: b)
+    monkeypatch.setattr(motor.time, "sleep", esperas.append)
+    return esperas
+
+def test_con_holgura_no_espera():
+    limitador = LimitadorAdaptativo(rpm=60, tpm=1_000_000)
+    inicio = time.monotonic()
+    for _ in range(60):
+        limitador.adquirir(1000)
+    assert time.monotonic() - inicio < 0.5
+
+def test_sin_cupo_espera_la_recarga():
+    limitador = LimitadorAdaptativo(rpm=600, tpm=1_000_000)
+    limitador._peticiones = 0
+    inicio = time.monotonic()
+    limitador.adquirir(1)
+    # 600 peticiones/min: una petición se recarga en 0,1 s
+    assert 0.05 < time.monotonic() - inicio < 1
+
+def test_429_baja_el_ritmo_una_vez_por_rafaga_y_se_recupera():
+    limitador = LimitadorAdaptativo(rpm=100, tpm=1_000_000)
+    limitador.registrar_limite()
+    limitador.registrar_limite()
+    assert limitador.factor == pytest.approx(0.7)
+    assert limitador.holgura() < 1
+    for _ in range(50):
+        limitador.registrar_exito()
+    assert limitador.factor == 1.0
+
+def test_el_ritmo_no_baja_del_minimo():
+    limitador = LimitadorAdaptativo(rpm=100, tpm=1_000_000)
+    for _ in range(20):
+        limitador._ultimo_429 = 0.0
+        limitador.registrar_limite()
+    assert limitador.factor == pytest.approx(0.1)
+
+def test_tokens_reales_corrigen_el_estimado():
+    limitador = LimitadorAdaptativo(rpm=100, tpm=10_000)
+    limitador.adquirir(5_000)
+    limitador.ajustar_tokens(5_000, 1_000)
+    assert limitador._tokens == pytest.approx(9_000, abs=50)
+
+def test_para_modelo_usa_la_cuota_del_modelo_y_acepta_la_region():
+    modelo = next(iter(LIMITES_MODELO))
+    limitador = LimitadorAdaptativo.para_modelo(f"{modelo}@europe-west1")
+    assert (limitador.rpm, limitador.tpm) == (LIMITES_MODELO[modelo]["rpm"], LIMITES_MODELO[modelo]["tpm"])
+
+def test_errores_transitorios_se_reintentan_con_backoff_exponencial(sin_esperas):
+    model = ModeloIntermitente(google_exceptions.TooManyRequests("429"), google_exceptions.ServiceUnavailable("503"))
+    assert generar_texto(model, "prompt") == "respuesta"
+    assert model.llamadas == 3
+    assert sin_esperas == [1, 2]
+
+def test_solo_el_429_frena_el_limitador(monkeypatch):
+    monkeypatch.setattr(motor.random, "uniform", lambda a, b: 0)
+    model = ModeloIntermitente(google_exceptions.ServiceUnavailable("503"), google_exceptions.TooManyRequests("429"))
+    limitador = LimitadorAdaptativo(rpm=6000, tpm=10_000_000)
+    assert generar_texto(model, "prompt", limitador) == "respuesta"
+    assert limitador.factor == pytest.approx(0.7 + 0.01)
+
+def test_agotados_los_reintentos_se_lanza_el_error(sin_esperas):
+    model = ModeloIntermitente(*[google_exceptions.InternalServerError("500")] * 3)
+    with pytest.raises(google_exceptions.InternalServerError):
+        generar_texto(model, "prompt", max_reintentos=2)
+    assert model.llamadas == 3
+
+def test_errores_no_transitorios_no_se_reintentan(sin_esperas):
+    model = ModeloIntermitente(google_exceptions.InvalidArgument("400"))
+    with pytest.raises(google_exceptions.InvalidArgument):
+        generar_texto(model, "prompt")
+    assert model.llamadas == 1 and sin_esperas == []
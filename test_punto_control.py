@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Pruebas de los puntos de control y la reanudación (python -m pytest -q)."""
+
+import os
+
+import pytest
+
+from conftest import ModeloFalso, banco_items
+from motor import COLUMNAS_NUEVAS, PuntoControl, clave_item, ejecutar_enriquecimiento, restaurar_punto_control
+
+@pytest.fixture
+def punto_control(tmp_path):
+    return PuntoControl(os.path.join(tmp_path, "checkpoints", "ejecucion.jsonl"))
+
+def banco(item_ids):
+    df = banco_items(len(item_ids))
+    df["ItemId"] = item_ids
+    df["ItemEnunciado"] = [f"Enunciado {n}" for n in range(len(item_ids))]
+    for col in COLUMNAS_NUEVAS:
+        df[col] = ""
+    return df
+
+def fallar_en(enunciado):
+    def fallar(prompt):
+        if enunciado in prompt:
+            raise ValueError("Respuesta inválida.")
+    return fallar
+
+def enriquecer(model, df, df_pendiente, punto_control):
+    return list(ejecutar_enriquecimiento(model, "gemini-2.5-flash", df, df_pendiente, punto_control=punto_control, max_concurrencia=2))
+
+def test_clave_item_combina_item_id_y_posicion():
+    df = banco(["A", "A"])
+    assert [clave_item(df.loc[i], i) for i in df.index] == ["A@1", "A@2"]
+    assert clave_item(df.drop(columns="ItemId").loc[1], 1) == "2"
+
+def test_clave_ejecucion_cambia_con_el_excel_el_modelo_y_las_instrucciones():
+    base = PuntoControl.clave_ejecucion(b"excel", "gemini-2.5-flash")
+    assert base == PuntoControl.clave_ejecucion(b"excel", "gemini-2.5-flash", ("", "", ""))
+    assert base != PuntoControl.clave_ejecucion(b"otro excel", "gemini-2.5-flash")
+    assert base != PuntoControl.clave_ejecucion(b"excel", "gemini-2.5-pro")
+    assert base != PuntoControl.clave_ejecucion(b"excel", "gemini-2.5-flash", ("", "", "En parejas"))
+
+def test_reanudar_solo_procesa_lo_que_falta(punto_control):
+    df = banco(["A", "A", "B"])
+    model = ModeloFalso(fallar=fallar_en("Enunciado 2"))
+    enriquecer(model, df, df, punto_control)
+
+    # Nueva ejecución sobre el mismo Excel: los ítems con el mismo ItemId se recuperan cada uno en su posición
+    df = banco(["A", "A", "B"])
+    ya_completados = restaurar_punto_control(df, punto_control)
+    assert ya_completados == [0, 1]
+    assert (df.loc[[0, 1], "Que_Evalua"] != "").all() and df.loc[2, "Que_Evalua"] == ""
+
+    model = ModeloFalso()
+    resultados = enriquecer(model, df, df.drop(index=ya_completados), punto_control)
+    assert [i for i, _, error, _ in resultados if error is None] == [2]
+    assert len(model.prompts) == 3
+    assert set(punto_control.cargar()) == {"A@1", "A@2", "B@3"}
+
+def test_sin_reanudar_se_borra_el_punto_control(punto_control):
+    punto_control.registrar("A@1", {"Que_Evalua": "x"})
+    assert restaurar_punto_control(banco(["A"]), punto_control, reanudar=False) == []
+    assert punto_control.cargar() == {}
+
+def test_linea_truncada_por_una_caida_se_ignora(punto_control):
+    punto_control.registrar("A@1", {"Que_Evalua": "x"})
+    with open(punto_control.ruta, "a", encoding="utf-8") as f:
+        f.write('{"item": "A@2", "resul')
+    assert punto_control.cargar() == {"A@1": {"Que_Evalua": "x"}}
+    punto_control.registrar("A@3", {"Que_Evalua": "z"})
+    assert set(punto_control.cargar()) == {"A@1", "A@3"}
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Pruebas de la conmutación de región del PoolRegiones (python -m pytest -q)."""
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from conftest import RespuestaFalsa
+from motor import PoolRegiones, Streaming, generar_texto
+
+class ModeloRegional:
+    """Responde en fragmentos; `fallar_tras` fragmentos lanza un 429 (None: nunca falla)."""
+
+    def __init__(self, fragmentos, fallar_tras=None):
+        self._model_name = "publishers/google/models/gemini-2.5-flash"
+        self.fragmentos = fragmentos
+        self.fallar_tras = fallar_tras
+        self.llamadas = 0
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        self.llamadas += 1
+        if not stream:
+            if self.fallar_tras is not None:
+                raise google_exceptions.TooManyRequests("cuota agotada")
+            return RespuestaFalsa("".join(self.fragmentos))
+        return self._fragmentos()
+
+    def _fragmentos(self):
+        for n, texto in enumerate(self.fragmentos):
+            if n == self.fallar_tras:
+                raise google_exceptions.TooManyRequests("cuota agotada")
+            yield RespuestaFalsa(texto)
+
+def por_region(pool):
+    return {fila["region"]: fila for fila in pool.estadisticas()}
+
+def sin_llamadas_en_curso(pool):
+    return all(estado["en_curso"] == 0 for estado in pool._estado.values())
+
+def test_llamada_normal_cambia_de_region_ante_un_429():
+    pool = PoolRegiones({"a": ModeloRegional(["hola"], fallar_tras=0), "b": ModeloRegional(["hola"])})
+    # Sin limitadores todas las regiones tienen la misma holgura: se fuerza que "a" vaya primero
+    pool._estado["b"]["ultima"] = 1.0
+    assert pool.generate_content("prompt").text == "hola"
+    estadisticas = por_region(pool)
+    assert estadisticas["a"]["errores_429"] == 1 and estadisticas["b"]["llamadas"] == 1
+    assert sin_llamadas_en_curso(pool)
+
+def test_streaming_cambia_de_region_si_falla_antes_del_primer_fragmento():
+    a, b = ModeloRegional(["no llega"], fallar_tras=0), ModeloRegional(["Hola ", "mundo"])
+    pool = PoolRegiones({"a": a, "b": b})
+    pool._estado["b"]["ultima"] = 1.0
+    texto = generar_texto(pool, "prompt", streaming=Streaming(), max_reintentos=0)
+
+    assert texto == "Hola mundo"
+    assert (a.llamadas, b.llamadas) == (1, 1)
+    estadisticas = por_region(pool)
+    assert estadisticas["a"]["errores_429"] == 1 and estadisticas["b"]["llamadas"] == 1
+    assert sin_llamadas_en_curso(pool)
+
+def test_streaming_ya_empezado_no_cambia_de_region_pero_cuenta_el_fallo():
+    pool = PoolRegiones({"a": ModeloRegional(["Hola ", "mundo"], fallar_tras=1), "b": ModeloRegional(["otra"])})
+    pool._estado["b"]["ultima"] = 1.0
+    fragmentos = pool.generate_content("prompt", stream=True)
+    assert next(fragmentos).text == "Hola "
+    with pytest.raises(google_exceptions.TooManyRequests):
+        next(fragmentos)
+    assert por_region(pool)["a"]["errores_429"] == 1
+    assert sin_llamadas_en_curso(pool)
+
+def test_streaming_cerrado_antes_de_terminar_libera_la_region():
+    pool = PoolRegiones({"a": ModeloRegional(["Hola ", "mundo"])})
+    fragmentos = pool.generate_content("prompt", stream=True)
+    next(fragmentos)
+    fragmentos.close()
+    assert sin_llamadas_en_curso(pool)
+    assert por_region(pool)["a"]["llamadas"] == 0
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Pruebas del modo de reparación de celdas con error (python -m pytest -q)."""
+
+from io import BytesIO
+
+import pytest
+
+from conftest import RESPUESTA_PASO2, RESPUESTA_PASO3, banco_items
+from motor import (
+    COLUMNA_ERROR, COLUMNAS_NUEVAS, MARCA_ERROR, MODO_REPARACION, aplicar_resultado, celda_fallida, ejecutar_enriquecimiento,
+    filas_a_reparar, leer_excel, pasos_pendientes, reparar_item, serializar_datos,
+)
+
+def exportar_y_releer(df):
+    return leer_excel(BytesIO(serializar_datos(df, "Excel (.xlsx)")))
+
+def enriquecer(model, df, modo="3 pasos", pendientes=None):
+    pendientes = df if pendientes is None else df.loc[pendientes]
+    return list(ejecutar_enriquecimiento(model, "gemini-2.5-flash", df, pendientes, modo=modo, max_concurrencia=2))
+
+def test_reparar_una_exportacion_sin_errores(modelo_falso):
+    df = leer_excel(BytesIO(serializar_datos(banco_items(3), "Excel (.xlsx)")))
+    enriquecer(modelo_falso, df)
+    assert (df[COLUMNA_ERROR] == "").all()
+
+    # Error_IA quedó vacío en toda la columna: al releer el Excel no puede llegar como float64
+    df = exportar_y_releer(df)
+    df.loc[1, "Que_Evalua"] = ""
+    assert filas_a_reparar(df) == [1]
+    modelo_falso.prompts.clear()
+    resultados = enriquecer(modelo_falso, df, MODO_REPARACION, filas_a_reparar(df))
+
+    assert [(i, error) for i, _, error, _ in resultados] == [(1, None)]
+    assert df.loc[1, "Que_Evalua"] == RESPUESTA_PASO2
+    # El paso 1 se reutiliza desde el Excel: solo se piden los pasos 2 y 3
+    assert len(modelo_falso.prompts) == 2
+    assert filas_a_reparar(df) == []
+
+def test_columna_generada_toda_vacia_se_puede_reparar(modelo_falso):
+    df = banco_items(2)
+    for col in COLUMNAS_NUEVAS:
+        df[col] = "x"
+    df["Recomendacion_Avanzar"] = None
+    df = exportar_y_releer(df)
+    assert filas_a_reparar(df) == [0, 1]
+    assert all(pasos_pendientes(df.loc[i]) == [3] for i in (0, 1))
+
+    enriquecer(modelo_falso, df, MODO_REPARACION, filas_a_reparar(df))
+    assert filas_a_reparar(df) == []
+    assert df.loc[0, "Que_Evalua"] == "x"
+
+def test_error_deja_los_pasos_terminados_y_marca_el_resto():
+    df = banco_items(1)
+    for col in COLUMNAS_NUEVAS:
+        df[col] = ""
+    aplicar_resultado(df, 0, {"Justificacion_Correcta": "j", "Analisis_Distractores": "d"}, ValueError("paso 2"))
+    assert df.loc[0, "Justificacion_Correcta"] == "j"
+    assert df.loc[0, "Que_Evalua"] == MARCA_ERROR
+    assert df.loc[0, COLUMNA_ERROR] == "paso 2"
+    assert pasos_pendientes(df.loc[0]) == [2, 3]
+
+@pytest.mark.parametrize("valor, fallida", [
+    ("texto", False), ("", True), ("   ", True), (None, True), (float("nan"), True),
+    (MARCA_ERROR, True), ("Error: 429 cuota agotada", True),
+])
+def test_celda_fallida(valor, fallida):
+    assert celda_fallida(valor) is fallida
+
+def test_reparar_item_solo_pide_los_pasos_fallidos(modelo_falso):
+    fila = banco_items(1, Justificacion_Correcta="ruta guardada", Analisis_Distractores="Análisis de Opciones No Válidas:\n- B",
+                       Que_Evalua="qué evalúa guardado", Recomendacion_Fortalecer=MARCA_ERROR, Recomendacion_Avanzar=MARCA_ERROR).loc[0]
+    assert pasos_pendientes(fila) == [3]
+    resultado = reparar_item(modelo_falso, fila)
+
+    assert len(modelo_falso.prompts) == 1
+    assert "qué evalúa guardado" in modelo_falso.prompts[0] and "ruta guardada" in modelo_falso.prompts[0]
+    assert resultado["Que_Evalua"] == "qué evalúa guardado"
+    assert resultado["Recomendacion_Avanzar"] == RESPUESTA_PASO3.split("\n\n")[1]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Pruebas de las respuestas en streaming y sus validadores parciales (python -m pytest -q)."""
+
+import pytest
+
+from conftest import RESPUESTA_PASO1, RespuestaFalsa
+from motor import RespuestaAbortada, Streaming, generar_texto, validador_parcial, validar_paso1
+
+class ModeloEnFragmentos:
+    """Entrega cada respuesta de `respuestas` (una por llamada) en fragmentos de `tamano` caracteres."""
+
+    def __init__(self, *respuestas, tamano=20):
+        self._model_name = "publishers/google/models/gemini-2.5-flash"
+        self.respuestas = list(respuestas)
+        self.tamano = tamano
+        self.entregados = []
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        return self._fragmentos(self.respuestas.pop(0))
+
+    def _fragmentos(self, texto):
+        self.entregados.append(0)
+        for inicio in range(0, len(texto), self.tamano):
+            self.entregados[-1] += 1
+            yield RespuestaFalsa(texto[inicio:inicio + self.tamano])
+
+@pytest.mark.parametrize("texto", ["Ru", "**Ruta Cognitiva", "  ruta cognitiva correcta:\nSe", RESPUESTA_PASO1])
+def test_paso1_acepta_lo_que_aun_puede_terminar_bien(texto):
+    validador_parcial(1)(texto)
+
+@pytest.mark.parametrize("paso, texto, motivo", [
+    (1, "Lo siento, no puedo", "no empieza con"),
+    (1, "Ruta Cognitiva Correcta:\n" + "x" * 8100, "no trae 'Análisis de Opciones No Válidas:'"),
+    (1, "Ruta Cognitiva Correcta:\nAnálisis de Opciones No Válidas:\n" + "x" * 12000, "presupuesto de 12000"),
+    (2, "Este ítem evalúa " + "x" * 600, "presupuesto de 600"),
+    (3, "x" * 8100, "no trae 'RECOMENDACIÓN PARA AVANZAR'"),
+])
+def test_corta_las_respuestas_que_ya_no_pueden_terminar_bien(paso, texto, motivo):
+    with pytest.raises(RespuestaAbortada, match=motivo):
+        validador_parcial(paso)(texto)
+
+def test_respuesta_desviada_se_corta_y_se_vuelve_a_pedir():
+    desviada = "Lo siento, como modelo de lenguaje no puedo ayudar con esto. " * 10
+    model = ModeloEnFragmentos(desviada, RESPUESTA_PASO1)
+    parciales, abortos, uso = [], [], {}
+    streaming = Streaming(lambda indices, paso, texto: parciales.append(texto), lambda indices, paso, motivo: abortos.append(motivo))
+
+    texto = generar_texto(model, "prompt", validar=validar_paso1, uso=uso, paso=1, streaming=streaming,
+                          validar_parcial=validador_parcial(1))
+
+    assert texto == RESPUESTA_PASO1
+    # La respuesta desviada se cortó en su primer fragmento, sin leer el resto
+    assert model.entregados[0] == 1
+    assert len(abortos) == 1 and uso["abortos"] == 1 and uso["llamadas"] == 2
+    assert parciales[-1] == RESPUESTA_PASO1
+
+def test_sin_mas_reintentos_de_corte_se_lanza_el_error():
+    model = ModeloEnFragmentos(*["No sé."] * 3)
+    with pytest.raises(RespuestaAbortada):
+        generar_texto(model, "prompt", paso=1, streaming=Streaming(max_abortos=2), validar_parcial=validador_parcial(1))
+    assert len(model.entregados) == 3
@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+"""Trabajos de enriquecimiento en segundo plano, independientes de la sesión de Streamlit.
+
+Un trabajo se envía con el Excel y la configuración elegida en la interfaz y corre en un hilo
+del gestor del proceso: sobrevive a los reruns, a otras interacciones y al cierre de la pestaña.
+Su estado, avance y resultados por ítem se guardan en una base SQLite, desde donde la interfaz
+los consulta. Los trabajos de distintos usuarios se reparten por turnos la cuota de cada modelo.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from motor import (
+    DIRECTORIO_DATOS, MODO_REPARACION, ContextoFewShotCacheado, EjecucionCancelada, LimitadorAdaptativo, Streaming,
+    abrir_punto_control, aplicar_resultado, aplicar_uso, clave_modelos, comprobar_cancelacion, crear_enrutador, ejecutar_enriquecimiento,
+    filas_a_reparar, histograma_latencias, inicializar_vertex, leer_excel, registros_llamadas, restaurar_punto_control, resumir_llamadas, resumir_uso, setup_model,
+)
+
+ESTADOS_ACTIVOS = ("en_cola", "en_curso")
+ESTADOS_REANUDABLES = ("cancelado", "interrumpido", "fallido")
+MAX_EVENTOS_RECIENTES = 30
+MAX_MUESTRAS_LATENCIA = 500
+MAX_CARACTERES_PARCIAL = 400
+
+# --- CUOTA COMPARTIDA ENTRE TRABAJOS ---
+
+class CuotaCompartida:
+    """Reparte por turnos el limitador de un modelo entre los trabajos que compiten por él.
+
+    Cuando varios trabajos esperan cupo, el siguiente permiso va al trabajo que lleva más tiempo
+    sin recibir uno; así un trabajo con mucha concurrencia no acapara la cuota de la instancia.
+    """
+
+    def __init__(self, limitador):
+        self.limitador = limitador
+        self._cond = threading.Condition()
+        self._esperando = {}
+        self._ultimo_turno = {}
+        self._ocupado = False
+
+    def para(self, trabajo_id):
+        return _CuotaTrabajo(self, trabajo_id)
+
+    def _siguiente(self):
+        return min(self._esperando, key=lambda trabajo: self._ultimo_turno.get(trabajo, 0.0))
+
+    def _salir(self, trabajo_id):
+        self._esperando[trabajo_id] -= 1
+        if not self._esperando[trabajo_id]:
+            del self._esperando[trabajo_id]
+        self._cond.notify_all()
+
+    def adquirir(self, trabajo_id, tokens_estimados, cancelado=None):
+        """Espera el turno del trabajo y luego el cupo del limitador; un trabajo cancelado deja la fila (EjecucionCancelada)."""
+        with self._cond:
+            self._esperando[trabajo_id] = self._esperando.get(trabajo_id, 0) + 1
+            try:
+                while self._ocupado or self._siguiente() != trabajo_id:
+                    comprobar_cancelacion(cancelado)
+                    self._cond.wait()
+                comprobar_cancelacion(cancelado)
+            except EjecucionCancelada:
+                self._salir(trabajo_id)
+                raise
+            self._ocupado = True
+        try:
+            self.limitador.adquirir(tokens_estimados, cancelado)
+        finally:
+            with self._cond:
+                self._ultimo_turno[trabajo_id] = time.monotonic()
+                self._ocupado = False
+                self._salir(trabajo_id)
+
+    def despertar(self):
+        """Despierta a los que esperan turno para que un trabajo recién cancelado deje la fila."""
+        with self._cond:
+            self._cond.notify_all()
+
+class _CuotaTrabajo:
+    """Vista de una CuotaCompartida para un trabajo; se usa como un LimitadorAdaptativo."""
+
+    def __init__(self, cuota, trabajo_id):
+        self._cuota = cuota
+        self._trabajo_id = trabajo_id
+
+    def adquirir(self, tokens_estimados, cancelado=None):
+        self._cuota.adquirir(self._trabajo_id, tokens_estimados, cancelado)
+
+    def ajustar_tokens(self, estimados, reales):
+        self._cuota.limitador.ajustar_tokens(estimados, reales)
+
+    def registrar_exito(self):
+        self._cuota.limitador.registrar_exito()
+
+    def registrar_limite(self):
+        self._cuota.limitador.registrar_limite()
+
+    def holgura(self):
+        return self._cuota.limitador.holgura()
+
+# --- MONITOR DE AVANCE ---
+
+def percentil(valores_ordenados, q):
+    """Percentil por rango más cercano de una lista ya ordenada."""
+    if not valores_ordenados:
+        return None
+    return valores_ordenados[min(int(q * len(valores_ordenados)), len(valores_ordenados) - 1)]
+
+class MonitorTrabajo:
+    """Agregados en memoria del avance de un trabajo, de tamaño fijo sin importar cuántos ítems tenga.
+
+    Guarda cuántos ítems están en curso, los últimos eventos en un búfer circular, una ventana
+    de las latencias más recientes de cada paso (de la que salen p50 y p95) y, en streaming, el
+    final del texto que va llegando para cada unidad en curso.
+    """
+
+    def __init__(self, max_eventos=MAX_EVENTOS_RECIENTES, max_muestras=MAX_MUESTRAS_LATENCIA):
+        self._lock = threading.Lock()
+        self._en_curso = set()
+        self._eventos = deque(maxlen=max_eventos)
+        self._max_muestras = max_muestras
+        self._latencias = {}
+        self._costo_usd = 0.0
+        self._parciales = {}
+        # Función que entrega el reparto entre regiones mientras corre el trabajo (ver EnrutadorModelos.estadisticas_regiones)
+        self.regiones = None
+
+    def evento(self, tipo, texto):
+        with self._lock:
+            self._eventos.append({"hora": time.strftime("%H:%M:%S"), "tipo": tipo, "detalle": texto})
+
+    def empezar(self, indices):
+        with self._lock:
+            self._en_curso.update(indices)
+
+    def vaciar_en_curso(self):
+        with self._lock:
+            self._en_curso.clear()
+            self._parciales.clear()
+
+    def fragmento(self, indices, items, paso, texto):
+        """Texto parcial (solo el final) de la respuesta que está llegando para los ítems `indices`."""
+        with self._lock:
+            self._parciales[tuple(indices)] = {"ítems": items, "paso": paso, "texto": texto[-MAX_CARACTERES_PARCIAL:]}
+
+    def terminar(self, indice, item_id, error, uso):
+        with self._lock:
+            self._en_curso.discard(indice)
+            for indices in [indices for indices in self._parciales if indice in indices]:
+                del self._parciales[indices]
+            self._costo_usd += (uso or {}).get("costo_usd", 0.0)
+            for paso, segundos in ((uso or {}).get("latencia_pasos_s") or {}).items():
+                self._latencias.setdefault(int(paso), deque(maxlen=self._max_muestras)).append(segundos)
+        if error is not None:
+            self.evento("error", f"Ítem {item_id}: {error}")
+        else:
+            self.evento("ok", f"Ítem {item_id} completado" + (f" en {uso['latencia_s']:.1f} s" if uso and "latencia_s" in uso else ""))
+
+    def latencias_pasos(self):
+        """{paso: {"p50_s", "p95_s", "muestras"}} sobre la ventana de latencias recientes."""
+        with self._lock:
+            ventanas = {paso: sorted(muestras) for paso, muestras in self._latencias.items()}
+        return {
+            paso: {"p50_s": percentil(valores, 0.5), "p95_s": percentil(valores, 0.95), "muestras": len(valores)}
+            for paso, valores in sorted(ventanas.items())
+        }
+
+    def instantanea(self):
+        with self._lock:
+            en_curso, eventos, costo_usd = len(self._en_curso), list(self._eventos), self._costo_usd
+            parciales = list(self._parciales.values())
+        return {
+            "en_curso": en_curso, "eventos": eventos[::-1], "latencia_pasos": self.latencias_pasos(), "costo_usd": costo_usd,
+            "parciales": parciales, "regiones": self.regiones() if self.regiones else [],
+        }
+
+# --- ALMACÉN DE TRABAJOS ---
+
+class AlmacenTrabajos:
+    """Estado, avance y resultados por ítem de cada trabajo, en SQLite."""
+
+    def __init__(self, ruta):
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(ruta, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS trabajos ("
+            "id TEXT PRIMARY KEY, nombre_excel TEXT NOT NULL, parametros TEXT NOT NULL, estado TEXT NOT NULL, "
+            "creado REAL NOT NULL, inicio REAL, fin REAL, total INTEGER NOT NULL DEFAULT 0, "
+            "recuperados INTEGER NOT NULL DEFAULT 0, completados INTEGER NOT NULL DEFAULT 0, errores INTEGER NOT NULL DEFAULT 0, "
+            "mensaje TEXT NOT NULL DEFAULT '', avisos TEXT NOT NULL DEFAULT '[]', resumen TEXT NOT NULL DEFAULT '{}')"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "trabajo TEXT NOT NULL, indice INTEGER NOT NULL, item_id TEXT NOT NULL, resultado TEXT, error TEXT, uso TEXT, "
+            "ts REAL NOT NULL, PRIMARY KEY (trabajo, indice))"
+        )
+        self._conn.commit()
+
+    def crear(self, trabajo_id, nombre_excel, parametros):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO trabajos (id, nombre_excel, parametros, estado, creado) VALUES (?, ?, ?, 'en_cola', ?)",
+                (trabajo_id, nombre_excel, json.dumps(parametros, ensure_ascii=False), time.time()),
+            )
+            self._conn.commit()
+
+    def actualizar(self, trabajo_id, **campos):
+        for campo in ("parametros", "avisos", "resumen"):
+            if campo in campos:
+                campos[campo] = json.dumps(campos[campo], ensure_ascii=False, default=str)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE trabajos SET {', '.join(f'{campo} = ?' for campo in campos)} WHERE id = ?",
+                (*campos.values(), trabajo_id),
+            )
+            self._conn.commit()
+
+    def registrar_item(self, trabajo_id, indice, item_id, resultado, error, uso):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO items (trabajo, indice, item_id, resultado, error, uso, ts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    trabajo_id, int(indice), str(item_id),
+                    json.dumps(resultado, ensure_ascii=False) if resultado is not None else None,
+                    str(error) if error is not None else None,
+                    json.dumps(uso, ensure_ascii=False) if uso else None,
+                    time.time(),
+                ),
+            )
+            columna = "errores" if error is not None else "completados"
+            self._conn.execute(f"UPDATE trabajos SET {columna} = {columna} + 1 WHERE id = ?", (trabajo_id,))
+            self._conn.commit()
+
+    def fallos(self, trabajo_id, filtro="", limite=200):
+        """Ítems con error que contienen `filtro` en su id o en el mensaje; retorna (total, primeros `limite`)."""
+        condicion = "trabajo = ? AND error IS NOT NULL AND (item_id LIKE ? OR error LIKE ?)"
+        patron = f"%{filtro}%"
+        with self._lock:
+            total = self._conn.execute(f"SELECT COUNT(*) FROM items WHERE {condicion}", (trabajo_id, patron, patron)).fetchone()[0]
+            filas = self._conn.execute(
+                f"SELECT item_id, error, ts FROM items WHERE {condicion} ORDER BY ts DESC LIMIT ?",
+                (trabajo_id, patron, patron, limite),
+            ).fetchall()
+        return total, [dict(fila) for fila in filas]
+
+    def descartar_errores(self, trabajo_id):
+        """Olvida los ítems fallidos de un intento anterior (se vuelven a intentar al reanudar)."""
+        with self._lock:
+            self._conn.execute("DELETE FROM items WHERE trabajo = ? AND error IS NOT NULL", (trabajo_id,))
+            self._conn.commit()
+
+    @staticmethod
+    def _como_dict(fila):
+        trabajo = dict(fila)
+        for campo in ("parametros", "avisos", "resumen"):
+            trabajo[campo] = json.loads(trabajo[campo])
+        return trabajo
+
+    def obtener(self, trabajo_id):
+        with self._lock:
+            fila = self._conn.execute("SELECT * FROM trabajos WHERE id = ?", (trabajo_id,)).fetchone()
+        return self._como_dict(fila) if fila else None
+
+    def listar(self, limite=50):
+        with self._lock:
+            filas = self._conn.execute("SELECT * FROM trabajos ORDER BY creado DESC LIMIT ?", (limite,)).fetchall()
+        return [self._como_dict(fila) for fila in filas]
+
+    def items(self, trabajo_id):
+        with self._lock:
+            filas = self._conn.execute("SELECT * FROM items WHERE trabajo = ? ORDER BY ts", (trabajo_id,)).fetchall()
+        return [dict(fila) for fila in filas]
+
+    def marcar_interrumpidos(self):
+        """Los trabajos que estaban activos cuando se detuvo el proceso quedan listos para reanudarse."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE trabajos SET estado = 'interrumpido', mensaje = 'El proceso se reinició durante la ejecución.' "
+                "WHERE estado IN ('en_cola', 'en_curso')"
+            )
+            self._conn.commit()
+
+# --- GESTOR DE TRABAJOS ---
+
+class GestorTrabajos:
+    """Ejecuta trabajos en un pool de hilos propio del proceso, compartido por todas las sesiones.
+
+    `parametros` de un trabajo es un dict JSON con la configuración de la interfaz (proyecto,
+    región, modelos, modo, concurrencia, cachés...). `fabrica_cache(ruta, max_mb)` entrega la
+    caché de respuestas compartida del proceso.
+    """
+
+    def __init__(self, directorio=os.path.join(DIRECTORIO_DATOS, "trabajos"), max_simultaneos=4, fabrica_cache=None):
+        os.makedirs(directorio, exist_ok=True)
+        self.directorio = directorio
+        self.fabrica_cache = fabrica_cache
+        self.almacen = AlmacenTrabajos(os.path.join(directorio, "trabajos.sqlite"))
+        self.almacen.marcar_interrumpidos()
+        self._executor = ThreadPoolExecutor(max_workers=max_simultaneos, thread_name_prefix="trabajo")
+        self._cancelaciones = {}
+        self._monitores = {}
+        self._cuotas = {}
+        self._lock = threading.Lock()
+
+    def cuota(self, model_name):
+        with self._lock:
+            if model_name not in self._cuotas:
+                self._cuotas[model_name] = CuotaCompartida(LimitadorAdaptativo.para_modelo(model_name))
+            return self._cuotas[model_name]
+
+    def _ruta_excel(self, trabajo_id):
+        return os.path.join(self.directorio, f"{trabajo_id}.xlsx")
+
+    def enviar(self, contenido_excel, nombre_excel, parametros):
+        """Encola un trabajo y retorna su id."""
+        trabajo_id = uuid.uuid4().hex[:12]
+        with open(self._ruta_excel(trabajo_id), "wb") as f:
+            f.write(contenido_excel)
+        self.almacen.crear(trabajo_id, nombre_excel, parametros)
+        self._lanzar(trabajo_id)
+        return trabajo_id
+
+    def _lanzar(self, trabajo_id):
+        self._cancelaciones[trabajo_id] = threading.Event()
+        self._monitores[trabajo_id] = MonitorTrabajo()
+        self._executor.submit(self._ejecutar, trabajo_id)
+
+    def cancelar(self, trabajo_id):
+        """Detiene el trabajo sin hacer más llamadas al modelo; lo ya terminado queda en el punto de control."""
+        if trabajo_id in self._cancelaciones:
+            self._cancelaciones[trabajo_id].set()
+            with self._lock:
+                cuotas = list(self._cuotas.values())
+            for cuota in cuotas:
+                cuota.despertar()
+            self._monitores[trabajo_id].evento(
+                "aviso", "Cancelación solicitada; no se harán más llamadas al modelo y se esperan las respuestas ya pedidas."
+            )
+
+    def reanudar(self, trabajo_id):
+        trabajo = self.almacen.obtener(trabajo_id)
+        if not trabajo or trabajo["estado"] not in ESTADOS_REANUDABLES:
+            return False
+        self.almacen.actualizar(
+            trabajo_id, estado="en_cola", mensaje="", parametros={**trabajo["parametros"], "reanudar": True}
+        )
+        self._lanzar(trabajo_id)
+        return True
+
+    def obtener(self, trabajo_id):
+        return self.almacen.obtener(trabajo_id)
+
+    def monitor(self, trabajo_id):
+        """Instantánea del MonitorTrabajo (None si el trabajo no se ejecutó en este proceso)."""
+        monitor = self._monitores.get(trabajo_id)
+        return monitor.instantanea() if monitor else None
+
+    def fallos(self, trabajo_id, filtro="", limite=200):
+        return self.almacen.fallos(trabajo_id, filtro, limite)
+
+    def listar(self, limite=50):
+        return self.almacen.listar(limite)
+
+    def dataframe(self, trabajo_id):
+        """Excel del trabajo con los resultados obtenidos hasta ahora (incluidos los recuperados del punto de control)."""
+        trabajo = self.almacen.obtener(trabajo_id)
+        ruta_excel = self._ruta_excel(trabajo_id)
+        df = leer_excel(ruta_excel, trabajo["parametros"].get("columnas"))
+        if "clave_modelos" in trabajo["resumen"]:
+            with open(ruta_excel, "rb") as f:
+                contenido_excel = f.read()
+            punto_control = abrir_punto_control(
+                contenido_excel, trabajo["resumen"]["clave_modelos"], trabajo["parametros"].get("bucket_checkpoints") or None,
+                trabajo["parametros"]["instrucciones"],
+            )
+            restaurar_punto_control(df, punto_control)
+        for item in self.almacen.items(trabajo_id):
+            if item["indice"] in df.index:
+                resultado = json.loads(item["resultado"]) if item["resultado"] else None
+                aplicar_resultado(df, item["indice"], resultado, item["error"])
+                aplicar_uso(df, item["indice"], json.loads(item["uso"]) if item["uso"] else None)
+        return df
+
+    def telemetria(self, trabajo_id):
+        """Una fila por llamada al modelo de los ítems procesados en este trabajo."""
+        return registros_llamadas(
+            (item["item_id"], json.loads(item["uso"]) if item["uso"] else None) for item in self.almacen.items(trabajo_id)
+        )
+
+    def _ejecutar(self, trabajo_id):
+        cancelado = self._cancelaciones[trabajo_id]
+        monitor = self._monitores[trabajo_id]
+        if cancelado.is_set():
+            self.almacen.actualizar(trabajo_id, estado="cancelado", fin=time.time())
+            return
+        p = self.almacen.obtener(trabajo_id)["parametros"]
+        self.almacen.actualizar(trabajo_id, estado="en_curso", inicio=time.time(), fin=None, avisos=[])
+        self.almacen.descartar_errores(trabajo_id)
+        avisos = []
+        try:
+            model_name = p["model_name"]
+            inicializar_vertex(p["project_id"], p["location"])
+            model = setup_model(p["project_id"], p["location"], model_name)
+            enrutador = None
+            if p["modo_ejecucion"] == "En línea":
+                modelos_por_paso = {int(paso): nombre for paso, nombre in p["modelos_por_paso"].items()}
+                enrutador = crear_enrutador(
+                    p["project_id"], p["location"], modelos_por_paso, p["cascada"],
+                    limitador_de=lambda nombre: self.cuota(nombre).para(trabajo_id),
+                    regiones_adicionales=p.get("regiones_adicionales", []),
+                )
+                monitor.regiones = enrutador.estadisticas_regiones
+
+            ruta_excel = self._ruta_excel(trabajo_id)
+            df = leer_excel(ruta_excel, p.get("columnas"))
+            with open(ruta_excel, "rb") as f:
+                contenido_excel = f.read()
+            clave = clave_modelos(model_name, enrutador)
+            punto_control = abrir_punto_control(contenido_excel, clave, p.get("bucket_checkpoints") or None, p["instrucciones"])
+            ya_completados = restaurar_punto_control(df, punto_control, p["reanudar"])
+            df_pendiente = df.drop(index=ya_completados)
+            if p["modo_generacion"] == MODO_REPARACION:
+                # Las filas sin celdas fallidas cuentan como recuperadas: no se vuelven a enviar
+                df_pendiente = df_pendiente.loc[filas_a_reparar(df_pendiente)]
+                ya_completados = df.index.difference(df_pendiente.index)
+            self.almacen.actualizar(
+                trabajo_id, total=len(df), recuperados=len(ya_completados), completados=0, errores=0,
+                resumen={"clave_modelos": clave},
+            )
+            monitor.evento("inicio", f"{len(df_pendiente)} ítems pendientes, {len(ya_completados)} recuperados del punto de control.")
+
+            cache = None
+            if p["usar_cache"] and self.fabrica_cache:
+                cache = self.fabrica_cache(os.path.join(DIRECTORIO_DATOS, "respuestas.sqlite"), p["cache_max_mb"])
+                # La caché es compartida por todos los trabajos: se informa la diferencia de sus contadores
+                aciertos_iniciales, fallos_iniciales = cache.aciertos, cache.fallos
+            usar_contexto_cacheado = p["usar_context_caching"] and p["modo_ejecucion"] == "En línea"
+            modelos_contexto = enrutador.nombres_por_paso() if enrutador else model_name
+            usos = []
+            with (ContextoFewShotCacheado(
+                modelos_contexto, p["project_id"], [p["location"], *p.get("regiones_adicionales", [])], p["ttl_context_caching"]
+            ) if usar_contexto_cacheado else nullcontext()) as contexto_fewshot:
+                if contexto_fewshot is not None:
+                    if contexto_fewshot.cacheados:
+                        avisos.append("Ejemplos fijos cacheados en Vertex: " + ", ".join(
+                            f"paso {paso} ({nombre})" for paso, nombre in contexto_fewshot.cacheados
+                        ) + ".")
+                    for (paso, nombre), motivo in contexto_fewshot.errores.items():
+                        avisos.append(f"No se pudo cachear el prefijo del paso {paso} ({nombre}); se enviará completo. Motivo: {motivo}")
+                    self.almacen.actualizar(trabajo_id, avisos=avisos)
+
+                # Los avisos de streaming llegan desde los hilos de trabajo mientras este hilo escribe en `df`:
+                # leen los ItemId de esta copia tomada antes de empezar
+                ids_items = dict(zip(
+                    df_pendiente.index, df_pendiente['ItemId'] if 'ItemId' in df_pendiente.columns else df_pendiente.index + 1
+                ))
+                streaming = None
+                if p.get("streaming") and p["modo_ejecucion"] == "En línea":
+                    def al_fragmento(indices, paso, texto):
+                        items = ", ".join(str(ids_items[i]) for i in indices)
+                        monitor.fragmento(indices, items, paso, texto)
+
+                    def al_abortar(indices, paso, motivo):
+                        items = ", ".join(str(ids_items[i]) for i in indices)
+                        monitor.evento("cortada", f"Ítem {items}: {motivo} Se vuelve a pedir.")
+
+                    streaming = Streaming(al_fragmento, al_abortar)
+
+                def al_iniciar_ola(paso, n):
+                    mensaje = f"Ola {paso}/3: {n} solicitudes enviadas al trabajo por lotes. Esperando resultados..."
+                    self.almacen.actualizar(trabajo_id, mensaje=mensaje)
+                    monitor.evento("lote", mensaje)
+
+                resultados = ejecutar_enriquecimiento(
+                    enrutador or model, model_name, df, df_pendiente, tuple(p["instrucciones"]), punto_control,
+                    p["modo_ejecucion"], p.get("destino_lotes"), p["max_concurrencia"], self.cuota(model_name).para(trabajo_id),
+                    cache, p["modo_generacion"], agrupar_pasajes=p["agrupar_pasajes"], max_por_grupo=p["max_por_grupo"],
+                    contexto_fewshot=contexto_fewshot, al_iniciar_ola=al_iniciar_ola, al_empezar=monitor.empezar,
+                    streaming=streaming, cancelado=cancelado,
+                )
+                try:
+                    for i, resultado, error, uso in resultados:
+                        item_id = ids_items[i]
+                        if uso:
+                            usos.append((item_id, uso))
+                        self.almacen.registrar_item(trabajo_id, i, item_id, resultado, error, uso)
+                        monitor.terminar(i, item_id, error, uso)
+                        if cancelado.is_set():
+                            break
+                finally:
+                    resultados.close()
+
+            resumen = {"clave_modelos": clave, "latencia_pasos": monitor.latencias_pasos()}
+            if cache:
+                resumen.update(cache_aciertos=cache.aciertos - aciertos_iniciales, cache_fallos=cache.fallos - fallos_iniciales)
+            if usos:
+                resumen["tokens_ahorrados"] = sum(uso.get("tokens_ahorrados", 0) for _, uso in usos)
+                resumen["uso"] = resumir_uso([uso for _, uso in usos]).to_dict("records")
+                registros = registros_llamadas(usos)
+                resumen["llamadas"] = resumir_llamadas(registros).to_dict("records")
+                resumen["histograma_latencia"] = histograma_latencias(registros)
+                resumen["costo_usd"] = sum(registro["costo_usd"] for registro in registros)
+            if enrutador:
+                resumen["enrutamiento"] = enrutador.estadisticas().to_dict("records")
+                resumen["regiones"] = enrutador.estadisticas_regiones()
+            estado = "cancelado" if cancelado.is_set() else "completado"
+            self.almacen.actualizar(trabajo_id, estado=estado, fin=time.time(), resumen=resumen, mensaje="")
+            monitor.evento("fin", "Trabajo cancelado." if cancelado.is_set() else "Trabajo completado.")
+        except Exception as e:
+            self.almacen.actualizar(trabajo_id, estado="fallido", fin=time.time(), mensaje=str(e))
+            monitor.evento("error", f"El trabajo falló: {e}")
+        finally:
+            monitor.vaciar_en_curso()
+